@@ -3,9 +3,44 @@ Oncolysis Controller Module
 ============================
 
 This package contains the modules for the Oncolysis Controller.
+
+The modules are imported on first use (e.g. `oncolysis_ctrl.controller`), so that importing the
+package does not load numpy, pyvisa and pythonnet before the GUI window is shown.
 """
-from . import config
-from . import controller
-from . import rf_switch
-from . import function_generator
-from . import app
+import importlib
+
+SUBMODULES = ('config',
+              'logs',
+              'tracing',
+              'simulator',
+              'mailbox',
+              'stripchart',
+              'session_log',
+              'history',
+              'config_compiler',
+              'controller',
+              'rf_switch',
+              'function_generator',
+              'channel_state',
+              'calibration',
+              'calibration_fit',
+              'envelope',
+              'dryrun',
+              'dose',
+              'clock',
+              'watchdog',
+              'reconcile',
+              'transport',
+              'server',
+              'orchestrator',
+              'app')
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBMODULES))
@@ -5,17 +5,21 @@ module containing the main application window class and functions
 """
 import tkinter as tk
 import os
+import datetime
 import logging
-from oncolysis_ctrl import controller, config
+import math
+import sqlite3
+import time
+from oncolysis_ctrl import config, dose, tracing, mailbox, stripchart
 from tkinter import font, ttk, messagebox
 import traceback
 import idlelib.tooltip as tooltip
-import numpy as np
 
 HERE = os.path.dirname(__file__)
 logger = logging.getLogger("oc.app")
 
 constants = config.constants
+PRESSURE_STRING_KEYS = ('mi', 'pressure', 'voltage', 'isppa', 'ispta', 'burst_length', 'period', 'duty_cycle')
 logger.info(f'Using configuration "{config.config_id}"')
 
 
@@ -50,6 +54,7 @@ class App(tk.Frame):
     :param power_settings: A dictionary of power settings
     :param voltage_calibration: A dictionary of voltage calibration values
     :param amplifier_gain: The amplifier gain
+    :param server_address: (host, port) of a controller server to attach to, or None to control the hardware directly
     """
     def __init__(self, root, 
                  simulate=False, 
@@ -61,14 +66,12 @@ class App(tk.Frame):
                  power_modes=constants.POWER_MODES, power_mode=constants.POWER_MODE,
                  power_settings=constants.POWER_SETTINGS, 
                  voltage_calibration=constants.CALIB,
-                 amplifier_gain=constants.AMPLIFIER_GAIN): 
+                 amplifier_gain=constants.AMPLIFIER_GAIN,
+                 server_address=None): 
+        t0 = time.perf_counter()
         super().__init__(root)
         self.top = self.winfo_toplevel()
-        config_id = config.get_config_id()
-        if simulate:
-            self.top.title(f'OpenWater Oncolysis Controller ({config_id}, SIMULATE MODE)')
-        else:
-            self.top.title(f'OpenWater Oncolysis Controller ({config_id})')
+        self.set_title(simulate)
 
         self.bigfont = font.Font(size=20, weight=font.BOLD)
         self.mediumfont = font.Font(size=16, weight=font.BOLD)
@@ -133,24 +136,8 @@ class App(tk.Frame):
         for i in range(2):
             self.freqsel_frame.rowconfigure(i, weight=1)
         self.frequency_data = {}
-        for i, f in enumerate(self.frequencies):
-            d = {}
-            d['value'] = f
-            d['var'] = tk.IntVar()
-            d['command'] = lambda freq=f: self.set_frequencies(freq)
-            d['checkbox'] = tk.Checkbutton(self.freqsel_frame,
-                                           text=f'{f}',
-                                           indicatoron=False,
-                                           command=d['command'],
-                                           variable=d['var'],
-                                           onvalue=1,
-                                           offvalue=0,
-                                           width=4,
-                                           font=self.bigfont)
-            d['checkbox'].grid(row=0, column=i, sticky='nsew')
-            d['tooltip'] = Hovertip_CustomFont(d['checkbox'], f'{f}', self.monofont, hover_delay=50)
-            self.frequency_data[f] = d
-            self.freqsel_frame.columnconfigure(i, weight=1)
+        self.pressure_strings_job = None
+        self.build_frequency_selector()
 
         self.freqsel_frame.grid(row=rowidx, column=0, sticky=tk.E+tk.W)
         self.param_frame.grid_rowconfigure(rowidx, weight=1)
@@ -188,6 +175,7 @@ class App(tk.Frame):
                                      width=30,
                                      length=300,
                                      font=self.bigfont)
+        self.power_slider.configure(command=self.update_pressure_strings)
         self.power_slider.bind('<ButtonRelease-1>', self.set_power_value)
         self.power_slider.grid(row=1, column=0, sticky=tk.E + tk.W)
         self.power_frame.grid_rowconfigure(0, weight=1)
@@ -271,6 +259,15 @@ class App(tk.Frame):
                                       font=self.bigfont, width=30)
         self.abort_button.grid(row=rowidx, column=1, sticky=tk.E+tk.W)
         self.treat_frame.grid_rowconfigure(rowidx, weight=1)
+        rowidx += 1
+        self.notes_frame = tk.Frame(self.treat_frame)
+        self.notes_label = tk.Label(self.notes_frame, text='Notes', anchor='w', font=self.smallfont)
+        self.notes_label.pack(side=tk.LEFT)
+        self.notes_var = tk.StringVar(value='')
+        self.notes_entry = tk.Entry(self.notes_frame, textvariable=self.notes_var, font=self.smallfont)
+        self.notes_entry.pack(side=tk.LEFT, expand=True, fill=tk.X)
+        self.notes_frame.grid(row=rowidx, column=0, columnspan=2, sticky=tk.E+tk.W, pady=2)
+        self.treat_frame.grid_rowconfigure(rowidx, weight=1)
         self.treat_frame.grid_columnconfigure(0, weight=1)
         self.treat_frame.grid_columnconfigure(1, weight=1)
 
@@ -299,38 +296,209 @@ class App(tk.Frame):
         self.treat_frame.grid(row=frowidx, column=0, sticky=tk.E+tk.W)
         self.grid_rowconfigure(frowidx, weight=2)
         frowidx += 1
+
+        # Create Treatment Chart
+        chart_traces = [stripchart.Trace('voltage', 'Vin', full_scale=constants.MAX_VOLTAGE * 1e3,
+                                         fmt='{:.0f} mV', color='#903000'),
+                        stripchart.Trace('output', 'Output', full_scale=1,
+                                         fmt=lambda value: 'ON' if value else 'OFF', color='#002030'),
+                        stripchart.Trace('frequency', 'Freq', categorical=True, fmt='{:g} kHz'),
+                        stripchart.Trace('dose', 'Dose', step=False, fmt='{:.3g} J/cm2', color='#2ca02c')]
+        self.chart = stripchart.StripChart(self, self.sample_chart, chart_traces, font=self.smallfont,
+                                           padx=10, pady=5)
+        self.chart.grid(row=frowidx, column=0, sticky=tk.E+tk.W+tk.N+tk.S)
+        self.grid_rowconfigure(frowidx, weight=3)
+        frowidx += 1
         self.grid_columnconfigure(0, weight=1)
 
         # Pack all elements
         self.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
+        # Show the window before loading the controller, which imports numpy. The controls are
+        # disabled until the controller exists.
+        self.set_controls_enabled(False)
+        self.root.update()
+        logger.info('[init] Window shown after %.0f ms', (time.perf_counter() - t0) * 1e3)
+        from oncolysis_ctrl import controller, server, history
+        try:
+            self.history = history.RunStore()
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f'[init] Could not open the run history: {e}')
+            self.history = None
         self.voltage_calibration = voltage_calibration
         self.amplifier_gain = amplifier_gain
+        # The controller callbacks run on other threads: post them to the Tk main loop
+        self.mailbox = mailbox.Mailbox(self.root)
         self.controller = controller.Controller(frequencies=[],
+                                                frequency_options=frequencies,
+                                                burst_lengths=burst_lengths,
+                                                duty_cycles=duty_cycles,
                                                 pressure=self.power_vals_dict[self.power_mode],
                                                 burst_duty_cycle=duty_cycle,
                                                 duration=duration,
-                                                simulate=simulate)
+                                                simulate=simulate,
+                                                ask_simulate=lambda: self.mailbox.call(controller.ask_simulate),
+                                                history=self.history)
+        self.open_stages = controller.OPEN_STAGES
+        self.update_power_limit()
         self.update_pressure_strings()
-        self.control_queue = controller.ControlQueue(self.controller, on_open=self.on_open, on_treat=self.on_treat,
-                                                     on_wait=self.on_wait, on_end=self.on_end, on_error=self.on_error)
+        callbacks = {'on_open': self.mailbox.wrap(self.on_open),
+                     'on_progress': self.mailbox.wrap(self.on_progress, key='progress'),
+                     'on_treat': self.mailbox.wrap(self.on_treat),
+                     'on_wait': self.mailbox.wrap(self.on_wait, key='wait'),
+                     'on_end': self.mailbox.wrap(self.on_end),
+                     'on_error': self.mailbox.wrap(self.on_error)}
+        self.attached = server_address is not None
+        if server_address is None:
+            self.control_queue = controller.ControlQueue(self.controller, **callbacks)
+        else:
+            self.control_queue = server.RemoteControlQueue(self.controller, *server_address, **callbacks)
+        self.mailbox.start()
         self.is_running = False
         self.is_started = False
-        config.REBOOT = False
-        logger.info('[init] App started')
+        self.set_controls_enabled(True)
+        self.chart.start()
+        self.root.bind('<Control-T>', self.toggle_tracing)
+        logger.info('[init] App started after %.0f ms', (time.perf_counter() - t0) * 1e3)
+
+    def build_frequency_selector(self, selected=()):
+        """
+        (Re)create the frequency checkboxes for the current list of frequencies
+
+        :param selected: frequencies to check (the frequencies the controller will treat)
+        """
+        for d in self.frequency_data.values():
+            d['checkbox'].destroy()
+        for i in range(len(self.frequency_data)):
+            self.freqsel_frame.columnconfigure(i, weight=0)
+        self.frequency_data = {}
+        for i, f in enumerate(self.frequencies):
+            d = {}
+            d['value'] = f
+            d['var'] = tk.IntVar(value=int(f in selected))
+            d['command'] = lambda freq=f: self.set_frequencies(freq)
+            d['checkbox'] = tk.Checkbutton(self.freqsel_frame,
+                                           text=f'{f}',
+                                           indicatoron=False,
+                                           command=d['command'],
+                                           variable=d['var'],
+                                           onvalue=1,
+                                           offvalue=0,
+                                           width=4,
+                                           font=self.bigfont)
+            d['checkbox'].grid(row=0, column=i, sticky='nsew')
+            d['tooltip'] = Hovertip_CustomFont(d['checkbox'], lambda freq=f: self.pressure_string(freq), self.monofont,
+                                               hover_delay=50)
+            self.frequency_data[f] = d
+            self.freqsel_frame.columnconfigure(i, weight=1)
 
     def load_config(self, config_name):
         """
-        Load a configuration
+        Load a configuration. The switch happens in place: the controller keeps its hardware
+        connections if the new configuration uses the same hardware, and only the widgets that depend
+        on the configuration are rebuilt.
 
         :param config_name: Name of the configuration to load
         """
         config_id = config.CONFIG_IDS[config.CONFIG_NAMES.index(config_name)]
-        prev_id = config.get_config_id()
-        if not config_id == prev_id:
-            logger.info(f'[load_config] Rebooting into configuration {config_id}')
-            config.set_config_id(config_id)
-            config.REBOOT = True
-            self.quit_app()
+        prev_id = config.config_id
+        if config_id == prev_id:
+            return
+        from oncolysis_ctrl import controller  # already imported by __init__
+        t0 = time.perf_counter()
+        new_constants = config.get_constants(config_id)
+        if self.controller.is_connected and \
+                controller.get_hardware_id(new_constants) != self.controller.get_hardware_id():
+            logger.warning(f'[load_config] {config_id} uses different hardware. Disconnect before switching')
+            messagebox.showwarning(title='Configuration', message='This configuration uses different hardware.\n'
+                                                                  'Disconnect before switching.')
+            self.config_name.set(config.CONFIG_NAMES[config.CONFIG_IDS.index(prev_id)])
+            return
+        logger.info(f'[load_config] Switching to configuration {config_id}')
+        config.load_config(config_id)
+        self.controller.set_constants(new_constants)
+        self.reload_config(new_constants)
+        if self.controller.is_connected:
+            self.control_queue.reconcile()
+        logger.info(f'[load_config] Loaded {config_id} in {(time.perf_counter() - t0) * 1e3:0.1f} ms')
+
+    def reload_config(self, constants):
+        """
+        Rebuild the widgets that depend on the configuration
+
+        :param constants: constants module of the new configuration
+        """
+        self.set_title(self.controller.simulate)
+        self.frequencies = constants.FREQUENCIES_KHZ
+        # The controller keeps the selected frequencies that the new configuration offers
+        self.build_frequency_selector(selected=self.controller.frequencies)
+
+        self.power_mode = constants.POWER_MODE
+        self.power_settings = constants.POWER_SETTINGS
+        self.power_mode_dict = {self.power_settings[mode]['label']: mode for mode in constants.POWER_MODES}
+        self.power_vals_dict = {mode: self.power_settings[mode]['default'] for mode in constants.POWER_MODES}
+        power_settings = self.power_settings[self.power_mode]
+        self.set_menu_options(self.power_mode_select, self.power_mode_str, list(self.power_mode_dict),
+                              power_settings['label'], self.set_power_mode)
+        self.power_slider.configure(from_=power_settings['minmax'][0],
+                                    to=power_settings['minmax'][1],
+                                    resolution=power_settings['step'])
+        self.power_value.set(power_settings['default'])
+        self.power_units_label.configure(text=power_settings['units'])
+
+        self.burst_lengths = constants.BURST_LENGTHS
+        self.burst_length_descs = tuple(f'{int(burst_length * 1000):0d} ms' for burst_length in self.burst_lengths)
+        burst_length = constants.BURST_LENGTH if constants.BURST_LENGTH in self.burst_lengths else self.burst_lengths[0]
+        self.set_menu_options(self.burst_length_menu, self.burst_length_str, self.burst_length_descs,
+                              self.burst_length_descs[self.burst_lengths.index(burst_length)], self.set_burst_length)
+
+        duty_cycle_strs = [f'{duty_cycle * 100:0.3g}%' for duty_cycle in constants.BURST_DUTY_CYCLES]
+        self.duty_cycle_dict = dict(zip(duty_cycle_strs, constants.BURST_DUTY_CYCLES))
+        self.set_menu_options(self.duty_cycle_menu, self.duty_cycle_str, duty_cycle_strs,
+                              duty_cycle_strs[constants.BURST_DUTY_CYCLES.index(constants.BURST_DUTY_CYCLE)],
+                              self.set_duty_cycle)
+
+        self.durations = constants.DURATIONS_S
+        self.duration_descriptions = tuple((config_time(t) for t in self.durations))
+        duration = constants.DURATION_S if constants.DURATION_S in self.durations else self.durations[0]
+        self.set_menu_options(self.duration_menu, self.duration_str, self.duration_descriptions,
+                              self.duration_descriptions[self.durations.index(duration)], self.set_duration)
+        self.controller.duration = duration
+
+        self.voltage_calibration = constants.CALIB
+        self.amplifier_gain = constants.AMPLIFIER_GAIN
+        self.update_power_limit()
+        self.update_pressure_strings()
+        if self.controller.is_connected:
+            self.set_controls_enabled(True)
+        self.check_ready()
+
+    @staticmethod
+    def set_menu_options(menu, variable, options, value, command):
+        """
+        Replace the options of an OptionMenu
+
+        :param menu: OptionMenu to update
+        :param variable: variable attached to the menu
+        :param options: new option strings
+        :param value: option to select
+        :param command: callback for a selection
+        """
+        dropdown = menu['menu']
+        dropdown.delete(0, 'end')
+        for option in options:
+            dropdown.add_command(label=option, command=tk._setit(variable, option, command))
+        variable.set(value)
+
+    def set_title(self, simulate):
+        """
+        Set the window title
+
+        :param simulate: True if in simulation mode
+        """
+        if simulate:
+            self.top.title(f'OpenWater Oncolysis Controller ({config.config_id}, SIMULATE MODE)')
+        else:
+            self.top.title(f'OpenWater Oncolysis Controller ({config.config_id})')
 
     def set_simulate(self):
         """
@@ -342,10 +510,7 @@ class App(tk.Frame):
         simulate = self.simulate_var.get() == 1
         logger.info(f'[set_simulate] Set controll.simulation to {simulate}')
         self.controller.simulate = simulate
-        if simulate:
-            self.top.title(f'OpenWater Oncolysis Controller (SIMULATE MODE)')
-        else:
-            self.top.title(f'OpenWater Oncolysis Controller')
+        self.set_title(simulate)
 
     def toggle_connect(self):
         """
@@ -365,7 +530,6 @@ class App(tk.Frame):
             self.config_select.configure(state='disabled')
             self.simulate_checkbox.configure(state='disabled')
             self.toggle_connect_button.configure(text='Connecting...', state=tk.DISABLED)
-            self.root.update()
             self.control_queue.start_queue()
             self.control_queue.open()
 
@@ -383,6 +547,8 @@ class App(tk.Frame):
                         self.burst_length_menu,
                         self.duty_cycle_menu,
                         self.power_mode_select]
+        if len(self.config_names) > 1:
+            all_controls.append(self.config_select)
         for control in all_controls:
             control.configure(state=state)
 
@@ -398,6 +564,7 @@ class App(tk.Frame):
         selected_frequencies = self.get_frequencies()
         self.controller.set_frequencies(selected_frequencies)
         self.check_ready()
+        self.update_power_limit()
         self.update_pressure_strings()
 
     def set_power_mode(self, power_mode_str):
@@ -418,6 +585,7 @@ class App(tk.Frame):
         self.power_value.set(self.power_vals_dict[self.power_mode])
         self.power_units_label.configure(text=power_settings['units'])
         self.controller.power_mode = self.power_mode
+        self.update_power_limit()
         self.set_power_value()
 
     def set_power_value(self, event=None):
@@ -435,39 +603,79 @@ class App(tk.Frame):
             self.controller.power_value = power_value
             self.update_pressure_strings()
 
-    def update_pressure_strings(self):
-        """
-        Update the pressure strings for each frequency
-        """
-        warn_logo = '[!]'
-        ok_logo = ''
-        for f in self.frequencies:
-            pressure_target = self.controller.calc_pressure_target(f, self.power_vals_dict[self.power_mode])
-            voltage_target = self.controller.calc_voltage(f, pressure_target)
-            MI = pressure_target*1e-3/np.sqrt(f*1e-3)
-            warn_mi = warn_logo if MI > 1.91 else ok_logo
-            isppa = (pressure_target*1e3)**2/3e6/1e4
-            warn_isppa = warn_logo if isppa > 190.1 else ok_logo
-            warn_v = warn_logo if voltage_target > 1.01 else ok_logo
-            adjusted_burst_length = self.controller.calc_burst_length(f)
-            period = self.controller.burst_length / self.controller.burst_duty_cycle
-            adjusted_duty_cycle = adjusted_burst_length/period
-            ispta = isppa*adjusted_duty_cycle*1e3
-            warn_ispta = warn_logo if ispta > 720.1 else ok_logo
-            label_text = f'{f} kHz\n' \
-                         f'{"MI":<6}:{MI:5.2f} {"":6} {warn_mi}\n' \
-                         f'{"PNP":<6}:{pressure_target:5.0f} {"kPa":6}\n' \
-                         f'{"Vin":<6}:{1e3 * voltage_target:5.0f} {"mV":6} {warn_v}\n' \
-                         f'{"ISPPA":<6}:{isppa:5.1f} {"W/cm2":6} {warn_isppa}\n' \
-                         f'{"ISPTA":<6}:{ispta:5.0f} {"mW/cm2":6} {warn_ispta}\n' \
-                         f'{"BURST":<6}:{adjusted_burst_length*1e3:5.3g} {"ms":6}\n' \
-                         f'{"PERIOD":<6}:{period*1e3:5.3g} {"ms":6}\n' \
-                         f'{"DUTY":<6}:{adjusted_duty_cycle*100:5.3g} {"%":6}'
-            self.frequency_data[f]['tooltip'].text = label_text
-            if any((warn_mi, warn_isppa, warn_ispta, warn_v)):
-                self.frequency_data[f]['checkbox'].configure(foreground='#903000')
-            else:
-                self.frequency_data[f]['checkbox'].configure(foreground='#002030')
+    def update_power_limit(self):
+        """
+        Limit the power slider to the safe operating envelope of the selected frequencies and settings
+        """
+        power_settings = self.power_settings[self.power_mode]
+        low, high = power_settings['minmax']
+        step = power_settings['step']
+        max_value, binding, frequency = self.controller.envelope.get_max_value(self.get_frequencies(),
+                                                                               self.power_mode,
+                                                                               self.controller.burst_length,
+                                                                               self.controller.burst_duty_cycle)
+        limit = low + step * math.floor((max_value - low) / step + 1e-9) if max_value > low else low
+        limit = min(limit, high)
+        self.power_slider.configure(to=limit)
+        if binding != 'range':
+            logger.info(f'[update_power_limit] {power_settings["label"]} limited to {limit} {power_settings["units"]} '
+                        f'by {binding} at {frequency} kHz')
+        if self.power_value.get() > limit:
+            logger.info(f'[update_power_limit] Reducing power to {limit} {power_settings["units"]}')
+            self.power_value.set(limit)
+            self.power_vals_dict[self.power_mode] = limit
+            self.controller.power_value = limit
+
+    def update_pressure_strings(self, value=None):
+        """
+        Schedule an update of the pressure strings. Updates requested within one frame are merged.
+
+        :param value: (optional) slider value, when called while the slider is moving
+        """
+        if self.pressure_strings_job is None:
+            self.pressure_strings_job = self.root.after(mailbox.FRAME_MS, self.refresh_pressure_strings)
+
+    def refresh_pressure_strings(self):
+        """
+        Update the acoustic parameters shown by the tooltip of each frequency, and the colour of its checkbox
+        """
+        self.pressure_strings_job = None
+        limits = self.controller.safety_limits
+        power_value = self.controller.power_value if self.is_started else self.power_value.get()
+        params = self.controller.calc_acoustic_params_array(self.frequencies, power_value)
+        columns = [params[key].tolist() for key in PRESSURE_STRING_KEYS]
+        for f, values in zip(self.frequencies, zip(*columns)):
+            data = self.frequency_data[f]
+            data['params'] = dict(zip(PRESSURE_STRING_KEYS, values))
+            warn = any(data['params'][key] > limits[key] for key in ('mi', 'isppa', 'voltage', 'ispta'))
+            foreground = '#903000' if warn else '#002030'
+            # Only touch the checkboxes whose colour changed
+            if foreground != data.get('foreground'):
+                data['checkbox'].configure(foreground=foreground)
+                data['foreground'] = foreground
+
+    def pressure_string(self, f):
+        """
+        Format the tooltip of a frequency. Called when the tooltip is shown.
+
+        :param f: frequency
+        :return: tooltip text
+        """
+        params = self.frequency_data[f].get('params')
+        if params is None:
+            return f'{f} kHz'
+        limits = self.controller.safety_limits
+        warn_mi, warn_isppa, warn_v, warn_ispta = ('[!]' if params[key] > limits[key] else ''
+                                                   for key in ('mi', 'isppa', 'voltage', 'ispta'))
+        return f'{f} kHz\n' \
+               f'{"MI":<6}:{params["mi"]:5.2f} {"":6} {warn_mi}\n' \
+               f'{"PNP":<6}:{params["pressure"]:5.0f} {"kPa":6}\n' \
+               f'{"Vin":<6}:{1e3 * params["voltage"]:5.0f} {"mV":6} {warn_v}\n' \
+               f'{"ISPPA":<6}:{params["isppa"]:5.1f} {"W/cm2":6} {warn_isppa}\n' \
+               f'{"ISPTA":<6}:{params["ispta"]:5.0f} {"mW/cm2":6} {warn_ispta}\n' \
+               f'{"BURST":<6}:{params["burst_length"]*1e3:5.3g} {"ms":6}\n' \
+               f'{"PERIOD":<6}:{params["period"]*1e3:5.3g} {"ms":6}\n' \
+               f'{"DUTY":<6}:{params["duty_cycle"]*100:5.3g} {"%":6}'
 
     def set_burst_length(self, burst_length_desc):
         """
@@ -479,6 +687,7 @@ class App(tk.Frame):
         burst_length = self.burst_lengths[burst_length_index]
         logger.info(f'[set_burst_length] Setting burst length to {burst_length_desc}')
         self.controller.set_burst_length(burst_length)
+        self.update_power_limit()
         self.update_pressure_strings()
 
     def set_duty_cycle(self, duty_cycle_str):
@@ -490,6 +699,7 @@ class App(tk.Frame):
         duty_cycle = self.duty_cycle_dict[duty_cycle_str]
         logger.info(f'[set_duty_cycle] Setting duty cycle to {duty_cycle_str}')
         self.controller.set_duty_cycle(duty_cycle)
+        self.update_power_limit()
         self.update_pressure_strings()
 
     def set_duration(self, duration):
@@ -537,6 +747,15 @@ class App(tk.Frame):
         ready_state = tk.NORMAL if ready else tk.DISABLED
         self.startpause_button.configure(state=ready_state)
 
+    def on_progress(self, stage):
+        """
+        Show the progress of the connection
+
+        :param stage: stage of the connection (key of `controller.OPEN_STAGES`)
+        """
+        self.toggle_connect_button.configure(text=self.open_stages[stage])
+
+    @tracing.traced('app.on_open')
     def on_open(self):
         """
         Callback function for when the controller is connected
@@ -545,16 +764,16 @@ class App(tk.Frame):
             self.toggle_connect_button.configure(state=tk.NORMAL, text='Failed to Connect. Click to Reset.')
         else:
             self.toggle_connect_button.configure(state=tk.NORMAL, text='Disconnect')
+        self.set_title(self.controller.simulate)
         if self.controller.simulate:
-            self.top.title(f'OpenWater Oncolysis Controller (SIMULATE MODE)')
             self.startpause_button.configure(text='Start Simulation')
             self.simulate_var.set(1)
         else:
-            self.top.title(f'OpenWater Oncolysis Controller')
             self.startpause_button.configure(text='Start')
         self.set_controls_enabled(True)
         self.check_ready()
 
+    @tracing.traced('app.on_treat')
     def on_treat(self, index):
         """
         Callback function for when a treatment is started
@@ -566,8 +785,8 @@ class App(tk.Frame):
         n = len(freqs)
         self.pbar['value'] = 100 * (index + 1) / n
         self.pbar_label_var.set(f'[{index + 1}/{n}] {freqs[index]} kHz')
-        self.root.update_idletasks()
 
+    @tracing.traced('app.on_wait')
     def on_wait(self, elapsed_time, max_time):
         """
         Callback function for when the controller is waiting
@@ -579,8 +798,8 @@ class App(tk.Frame):
         tmaxstr = config_time(max_time)
         self.tbar_label_var.set(f'{tstr} / {tmaxstr}')
         self.tbar['value'] = 100 * min(1, elapsed_time / max_time)
-        self.root.update_idletasks()
 
+    @tracing.traced('app.on_end')
     def on_end(self, message='Treatment Complete'):
         """
         Callback function for when a treatment is finished
@@ -588,10 +807,12 @@ class App(tk.Frame):
         :param message: message to display. Default is 'Treatment Complete'
         """
         logger.info(f'[on_end] {message}')
+        # A start refused by the safety envelope has not delivered any dose
+        if message != 'Safety Limit Exceeded':
+            self.save_dose()
         self.is_running = False
         self.is_started = False
         self.abort_button.configure(state=tk.DISABLED)
-        self.root.update_idletasks()
         if self.controller.simulate:
             self.startpause_button.configure(text='Start Simulation')
         else:
@@ -603,6 +824,42 @@ class App(tk.Frame):
         self.set_controls_enabled(True)
         self.check_ready()
 
+    def sample_chart(self):
+        """
+        Sample the controller state for the treatment chart. When attached to a server, the local
+        controller mirrors the output state of the server's controller.
+
+        :return: dict of time (s), commanded voltage (mV), output state, frequency (kHz) and
+                 cumulative energy density (J/cm2)
+        """
+        c = self.controller
+        t = c.clock.time()
+        return {'t': t,
+                'voltage': float(c.voltage) * 1e3 if c.frequency is not None else None,
+                'output': int(c.treat_on),
+                'frequency': c.frequency,
+                'dose': self.control_queue.get_dose_totals(t)['energy_j_cm2']}
+
+    def save_dose(self):
+        """
+        Save the dose delivered in the current treatment alongside the session logs. When attached
+        to a server, the local controller does not treat: the server records the dose in its history.
+        """
+        if self.attached:
+            logger.info('[save_dose] Dose recorded in the history of the controller server')
+            return
+        t = self.controller.clock.time()
+        session = self.controller.dose.get_session_totals(t)
+        for key, val in session.items():
+            logger.info(f'[save_dose] {key} = {val:0.4g} {dose.DOSE_UNITS[key]}')
+        try:
+            os.makedirs(config.LOG_PATH, exist_ok=True)
+            timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+            self.controller.dose.save(os.path.join(config.LOG_PATH, f'{timestamp}_dose.json'), t)
+        except OSError as e:
+            logger.error(f'[save_dose] Could not save dose: {e}')
+
+    @tracing.traced('app.on_error')
     def on_error(self, err):
         """
         Callback function for when an error occurs
@@ -610,7 +867,7 @@ class App(tk.Frame):
         :param err: error message
         """
         logger.critical(f"[controller.on_error] Unexpected {err=}, {type(err)=}")
-        logger.critical(f"[controller.on_error] {traceback.format_exc()}")
+        logger.critical(f"[controller.on_error] {''.join(traceback.format_exception(type(err), err, err.__traceback__))}")
         messagebox.showerror(title='ERROR!', message=str(err))
         self.barstyle.configure("my.Horizontal.TProgressbar", foreground='red', background='red')
         self.pbar_label_var.set('Error. Restart required.')
@@ -645,6 +902,7 @@ class App(tk.Frame):
             self.set_controls_enabled(False)
             logger.info(f'[start_treatment] Starting Treatment')
             self.is_started = True
+            self.controller.run_notes = self.notes_var.get().strip()
             self.control_queue.start()
         else:
             logger.info(f'[start_treatment] Resuming Treatment')
@@ -669,10 +927,36 @@ class App(tk.Frame):
         Abort the treatment
         """
         logger.info(f'[pause_treatment] Abort')
+        self.abort_button.configure(state=tk.DISABLED)
+        # The control loop calls on_end once the treatment has stopped
         self.control_queue.stop()
         self.control_queue.reset()
         self.barstyle.configure("my.Horizontal.TProgressbar", foreground='red', background='red')
-        self.on_end(message='Treatment Aborted')
+
+    def toggle_tracing(self, event=None):
+        """
+        Switch span tracing on or off (Ctrl+Shift+T). When it is switched off, the trace is saved
+        alongside the session logs.
+
+        :param event: key event
+        """
+        if tracing.TRACER.enabled:
+            tracing.disable()
+            self.save_trace()
+        else:
+            tracing.enable()
+
+    def save_trace(self):
+        """
+        Save the recorded spans as a Chrome trace alongside the session logs, and discard them
+        """
+        try:
+            os.makedirs(config.LOG_PATH, exist_ok=True)
+            timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+            tracing.export(os.path.join(config.LOG_PATH, f'{timestamp}_trace.json'))
+            tracing.TRACER.clear()
+        except OSError as e:
+            logger.error(f'[save_trace] Could not save trace: {e}')
 
     def quit_app(self):
         """
@@ -681,30 +965,46 @@ class App(tk.Frame):
         try:
             if self.controller.is_connected:
                 self.control_queue.kill()
+            if self.history is not None:
+                self.history.close()
+            if tracing.TRACER.events:
+                self.save_trace()
         finally:
             logger.info('[quit_app] Exiting...')
             self.root.destroy()
-            if not config.REBOOT:
-                raise SystemExit
+            raise SystemExit
 
 
-def runapp(simulate=False, config_ids=config.CONFIG_IDS):
+def runapp(simulate=False, config_ids=config.CONFIG_IDS, server_address=None, trace=False, start_time=None):
     """
     Launch GUI
 
     :param simulate: If True, the application will run in simulation mode, which will not communicate with the hardware
     :param config_ids: A list of configuration IDs
+    :param server_address: (host, port) of a controller server to attach to, or None to control the hardware directly
+    :param trace: If True, span tracing is on from the start (it can be toggled with Ctrl+Shift+T)
+    :param start_time: `time.perf_counter()` at launch, to log the startup time
     :return: None
     """
+    if start_time is not None:
+        logger.info('[runapp] Modules imported after %.0f ms', (time.perf_counter() - start_time) * 1e3)
+    if trace:
+        tracing.enable()
     root = tk.Tk()
     root.iconbitmap(os.path.join(HERE, 'app.ico'))
-    root.geometry("720x650+0+0")
-    myapp = App(root, simulate=simulate, config_ids=config_ids)
+    root.geometry("720x860+0+0")
+    myapp = App(root, simulate=simulate, config_ids=config_ids, server_address=server_address)
+    if config.constants is not constants:
+        # The configuration was switched after this module was imported
+        myapp.controller.set_constants(config.constants)
+        myapp.reload_config(config.constants)
 
     def on_closing():
         myapp.quit_app()
 
     root.protocol("WM_DELETE_WINDOW", on_closing)
+    if start_time is not None:
+        logger.info('[runapp] Ready after %.0f ms', (time.perf_counter() - start_time) * 1e3)
     myapp.mainloop()
 
 
@@ -713,6 +1013,7 @@ class Hovertip_CustomFont(tooltip.Hovertip):
     """Create a text tooltip with a mouse hover delay.
 
     anchor_widget: the widget next to which the tooltip will be shown
+    text: the text, or a function returning it, called each time the tooltip is shown
     hover_delay: time to delay before showing the tooltip, in milliseconds
 
     Note that a widget will only be shown when showtip() is called,
@@ -725,6 +1026,7 @@ class Hovertip_CustomFont(tooltip.Hovertip):
         self.font = custom_font
 
     def showcontents(self):
-        label = tk.Label(self.tipwindow, text=self.text, justify=tk.LEFT,
+        text = self.text() if callable(self.text) else self.text
+        label = tk.Label(self.tipwindow, text=text, justify=tk.LEFT,
                       background="#ffffe0", relief=tk.SOLID, borderwidth=1, font=self.font)
         label.pack()
\ No newline at end of file
@@ -0,0 +1,543 @@
+"""
+Benchmark Module
+================
+
+This module benchmarks the hot paths of the controller and the instrument drivers against the
+simulated instruments of `simulator`, so that the cost of the software itself can be measured
+and tracked without hardware. Each command of the simulated instruments can be given a latency,
+to model the USB round trips.
+
+The suite times:
+
+* ``controller.open``: `Controller.open` (connection and reconciliation)
+* ``set_frequency/<CONFIG_ID>``: a frequency transition, cycling through each configuration's
+  frequency list
+* ``control_loop``: a full treatment sequence through `control_loop` (on a virtual clock, so the
+  treatment time itself is skipped)
+* ``channel.round_trip``: `Channel` voltage and burst writes with their readback
+* ``rf_switch.set_position``: `RFSwitch.set_position` (with the settle time set by ``-settle``)
+* ``app.refresh_pressure_strings``: the GUI pressure and dose readout (skipped without a display)
+* ``import/<module>``: a cold import of the package and of the GUI module, in a new interpreter
+* ``logging/<mode>``: a frequency transition with logging off, synchronous and queued
+* ``dryrun.estimate``: `dryrun.ProtocolEstimator.estimate` on a batch of random protocols (reported
+  per batch of ``DRYRUN_BATCH``), checked against `controller.run_protocol` on a sample of them
+* ``transport/<fault>``: a read that stalls once (retried after the I/O timeout, ``IO_TIMEOUT``),
+  a switch read that stalls once, and `Controller.recover` after the session is lost
+
+For each, it reports the wall time per operation (median, 90th percentile and maximum), the number
+of instrument commands per operation, and the memory allocated (peak and retained, measured on a
+separate run with `tracemalloc`). The results can be saved as JSON, and two result files compared
+to flag regressions::
+
+    python -m oncolysis_ctrl.benchmark [-n 20] [-latency S] [-switch-latency S] [-settle S] [-only NAME[,NAME...]] [-o results.json]
+    python -m oncolysis_ctrl.benchmark -compare base.json new.json [-threshold 0.1]
+"""
+import contextlib
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import queue
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from oncolysis_ctrl import config, controller, clock, dryrun, function_generator, logs, rf_switch, simulator, \
+    transport
+
+N_REPEAT = 20
+THRESHOLD = 0.1
+# Differences below these are not flagged, whatever the ratio
+MIN_TIME_MS = 0.005
+MIN_ALLOC_KB = 1.0
+# Pause between transitions in the logging benchmark. In a protocol, transitions are seconds apart,
+# which leaves time for the log listener to catch up.
+TRANSITION_INTERVAL = 0.001
+# Protocols per batch in the dry-run benchmark, and protocols run to check the estimate
+DRYRUN_BATCH = 100000
+DRYRUN_VALIDATE = 50
+# I/O timeout and stall times in the transport benchmark (s). The switch fails until a stalled call
+# returns, so its stall must end within the retries of the read.
+IO_TIMEOUT = 0.02
+STALL_TIME = 1.0
+SWITCH_STALL_TIME = 0.05
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_controller(constants=None, latency=0.0, switch_latency=0.0, settle_time=0.0, connect=True):
+    """
+    Create a controller on simulated instruments
+
+    :param constants: configuration constants (default: the current configuration)
+    :param latency: time taken by each function generator command (s)
+    :param switch_latency: time taken by each RF switch command (s)
+    :param settle_time: time the RF switches wait after moving (s)
+    :param connect: open the controller
+    :return: `controller.Controller`
+    """
+    c = controller.Controller(frequencies=[], simulate=False, ask_simulate=None)
+    if constants is not None and constants is not config.constants:
+        c.set_constants(constants)
+    constants = constants or config.constants
+    c.set_frequencies(list(constants.FREQUENCIES_KHZ))
+    # Stay within the safety envelope, so that treatments can start
+    max_value, _, _ = c.envelope.get_max_value(c.frequencies, c.power_mode, c.burst_length, c.burst_duty_cycle)
+    c.power_value = min(c.power_value, max_value)
+    simulator.attach(c, latency=latency, switch_latency=switch_latency, settle_time=settle_time)
+    if connect:
+        c.open()
+    return c
+
+
+def summarize(times):
+    """
+    :param times: array of times (s)
+    :return: dict of n, median, p90, max and mean (ms)
+    """
+    times = np.asarray(times)
+    return {'n': len(times),
+            'median_ms': float(np.median(times) * 1e3),
+            'p90_ms': float(np.percentile(times, 90) * 1e3),
+            'max_ms': float(np.max(times) * 1e3),
+            'mean_ms': float(np.mean(times) * 1e3)}
+
+
+def measure(func, n, count=None, setup=None, pause=0.0):
+    """
+    Time repeated calls of a function, and measure the memory it allocates
+
+    :param func: operation to time (no arguments)
+    :param n: number of calls
+    :param count: function returning the total number of instrument commands so far (None to skip)
+    :param setup: function called before each call, outside the timing (None to skip)
+    :param pause: time to wait after each call, outside the timing (s)
+    :return: dict of results, as `summarize`, with 'commands', 'alloc_peak_kb' and 'alloc_net_kb'
+    """
+    times = np.zeros(n)
+    commands = np.zeros(n)
+    for i in range(n):
+        if setup is not None:
+            setup()
+        c0 = count() if count is not None else 0
+        t0 = time.perf_counter()
+        func()
+        times[i] = time.perf_counter() - t0
+        if count is not None:
+            commands[i] = count() - c0
+        if pause:
+            time.sleep(pause)
+    result = summarize(times)
+    result['commands'] = float(np.median(commands)) if count is not None else None
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result['alloc_peak_kb'] = (peak - base) / 1024
+    result['alloc_net_kb'] = (current - base) / 1024
+    return result
+
+
+def bench_open(n, latency=0.0, switch_latency=0.0, settle_time=0.0):
+    c = make_controller(latency=latency, switch_latency=switch_latency, settle_time=settle_time, connect=False)
+
+    def setup():
+        if c.is_connected:
+            c.close()
+    result = measure(c.open, n, count=lambda: simulator.count_commands(c), setup=setup)
+    c.close()
+    return {'controller.open': result}
+
+
+def bench_set_frequency(n, latency=0.0, switch_latency=0.0, settle_time=0.0):
+    results = {}
+    for config_id in config.CONFIG_IDS:
+        constants = config.get_constants(config_id)
+        c = make_controller(constants, latency=latency, switch_latency=switch_latency, settle_time=settle_time)
+        frequencies = itertools.cycle(c.frequencies)
+        results[f'set_frequency/{config_id}'] = measure(lambda: c.set_frequency(next(frequencies)),
+                                                        n * len(c.frequencies),
+                                                        count=lambda: simulator.count_commands(c))
+        c.close()
+    return results
+
+
+def bench_control_loop(n, latency=0.0, switch_latency=0.0, settle_time=0.0):
+    c = make_controller(latency=latency, switch_latency=switch_latency, settle_time=settle_time, connect=False)
+    messages = []
+
+    def setup():
+        # The virtual clock skips the treatment time. It can only be set once the (simulated)
+        # hardware is open.
+        c.clock = clock.REAL_CLOCK
+        c.open()
+        c.clock = clock.VirtualClock()
+
+    def run():
+        commands = queue.Queue()
+        commands.put('START')
+
+        def on_end(message='Treatment Complete'):
+            messages.append(message)
+            commands.put('KILL')
+        controller.control_loop(c, commands, on_end=on_end)
+
+    result = measure(run, n, count=lambda: simulator.count_commands(c), setup=setup)
+    c.clock = clock.REAL_CLOCK
+    if any(message != 'Treatment Complete' for message in messages):
+        result['error'] = ', '.join(sorted(set(messages)))
+    return {'control_loop': result}
+
+
+def bench_channel(n, latency=0.0, **kwargs):
+    instrument = simulator.SimulatedInstrument(latency=latency)
+    channel = function_generator.Channel(1, instrument, max_voltage=1.0)
+
+    def round_trip():
+        channel.set_voltage(voltage=0.1)
+        channel.get_voltage()
+        channel.set_burst(cycles=100, period=0.01)
+        channel.get_burst()
+        channel.get_settings()
+    return {'channel.round_trip': measure(round_trip, n, count=lambda: instrument.n_commands)}
+
+
+def bench_rf_switch(n, switch_latency=0.0, settle_time=0.0, **kwargs):
+    switch = rf_switch.RFSwitch(comport='SIM1', settle_time=settle_time)
+    switch.interface = simulator.SimulatedSwitchInterface(latency=switch_latency)
+    positions = itertools.cycle(range(1, 7))
+    return {'rf_switch.set_position': measure(lambda: switch.set_position(next(positions)), n,
+                                              count=lambda: switch.interface.n_commands)}
+
+
+def bench_app(n, **kwargs):
+    import tkinter as tk
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        return {'app.refresh_pressure_strings': {'skipped': f'no display ({e})'}}
+    from oncolysis_ctrl import app
+    try:
+        myapp = app.App(root, simulate=True)
+        result = measure(myapp.refresh_pressure_strings, n)
+    finally:
+        root.destroy()
+    return {'app.refresh_pressure_strings': result}
+
+
+def bench_import(n, **kwargs):
+    """
+    Time the import of the package and of the GUI module in a new interpreter, which bounds the
+    time before the window is shown
+    """
+    results = {}
+    for module in ('oncolysis_ctrl', 'oncolysis_ctrl.app'):
+        command = [sys.executable, '-c', f'import {module}']
+        results[f'import/{module}'] = measure(lambda: subprocess.run(command, cwd=os.path.dirname(HERE), check=True), n)
+    return results
+
+
+def bench_logging(n, latency=0.0, switch_latency=0.0, settle_time=0.0):
+    """
+    Compare the transition latency with logging disabled, with the console and file handlers
+    called synchronously, and queued (`logs.setup_logging`)
+    """
+    root = logging.getLogger()
+    saved_handlers, saved_level = list(root.handlers), root.level
+    c = make_controller(latency=latency, switch_latency=switch_latency, settle_time=settle_time)
+    frequencies = itertools.cycle(c.frequencies)
+    n = n * len(c.frequencies)
+
+    def transition():
+        c.set_frequency(next(frequencies))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        console = open(os.path.join(tmp, 'console.log'), 'w')
+        logfile = os.path.join(tmp, f'benchmark{logs.LOG_EXTENSION}')
+        try:
+            logs.stop_logging()
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            root.setLevel(logging.WARNING)
+            results['logging/off'] = measure(transition, n, pause=TRANSITION_INTERVAL)
+
+            root.setLevel(logging.INFO)
+            console_handler = logging.StreamHandler(console)
+            console_handler.setFormatter(logging.Formatter(logs.LOG_FORMAT))
+            file_handler = logs.make_file_handler(logfile)
+            root.addHandler(console_handler)
+            root.addHandler(file_handler)
+            results['logging/sync'] = measure(transition, n, pause=TRANSITION_INTERVAL)
+            root.removeHandler(console_handler)
+            root.removeHandler(file_handler)
+            file_handler.close()
+
+            logs.setup_logging(logfile, stream=console)
+            results['logging/queued'] = measure(transition, n, pause=TRANSITION_INTERVAL)
+            logs.stop_logging()
+        finally:
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            for handler in saved_handlers:
+                root.addHandler(handler)
+            root.setLevel(saved_level)
+            console.close()
+            c.close()
+    return results
+
+
+def random_protocols(c, n, seed=0):
+    """
+    Draw random protocols from a controller's configuration options
+
+    :param c: `controller.Controller`
+    :param n: number of protocols
+    :param seed: random seed
+    :return: list of protocol dicts
+    """
+    rng = np.random.default_rng(seed)
+    constants = config.constants
+    frequencies = np.array(c.frequencies, dtype=float)
+    modes = list(c.power_settings)
+    protocols = []
+    for _ in range(n):
+        mode = modes[rng.integers(len(modes))]
+        low, high = c.power_settings[mode]['minmax']
+        protocols.append({'frequencies': list(rng.choice(frequencies, rng.integers(1, len(frequencies) + 1),
+                                                         replace=False)),
+                          'power_mode': mode,
+                          'power_value': float(rng.uniform(low, high) * rng.choice([0.1, 0.5, 1.0])),
+                          'duration': float(rng.choice(constants.DURATIONS_S)),
+                          'burst_length': float(rng.choice(constants.BURST_LENGTHS)),
+                          'duty_cycle': float(rng.choice(constants.BURST_DUTY_CYCLES))})
+    return protocols
+
+
+def bench_dryrun(n, **kwargs):
+    def make():
+        return controller.Controller(frequencies=list(config.constants.FREQUENCIES_KHZ), simulate=True,
+                                     ask_simulate=None)
+    estimator = dryrun.ProtocolEstimator(make())
+    batch = estimator.pack(random_protocols(estimator.controller, DRYRUN_BATCH))
+    result = measure(lambda: estimator.estimate(**batch), n)
+    mismatches = dryrun.validate(make, random_protocols(estimator.controller, DRYRUN_VALIDATE, seed=1))
+    if mismatches:
+        result['error'] = f'{len(mismatches)} mismatches with run_protocol, e.g. {mismatches[0]}'
+    return {'dryrun.estimate': result}
+
+
+def bench_transport(n, latency=0.0, switch_latency=0.0, settle_time=0.0):
+    c = make_controller(latency=latency, switch_latency=switch_latency, settle_time=settle_time, connect=False)
+    c.io_policy.timeout = IO_TIMEOUT
+    c.open()
+    instrument = c.fgen.resource_manager.instrument
+    switch = c.switches[0]
+    count = lambda: simulator.count_commands(c)
+    results = {'transport/stalled_read': measure(c.xmit.get_settings, n, count=count,
+                                                 setup=lambda: instrument.faults.stall(1, STALL_TIME)),
+               'transport/stalled_switch': measure(switch.get_position, n, count=count,
+                                                   setup=lambda: switch.interface.faults.stall(1, SWITCH_STALL_TIME)),
+               'transport/recover': measure(lambda: c.recover(transport.TransportError('session lost')), n,
+                                            count=count, setup=instrument.faults.disconnect)}
+    report = c.io_policy.report()
+    if report['failures'] or report['recovery_failures']:
+        results['transport/recover']['error'] = f'{report["failures"]} failed reads, ' \
+                                                f'{report["recovery_failures"]} failed recoveries'
+    c.close()
+    return results
+
+
+BENCHMARKS = {'controller.open': bench_open,
+              'set_frequency': bench_set_frequency,
+              'control_loop': bench_control_loop,
+              'channel': bench_channel,
+              'rf_switch': bench_rf_switch,
+              'app': bench_app,
+              'import': bench_import,
+              'logging': bench_logging,
+              'dryrun': bench_dryrun,
+              'transport': bench_transport}
+
+
+@contextlib.contextmanager
+def quiet_logging(level=logging.INFO):
+    """
+    Send the logs to a temporary file while benchmarking, at the level used by the application
+
+    :param level: log level
+    """
+    root = logging.getLogger()
+    saved_handlers, saved_level = list(root.handlers), root.level
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'console.log'), 'w') as console:
+            for handler in saved_handlers:
+                root.removeHandler(handler)
+            logs.setup_logging(os.path.join(tmp, f'benchmark{logs.LOG_EXTENSION}'), level=level, stream=console)
+            try:
+                yield
+            finally:
+                logs.stop_logging()
+                for handler in list(root.handlers):
+                    root.removeHandler(handler)
+                for handler in saved_handlers:
+                    root.addHandler(handler)
+                root.setLevel(saved_level)
+
+
+def get_commit():
+    """
+    :return: current git commit of the repository, or None
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_suite(n=N_REPEAT, latency=0.0, switch_latency=0.0, settle_time=0.0, only=None):
+    """
+    Run the benchmark suite
+
+    :param n: number of repetitions of each operation
+    :param latency: time taken by each function generator command (s)
+    :param switch_latency: time taken by each RF switch command (s)
+    :param settle_time: time the RF switches wait after moving (s)
+    :param only: list of benchmark names (keys of `BENCHMARKS`) to run (None for all)
+    :return: dict with 'meta' (commit, platform and settings) and 'results' (keyed by benchmark)
+    """
+    results = {}
+    with quiet_logging():
+        for name, bench in BENCHMARKS.items():
+            if only is None or name in only:
+                t0 = time.perf_counter()
+                results.update(bench(n, latency=latency, switch_latency=switch_latency, settle_time=settle_time))
+                print(f'{name}: {time.perf_counter() - t0:0.1f} s', file=sys.stderr)
+    meta = {'commit': get_commit(),
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'n': n,
+            'latency': latency,
+            'switch_latency': switch_latency,
+            'settle_time': settle_time}
+    return {'meta': meta, 'results': results}
+
+
+def compare(base, new, threshold=THRESHOLD):
+    """
+    Compare two sets of results
+
+    :param base: results of the reference run (as returned by `run_suite`)
+    :param new: results of the run to check
+    :param threshold: relative increase of the median time or peak allocation flagged as a regression
+    :return: list of (benchmark, metric, base value, new value, 'regression' or 'improvement').
+             Any increase in the number of instrument commands is a regression.
+    """
+    changes = []
+    for name, result in new['results'].items():
+        reference = base['results'].get(name)
+        if reference is None or 'skipped' in reference or 'skipped' in result:
+            continue
+        for metric, minimum in (('median_ms', MIN_TIME_MS), ('alloc_peak_kb', MIN_ALLOC_KB), ('commands', 0)):
+            old, value = reference.get(metric), result.get(metric)
+            if old is None or value is None:
+                continue
+            tolerance = 0 if metric == 'commands' else threshold * abs(old)
+            if value - old > max(tolerance, minimum):
+                changes.append((name, metric, old, value, 'regression'))
+            elif old - value > max(tolerance, minimum):
+                changes.append((name, metric, old, value, 'improvement'))
+    return changes
+
+
+def print_results(results):
+    """
+    :param results: results, as returned by `run_suite`
+    """
+    meta = results['meta']
+    print(f'commit {meta["commit"]}, latency {meta["latency"]:g} s, switch latency {meta["switch_latency"]:g} s, '
+          f'settle {meta["settle_time"]:g} s')
+    print(f'{"benchmark":<36}{"n":>6}{"median ms":>12}{"p90 ms":>10}{"max ms":>10}{"commands":>10}'
+          f'{"alloc kB":>10}')
+    for name, result in results['results'].items():
+        if 'skipped' in result:
+            print(f'{name:<36}  skipped: {result["skipped"]}')
+            continue
+        commands = '' if result['commands'] is None else f'{result["commands"]:g}'
+        print(f'{name:<36}{result["n"]:>6}{result["median_ms"]:>12.3f}{result["p90_ms"]:>10.3f}'
+              f'{result["max_ms"]:>10.3f}{commands:>10}{result["alloc_peak_kb"]:>10.1f}'
+              + (f'  ERROR: {result["error"]}' if 'error' in result else ''))
+
+
+def main(args):
+    """
+    Run or compare benchmarks from the command line
+
+    :param args: command line arguments
+    :return: exit code (1 if a comparison found regressions)
+    """
+    options = {'n': N_REPEAT, 'latency': 0.0, 'switch_latency': 0.0, 'settle_time': 0.0, 'only': None}
+    output = None
+    threshold = THRESHOLD
+    compare_files = None
+    i = 0
+    while i < len(args):
+        if args[i] == '-compare':
+            compare_files = args[i + 1:i + 3]
+            i += 3
+            continue
+        if i + 1 >= len(args):
+            print(__doc__)
+            return 1
+        if args[i] == '-n':
+            options['n'] = int(args[i + 1])
+        elif args[i] == '-latency':
+            options['latency'] = float(args[i + 1])
+        elif args[i] == '-switch-latency':
+            options['switch_latency'] = float(args[i + 1])
+        elif args[i] == '-settle':
+            options['settle_time'] = float(args[i + 1])
+        elif args[i] == '-only':
+            options['only'] = args[i + 1].split(',')
+        elif args[i] == '-o':
+            output = args[i + 1]
+        elif args[i] == '-threshold':
+            threshold = float(args[i + 1])
+        else:
+            print(__doc__)
+            return 1
+        i += 2
+    if compare_files is not None:
+        with open(compare_files[0]) as f:
+            base = json.load(f)
+        with open(compare_files[1]) as f:
+            new = json.load(f)
+        changes = compare(base, new, threshold)
+        print(f'{base["meta"]["commit"]} -> {new["meta"]["commit"]} (threshold {threshold:g})')
+        for key in ('latency', 'switch_latency', 'settle_time', 'platform'):
+            if base['meta'].get(key) != new['meta'].get(key):
+                print(f'  WARNING: {key} differs ({base["meta"].get(key)} -> {new["meta"].get(key)})')
+        for name, metric, old, value, kind in changes:
+            print(f'  {kind.upper():<12}{name:<36}{metric:<14}{old:>10.3f} -> {value:<10.3f}')
+        regressions = [change for change in changes if change[-1] == 'regression']
+        print(f'{len(regressions)} regressions')
+        return 1 if regressions else 0
+    results = run_suite(**options)
+    print_results(results)
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
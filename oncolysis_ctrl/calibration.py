@@ -0,0 +1,257 @@
+"""
+Calibration Module
+==================
+
+This module contains the `Calibration` class, which evaluates the voltage calibration of a
+configuration (`CALIB`: ``p_ref``, ``coeff_a`` and ``coeff_b`` at a set of frequencies) at any
+frequency between the lowest and highest calibrated frequency.
+
+Each coefficient is interpolated with a monotone piecewise cubic (PCHIP) in log-frequency, which
+is smooth, reproduces the calibrated values exactly, and does not overshoot between points. The
+interpolants are evaluated once, when the calibration is created, into dense tables with a fixed
+frequency step, so that evaluating the calibration at a frequency is a table lookup.
+
+The interpolation uncertainty is estimated by leaving each calibration point out in turn and
+comparing the interpolant of the remaining points with the left-out value. The estimate is zero at
+calibrated frequencies and largest midway between them. Frequencies outside the calibrated range
+are refused with a `CalibrationError`.
+"""
+import logging
+import numpy as np
+logger = logging.getLogger("oc.calibration")
+
+CALIB_FIELDS = ('p_ref', 'coeff_a', 'coeff_b')
+TABLE_STEP_KHZ = 0.1
+
+
+class CalibrationError(ValueError):
+    """
+    Raised when the calibration is evaluated outside the calibrated range
+    """
+
+
+def solve_voltage(p, a, b):
+    """
+    Solve p = aV^2 + bV for the (amplified) voltage
+
+    :param p: pressure (kPa)
+    :param a: coeff_a (kPa/V^2)
+    :param b: coeff_b (kPa/V)
+    :return: voltage (V)
+    """
+    # Equivalent to (-b + sqrt(b^2 + 4ap)) / 2a, without cancellation for small a
+    return 2 * p / (b + np.sqrt(b ** 2 + 4 * a * p))
+
+
+def pchip_slopes(x, y):
+    """
+    Slopes of the monotone piecewise cubic Hermite interpolant (Fritsch-Carlson)
+
+    :param x: knot positions (increasing)
+    :param y: knot values
+    :return: slope at each knot
+    """
+    h = np.diff(x)
+    delta = np.diff(y) / h
+    slopes = np.zeros_like(y)
+    if len(x) == 2:
+        slopes[:] = delta[0]
+        return slopes
+    w1 = 2 * h[1:] + h[:-1]
+    w2 = h[1:] + 2 * h[:-1]
+    same_sign = delta[:-1] * delta[1:] > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        harmonic = (w1 + w2) / (w1 / delta[:-1] + w2 / delta[1:])
+    slopes[1:-1] = np.where(same_sign, harmonic, 0.0)
+    for end, (d0, d1, h0, h1) in ((0, (delta[0], delta[1], h[0], h[1])),
+                                  (-1, (delta[-1], delta[-2], h[-1], h[-2]))):
+        slope = ((2 * h0 + h1) * d0 - h0 * d1) / (h0 + h1)
+        if np.sign(slope) != np.sign(d0):
+            slope = 0.0
+        elif np.sign(d0) != np.sign(d1) and abs(slope) > abs(3 * d0):
+            slope = 3 * d0
+        slopes[end] = slope
+    return slopes
+
+
+def pchip(x, y, xi):
+    """
+    Evaluate the monotone piecewise cubic Hermite interpolant
+
+    :param x: knot positions (increasing)
+    :param y: knot values
+    :param xi: positions to evaluate, within [x[0], x[-1]]
+    :return: interpolated values
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    xi = np.asarray(xi, dtype=float)
+    if len(x) == 1:
+        return np.full_like(xi, y[0])
+    slopes = pchip_slopes(x, y)
+    i = np.clip(np.searchsorted(x, xi, side='right') - 1, 0, len(x) - 2)
+    h = x[i + 1] - x[i]
+    t = (xi - x[i]) / h
+    h00 = (1 + 2 * t) * (1 - t) ** 2
+    h10 = t * (1 - t) ** 2
+    h01 = t ** 2 * (3 - 2 * t)
+    h11 = t ** 2 * (t - 1)
+    return h00 * y[i] + h10 * h * slopes[i] + h01 * y[i + 1] + h11 * h * slopes[i + 1]
+
+
+class Calibration:
+    """
+    Calibration
+    ===========
+
+    Continuous-frequency voltage calibration, precomputed into lookup tables.
+    """
+    def __init__(self, calib, step=TABLE_STEP_KHZ):
+        """
+        Calibration constructor. Builds the lookup tables.
+
+        :param calib: calibration table, as `CALIB` in the configurations: {frequency (kHz): {'p_ref': kPa,
+                      'coeff_a': kPa/V^2, 'coeff_b': kPa/V}}
+        :param step: frequency step of the lookup tables (kHz)
+        """
+        self.points = {f: dict(calib[f]) for f in sorted(calib)}
+        self.frequencies = np.array(list(self.points), dtype=float)
+        self.f_min = float(self.frequencies[0])
+        self.f_max = float(self.frequencies[-1])
+        self.step = step
+        knots = np.log(self.frequencies)
+        self.values = {field: np.array([self.points[f][field] for f in self.points], dtype=float)
+                       for field in CALIB_FIELDS}
+        values = self.values
+        self.n = max(int(np.ceil((self.f_max - self.f_min) / step)), 0) + 1
+        self.grid = self.f_min + step * np.arange(self.n)
+        self.grid[-1] = self.f_max
+        log_grid = np.log(self.grid)
+        self.tables = {field: pchip(knots, values[field], log_grid) for field in CALIB_FIELDS}
+        self.knot_errors = self.leave_one_out(knots, values)
+        # Uncertainty grows from zero at the calibration points to its largest value midway between them
+        i = np.clip(np.searchsorted(self.frequencies, self.grid, side='right') - 1, 0, max(len(knots) - 2, 0))
+        if len(knots) > 1:
+            t = (log_grid - knots[i]) / (knots[i + 1] - knots[i])
+            shape = 4 * t * (1 - t)
+            self.uncertainty_tables = {field: shape * np.maximum(errors[i], errors[i + 1])
+                                       for field, errors in self.knot_errors.items()}
+        else:
+            self.uncertainty_tables = {field: np.zeros(self.n) for field in self.knot_errors}
+        logger.info(f'[init] Calibration tables for {self.f_min:g}-{self.f_max:g} kHz '
+                    f'({len(self.points)} points, {self.n} steps of {step:g} kHz)')
+
+    @staticmethod
+    def leave_one_out(knots, values):
+        """
+        Estimate the interpolation error at each calibration point by leaving it out
+
+        Besides the error of each coefficient, the relative error of the voltage needed to reach
+        p_ref is estimated. It accounts for coeff_a and coeff_b being fitted together, so it is a
+        better measure of the error in the delivered pressure than the coefficient errors.
+        :param knots: log-frequencies of the calibration points
+        :param values: dict of calibrated values of each field
+        :return: dict of absolute error at each point for each field, and relative error for
+                 'voltage' (end points take the error of their neighbour)
+        """
+        n = len(knots)
+        errors = {field: np.zeros(n) for field in CALIB_FIELDS + ('voltage',)}
+        if n < 3:
+            return errors
+        for k in range(1, n - 1):
+            keep = np.arange(n) != k
+            estimate = {field: pchip(knots[keep], values[field][keep], knots[k]) for field in CALIB_FIELDS}
+            for field in CALIB_FIELDS:
+                errors[field][k] = abs(estimate[field] - values[field][k])
+            voltage = solve_voltage(values['p_ref'][k], values['coeff_a'][k], values['coeff_b'][k])
+            voltage_estimate = solve_voltage(values['p_ref'][k], estimate['coeff_a'], estimate['coeff_b'])
+            errors['voltage'][k] = abs(voltage_estimate / voltage - 1)
+        for field_errors in errors.values():
+            field_errors[0] = field_errors[1]
+            field_errors[-1] = field_errors[-2]
+        return errors
+
+    def covers(self, frequency):
+        """
+        Check whether a frequency is within the calibrated range
+
+        :param frequency: frequency (kHz)
+        :return: True if the calibration can be evaluated at the frequency
+        """
+        return frequency in self.points or self.f_min <= frequency <= self.f_max
+
+    def check(self, frequency):
+        """
+        Refuse frequencies outside the calibrated range
+
+        :param frequency: frequency (kHz)
+        :raises CalibrationError: if the frequency is not covered
+        """
+        if not self.covers(frequency):
+            raise CalibrationError(f'{frequency} kHz is outside the calibrated range '
+                                   f'({self.f_min:g}-{self.f_max:g} kHz)')
+
+    def lookup(self, tables, frequency):
+        """
+        Interpolate linearly between the two nearest table entries
+
+        :param tables: dict of tables to read
+        :param frequency: frequency (kHz)
+        :return: dict of values
+        """
+        self.check(frequency)
+        x = (frequency - self.f_min) / self.step
+        i = min(int(x), self.n - 2) if self.n > 1 else 0
+        # The last step is shorter when the range is not a whole number of steps
+        t = (frequency - self.grid[i]) / (self.grid[i + 1] - self.grid[i]) if self.n > 1 else 0.0
+        return {field: float(table[i] + t * (table[i + 1] - table[i])) if t else float(table[i])
+                for field, table in tables.items()}
+
+    def get(self, frequency):
+        """
+        Evaluate the calibration at a frequency
+
+        :param frequency: frequency (kHz)
+        :return: dict of p_ref, coeff_a and coeff_b (exactly the calibrated values at calibration points)
+        :raises CalibrationError: if the frequency is outside the calibrated range
+        """
+        point = self.points.get(frequency)
+        if point is not None:
+            return point
+        return self.lookup(self.tables, frequency)
+
+    def get_uncertainty(self, frequency):
+        """
+        Estimate the interpolation uncertainty at a frequency
+
+        :param frequency: frequency (kHz)
+        :return: dict of absolute uncertainty of p_ref, coeff_a and coeff_b, and relative uncertainty
+                 of the voltage for a given pressure ('voltage'). All are zero at calibration points.
+        :raises CalibrationError: if the frequency is outside the calibrated range
+        """
+        if frequency in self.points:
+            return {field: 0.0 for field in self.uncertainty_tables}
+        return self.lookup(self.uncertainty_tables, frequency)
+
+    def evaluate(self, frequencies):
+        """
+        Evaluate the calibration at many frequencies at once
+
+        :param frequencies: array of frequencies (kHz)
+        :return: dict of arrays of p_ref, coeff_a and coeff_b
+        :raises CalibrationError: if any frequency is outside the calibrated range
+        """
+        frequencies = np.asarray(frequencies, dtype=float)
+        if np.any((frequencies < self.f_min) | (frequencies > self.f_max)):
+            raise CalibrationError(f'Frequencies outside the calibrated range ({self.f_min:g}-{self.f_max:g} kHz)')
+        x = (frequencies - self.f_min) / self.step
+        i = np.minimum(x.astype(int), max(self.n - 2, 0))
+        j = np.minimum(i + 1, self.n - 1)
+        t = (frequencies - self.grid[i]) / (self.grid[j] - self.grid[i]) if self.n > 1 else np.zeros_like(x)
+        values = {field: table[i] + t * (table[j] - table[i]) for field, table in self.tables.items()}
+        exact = np.isin(frequencies, self.frequencies)
+        if np.any(exact):
+            k = np.searchsorted(self.frequencies, frequencies[exact])
+            for field in CALIB_FIELDS:
+                values[field][exact] = self.values[field][k]
+        return values
@@ -0,0 +1,252 @@
+"""
+Calibration Fitting Module
+==========================
+
+This module fits the voltage calibration (`CALIB` in the configurations) from hydrophone
+measurements. The measurements are CSV files with a header row and one row per measurement,
+with columns ``frequency_khz``, ``voltage`` and ``pressure_kpa`` (other columns, such as a
+repeat number, are ignored). ``voltage`` is the amplified voltage, or the function generator
+voltage if an amplifier gain is given.
+
+At every frequency, the pressure is modelled as ``p = coeff_a * V**2 + coeff_b * V``. The files
+are read in chunks and reduced to the sums needed by the least squares normal equations, so that
+all frequencies are fitted at once and the size of the files is not limited by memory. A second
+pass computes the residual of every measurement, flags the ones more than `outlier_threshold`
+standard deviations from the fit as outliers, and refits without them.
+
+The result can be written as a ``CALIB`` table for a constants module or as JSON for a
+configuration data file::
+
+    python -m oncolysis_ctrl.calibration_fit sweep1.csv sweep2.csv [-gain 562.3] [-json] [-o calib.py]
+"""
+import csv
+import json
+import logging
+import sys
+import numpy as np
+logger = logging.getLogger("oc.calibration_fit")
+
+COLUMNS = ('frequency_khz', 'voltage', 'pressure_kpa')
+MI_REF = 1.9
+CHUNK_SIZE = 100000
+OUTLIER_THRESHOLD = 4.0
+MIN_POINTS = 3
+# Sums accumulated for each frequency
+N, V2, V3, V4, PV, PV2, PP = range(7)
+
+
+def read_chunks(filenames, gain=1.0, chunk_size=CHUNK_SIZE):
+    """
+    Read measurement files in chunks
+
+    :param filenames: list of CSV files
+    :param gain: amplifier gain to apply to the voltage column
+    :param chunk_size: number of rows per chunk
+    :return: generator of (frequency (kHz), amplified voltage (V), pressure (kPa)) arrays
+    """
+    for filename in filenames:
+        with open(filename, 'r', newline='') as f:
+            reader = csv.reader(f)
+            header = [name.strip().lower() for name in next(reader)]
+            missing = [name for name in COLUMNS if name not in header]
+            if missing:
+                raise ValueError(f'{filename} has no column {", ".join(missing)}')
+            index = [header.index(name) for name in COLUMNS]
+            rows = []
+            for row in reader:
+                if row:
+                    rows.append([row[i] for i in index])
+                if len(rows) == chunk_size:
+                    yield to_arrays(rows, gain)
+                    rows = []
+            if rows:
+                yield to_arrays(rows, gain)
+
+
+def to_arrays(rows, gain):
+    data = np.array(rows, dtype=float)
+    return data[:, 0], data[:, 1] * gain, data[:, 2]
+
+
+class SweepFit:
+    """
+    Least squares fit of p = aV^2 + bV at many frequencies, from streamed measurements
+    """
+    def __init__(self):
+        self.frequencies = {}
+        self.sums = np.zeros((0, 7))
+
+    def get_index(self, frequency):
+        """
+        Map frequencies to rows of the sums, adding rows for new frequencies
+
+        :param frequency: array of frequencies (kHz)
+        :return: array of row indices
+        """
+        unique, inverse = np.unique(frequency, return_inverse=True)
+        new = [f for f in unique.tolist() if f not in self.frequencies]
+        if new:
+            for f in new:
+                self.frequencies[f] = len(self.frequencies)
+            self.sums = np.vstack([self.sums, np.zeros((len(new), 7))])
+        return np.array([self.frequencies[f] for f in unique.tolist()], dtype=int)[inverse]
+
+    def add(self, frequency, voltage, pressure):
+        """
+        Accumulate measurements
+
+        :param frequency: array of frequencies (kHz)
+        :param voltage: array of amplified voltages (V)
+        :param pressure: array of pressures (kPa)
+        """
+        index = self.get_index(frequency)
+        v2 = voltage ** 2
+        terms = np.stack([np.ones_like(voltage), v2, v2 * voltage, v2 ** 2,
+                          pressure * voltage, pressure * v2, pressure ** 2], axis=1)
+        np.add.at(self.sums, index, terms)
+
+    def solve(self):
+        """
+        Solve the normal equations at every frequency
+
+        :return: dict of arrays (one entry per frequency, in order of `sorted_frequencies`): coeff_a,
+                 coeff_b, se_a and se_b (standard errors), rms (residual, kPa) and n
+        """
+        order = np.argsort(list(self.frequencies))
+        s = self.sums[order]
+        det = s[:, V4] * s[:, V2] - s[:, V3] ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a = (s[:, PV2] * s[:, V2] - s[:, PV] * s[:, V3]) / det
+            b = (s[:, V4] * s[:, PV] - s[:, V3] * s[:, PV2]) / det
+            rss = (s[:, PP] - 2 * (a * s[:, PV2] + b * s[:, PV])
+                   + a ** 2 * s[:, V4] + 2 * a * b * s[:, V3] + b ** 2 * s[:, V2])
+            variance = np.maximum(rss, 0) / (s[:, N] - 2)
+            se_a = np.sqrt(variance * s[:, V2] / det)
+            se_b = np.sqrt(variance * s[:, V4] / det)
+        return {'coeff_a': a,
+                'coeff_b': b,
+                'se_a': se_a,
+                'se_b': se_b,
+                'rms': np.sqrt(variance),
+                'n': s[:, N].astype(int)}
+
+    @property
+    def sorted_frequencies(self):
+        return sorted(self.frequencies)
+
+
+def fit_files(filenames, gain=1.0, outlier_threshold=OUTLIER_THRESHOLD, mi_ref=MI_REF, chunk_size=CHUNK_SIZE):
+    """
+    Fit a calibration table from measurement files
+
+    :param filenames: list of CSV files
+    :param gain: amplifier gain to apply to the voltage column (1 if the files contain amplified voltages)
+    :param outlier_threshold: residual above which a measurement is an outlier (in standard deviations)
+    :param mi_ref: MI used for p_ref (the pressure for 100% in constant MI mode)
+    :param chunk_size: number of rows read at a time
+    :return: dict with 'calib' (the CALIB table), 'fit' (per-frequency statistics of the final
+             fit, keyed by frequency) and 'outliers' (number of outliers per frequency)
+    """
+    first = SweepFit()
+    for frequency, voltage, pressure in read_chunks(filenames, gain, chunk_size):
+        first.add(frequency, voltage, pressure)
+    frequencies = first.sorted_frequencies
+    result = first.solve()
+    logger.info(f'[fit_files] Fitted {len(frequencies)} frequencies from {int(result["n"].sum())} measurements')
+
+    # Second pass: flag outliers and refit without them
+    frequency_array = np.array(frequencies)
+    final = SweepFit()
+    n_outliers = np.zeros(len(frequencies), dtype=int)
+    for frequency, voltage, pressure in read_chunks(filenames, gain, chunk_size):
+        i = np.searchsorted(frequency_array, frequency)
+        residual = pressure - result['coeff_a'][i] * voltage ** 2 - result['coeff_b'][i] * voltage
+        inlier = ~(np.abs(residual) > outlier_threshold * result['rms'][i])
+        n_outliers += np.bincount(i[~inlier], minlength=len(frequencies))
+        final.add(frequency[inlier], voltage[inlier], pressure[inlier])
+    result = final.solve()
+    outliers = dict(zip(frequencies, n_outliers.tolist()))
+
+    calib = {}
+    fit = {}
+    for i, f in enumerate(final.sorted_frequencies):
+        key = int(f) if float(f).is_integer() else f
+        stats = {name: values[i].item() for name, values in result.items()}
+        stats['outliers'] = outliers[f]
+        fit[key] = stats
+        if stats['n'] < MIN_POINTS or not np.isfinite(stats['coeff_a']):
+            logger.error(f'[fit_files] {key} kHz: not enough distinct measurements to fit ({stats["n"]})')
+            continue
+        if outliers[f]:
+            logger.warning(f'[fit_files] {key} kHz: {outliers[f]} outliers removed')
+        calib[key] = {'p_ref': float(f'{mi_ref * np.sqrt(f * 1e-3) * 1e3:.6g}'),
+                      'coeff_a': float(f'{stats["coeff_a"]:.6g}'),
+                      'coeff_b': float(f'{stats["coeff_b"]:.6g}')}
+        logger.info(f'[fit_files] {key} kHz: a={stats["coeff_a"]:.6g} (+/-{stats["se_a"]:.2g}), '
+                    f'b={stats["coeff_b"]:.6g} (+/-{stats["se_b"]:.2g}), rms={stats["rms"]:.3g} kPa, n={stats["n"]}')
+    return {'calib': calib, 'fit': fit, 'outliers': outliers}
+
+
+def format_calib(calib):
+    """
+    Format a calibration table as Python source, laid out like the constants modules
+
+    :param calib: CALIB table
+    :return: source text
+    """
+    entries = []
+    for f, entry in calib.items():
+        indent = ' ' * (len('CALIB = {') + len(f'{f}: {{'))
+        entries.append(f"{f}: {{'p_ref': {entry['p_ref']!r},\n"
+                       f"{indent}'coeff_a': {entry['coeff_a']!r},\n"
+                       f"{indent}'coeff_b': {entry['coeff_b']!r}}}")
+    return 'CALIB = {' + (',\n' + ' ' * len('CALIB = {')).join(entries) + '}\n'
+
+
+def main(args):
+    """
+    Fit a calibration table from the command line
+
+    :param args: command line arguments
+    :return: exit code
+    """
+    filenames = []
+    gain = 1.0
+    as_json = False
+    output = None
+    i = 0
+    while i < len(args):
+        if args[i] == '-gain':
+            gain = float(args[i + 1])
+            i += 2
+        elif args[i] == '-json':
+            as_json = True
+            i += 1
+        elif args[i] == '-o':
+            output = args[i + 1]
+            i += 2
+        else:
+            filenames.append(args[i])
+            i += 1
+    if not filenames:
+        print(__doc__)
+        return 1
+    result = fit_files(filenames, gain=gain)
+    for f, stats in result['fit'].items():
+        print(f'{f:>8} kHz  n={stats["n"]:<6d} rms={stats["rms"]:8.3g} kPa  outliers={stats["outliers"]}',
+              file=sys.stderr)
+    if as_json:
+        text = json.dumps({'CALIB': {str(f): entry for f, entry in result['calib'].items()}}, indent=4) + '\n'
+    else:
+        text = format_calib(result['calib'])
+    if output is None:
+        sys.stdout.write(text)
+    else:
+        with open(output, 'w') as f:
+            f.write(text)
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
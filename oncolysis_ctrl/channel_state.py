@@ -0,0 +1,267 @@
+"""
+Channel State Module
+====================
+
+This module contains a declarative model of a function generator channel, `ChannelState`, and the
+compiler `compile_transition`, which turns the difference between the current state of a channel
+and a target state into the minimal sequence of SCPI commands, in a safe order:
+
+1. the output is disabled first when the target disables it, and kept disabled while the
+   waveform or burst mode changes (or a setting of unknown value is written);
+2. the amplitude is lowered before, and raised after, the frequency and burst changes;
+3. changes that shorten the burst relative to its period (fewer cycles, a longer period) are
+   written before the frequency, and those that lengthen it after, so that the burst always fits
+   in its period;
+4. the burst is enabled after, and disabled before, its other settings are written;
+5. the output is enabled last.
+
+Settings that already have their target value are not written, and a change of waveform is
+written as a single ``APPLY`` command. States are immutable and hashable, and the compiled
+sequences are cached per (current, target) pair, so the transitions of a protocol, which repeat
+from one run to the next, are only compiled once. `function_generator.Channel` keeps the state
+it last wrote, and `Channel.set_state` moves it to a target state.
+"""
+import functools
+import math
+
+FIELDS = ('output', 'function', 'frequency', 'amplitude', 'offset', 'phase',
+          'burst_enabled', 'burst_mode', 'burst_cycles', 'burst_period', 'burst_phase', 'burst_delay',
+          'trig_source', 'trig_negative', 'trig_out', 'gate_invert')
+# Command header of each field (the waveform is set with APPLY)
+HEADERS = {'output': 'OUTPUT{channel}:STAT',
+           'frequency': 'SOURCE{channel}:FREQUENCY:FIXED',
+           'amplitude': 'SOURCE{channel}:VOLTAGE:LEVEL:IMMEDIATE:AMPLITUDE',
+           'offset': 'SOURCE{channel}:VOLTAGE:LEVEL:IMMEDIATE:OFFSET',
+           'phase': 'SOURCE{channel}:PHASE',
+           'burst_enabled': 'SOURCE{channel}:BURST:STATE',
+           'burst_mode': 'SOURCE{channel}:BURST:MODE',
+           'burst_cycles': 'SOURCE{channel}:BURST:NCYCLES',
+           'burst_period': 'SOURCE{channel}:BURST:INTERNAL:PERIOD',
+           'burst_phase': 'SOURCE{channel}:BURST:PHASE',
+           'burst_delay': 'SOURCE{channel}:BURST:TDELAY',
+           'trig_source': 'SOURCE{channel}:BURST:TRIG:SOURCE',
+           'trig_negative': 'SOURCE{channel}:BURST:TRIG:SLOPE',
+           'trig_out': 'SOURCE{channel}:BURST:TRIG:TRIGOUT',
+           'gate_invert': 'SOURCE{channel}:BURST:GATE:POL'}
+# Values of the boolean fields in the commands
+BOOLEAN_VALUES = {'output': ('OFF', 'ON'),
+                  'burst_enabled': ('OFF', 'ON'),
+                  'trig_negative': ('POSITIVE', 'NEGATIVE'),
+                  'gate_invert': ('NORM', 'INV')}
+# Fields whose change switches the output waveform, written with the output disabled
+MODE_FIELDS = ('function', 'burst_enabled', 'burst_mode', 'trig_source')
+APPLY_FIELDS = ('frequency', 'amplitude', 'offset', 'phase')
+# Order of the burst settings written between the burst being disabled and enabled
+BURST_FIELDS = ('burst_mode', 'trig_source', 'trig_negative', 'trig_out', 'gate_invert', 'burst_phase',
+                'burst_delay')
+SOURCE_KEYS = {'mode': 'function', 'frequency': 'frequency', 'amplitude': 'amplitude', 'offset': 'offset',
+               'phase': 'phase'}
+BURST_KEYS = {'enabled': 'burst_enabled', 'period': 'burst_period', 'mode': 'burst_mode', 'cycles': 'burst_cycles',
+              'phase': 'burst_phase', 'delay': 'burst_delay', 'trig_negative': 'trig_negative',
+              'trig_source': 'trig_source', 'gate_invert': 'gate_invert'}
+# Smallest amplitude change written (V), the resolution of the instrument
+AMPLITUDE_TOLERANCE = 1e-4
+CACHE_SIZE = 1024
+
+
+def values_match(current, desired, field=None):
+    """
+    Compare a current value (e.g. read from the instrument) with a desired value
+
+    :param current: current value
+    :param desired: desired value
+    :param field: name of the field (the amplitude is compared to `AMPLITUDE_TOLERANCE`)
+    :return: True if the values are equivalent
+    """
+    if isinstance(desired, str) or isinstance(current, str):
+        # The instrument answers with short forms (e.g. 'SIN' for 'SINUSOID')
+        current, desired = str(current).upper(), str(desired).upper()
+        return current.startswith(desired[:3]) and desired.startswith(current[:3])
+    if isinstance(desired, bool) or isinstance(current, bool):
+        return bool(current) == bool(desired)
+    if field == 'amplitude':
+        return abs(float(current) - float(desired)) < AMPLITUDE_TOLERANCE
+    return math.isclose(float(current), float(desired), rel_tol=1e-6, abs_tol=1e-9)
+
+
+class ChannelState:
+    """
+    Channel State
+    =============
+
+    Settings of a function generator channel. A field set to None is unknown in a current state,
+    and left unchanged in a target state. States are immutable and hashable.
+    """
+    __slots__ = FIELDS
+
+    def __init__(self, **fields):
+        """
+        ChannelState constructor
+
+        :param fields: values of the fields (see `FIELDS`). The others are None.
+        """
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise TypeError(f'Unknown channel state fields: {", ".join(sorted(unknown))}')
+        for field in FIELDS:
+            object.__setattr__(self, field, fields.get(field))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ChannelState is immutable. Use replace()')
+
+    def __eq__(self, other):
+        return isinstance(other, ChannelState) and self.astuple() == other.astuple()
+
+    def __hash__(self):
+        return hash(self.astuple())
+
+    def __repr__(self):
+        fields = ', '.join(f'{field}={value!r}' for field, value in self.asdict().items())
+        return f'ChannelState({fields})'
+
+    def astuple(self):
+        """
+        :return: tuple of the values of all fields
+        """
+        return tuple(getattr(self, field) for field in FIELDS)
+
+    def asdict(self):
+        """
+        :return: dict of the fields that are set
+        """
+        return {field: getattr(self, field) for field in FIELDS if getattr(self, field) is not None}
+
+    def replace(self, **fields):
+        """
+        :param fields: fields to change (None to forget a value)
+        :return: copy of the state with the fields changed
+        """
+        values = {field: getattr(self, field) for field in FIELDS}
+        values.update(fields)
+        return ChannelState(**values)
+
+    def update(self, target):
+        """
+        :param target: target state
+        :return: the state reached by applying the target (its fields that are set) to this state
+        """
+        return self.replace(**target.asdict())
+
+    def diff(self, target):
+        """
+        :param target: target state
+        :return: dict of (current, target) values of the fields the target changes
+        """
+        return {field: (getattr(self, field), value) for field, value in target.asdict().items()
+                if getattr(self, field) is None or not values_match(getattr(self, field), value, field)}
+
+    @classmethod
+    def from_params(cls, source_params=None, burst_params=None, output=None):
+        """
+        Build a state from waveform and burst settings
+
+        :param source_params: waveform settings (as used by `Channel.apply` or returned by
+                              `Channel.get_settings`)
+        :param burst_params: burst settings (as used by `Channel.set_burst` or returned by
+                             `Channel.get_burst`)
+        :param output: output enabled
+        :return: ChannelState
+        """
+        fields = {'output': output}
+        for key, value in (source_params or {}).items():
+            if key in SOURCE_KEYS:
+                fields[SOURCE_KEYS[key]] = value
+        burst_params = burst_params or {}
+        for key, value in burst_params.items():
+            if key in BURST_KEYS:
+                fields[BURST_KEYS[key]] = value
+        if burst_params.get('trig_out_en') is not None:
+            fields['trig_out'] = ('NEG' if burst_params.get('trig_out_negative') else 'POS') \
+                if burst_params['trig_out_en'] else 'OFF'
+        return cls(**fields)
+
+
+def format_command(channel, field, value):
+    """
+    :param channel: channel number
+    :param field: field of `ChannelState` (except 'function')
+    :param value: value to write
+    :return: SCPI command writing the value
+    """
+    if field in BOOLEAN_VALUES:
+        value = BOOLEAN_VALUES[field][bool(value)]
+    return f'{HEADERS[field].format(channel=channel)} {value}'
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def compile_transition(current, target, channel, max_voltage=None):
+    """
+    Compile the SCPI commands moving a channel from its current state to a target state
+
+    :param current: current `ChannelState` (None fields are unknown)
+    :param target: target `ChannelState` (None fields are left unchanged)
+    :param channel: channel number
+    :param max_voltage: maximum amplitude (V), or None
+    :return: (tuple of commands, state after the commands)
+    :raises ValueError: if the target amplitude exceeds the maximum
+    """
+    if target.amplitude and max_voltage and target.amplitude > max_voltage:
+        raise ValueError(f'Requested voltage ({target.amplitude} V) exceeds maximum allowable for '
+                         f'channel {channel} ({max_voltage} V)')
+    changes = current.diff(target)
+    state = current.update(target)
+    if not changes:
+        return (), state
+    commands = []
+    pending = dict(changes)
+
+    def write(field):
+        commands.append(format_command(channel, field, pending.pop(field)[1]))
+
+    output = target.output if target.output is not None else current.output
+    # 1. Disable the output
+    hold_off = current.output is not False and any(field in MODE_FIELDS or current_value is None
+                                                   for field, (current_value, _) in changes.items()
+                                                   if field != 'output')
+    if output is False and 'output' in pending:
+        write('output')
+    elif hold_off:
+        commands.append(format_command(channel, 'output', False))
+        if output is None:
+            state = state.replace(output=False)
+    # 2. and 3. Lower the amplitude (unless the waveform changes, which writes it with the output
+    # disabled) and shorten the burst
+    for field, shorten in (('amplitude', -1), ('burst_cycles', -1), ('burst_period', 1)):
+        values = pending.get(field)
+        if values is not None and values[0] is not None and (values[1] - values[0]) * shorten > 0 and \
+                not (field == 'amplitude' and 'function' in pending):
+            write(field)
+    # The waveform, in one APPLY command when it changes
+    if 'function' in pending:
+        _, function = pending.pop('function')
+        args = []
+        for field in APPLY_FIELDS:
+            value = getattr(state, field)
+            if value is None:
+                break
+            args.append(value)
+            pending.pop(field, None)
+        commands.append(f'SOUR{channel}:APPLY:{function.upper()}' + (' ' + ', '.join(map(str, args)) if args else ''))
+    for field in ('frequency', 'offset', 'phase'):
+        if field in pending:
+            write(field)
+    # 4. The burst, disabled before and enabled after its settings
+    if 'burst_enabled' in pending and not pending['burst_enabled'][1]:
+        write('burst_enabled')
+    for field in BURST_FIELDS + ('burst_cycles', 'burst_period'):
+        if field in pending:
+            write(field)
+    if 'burst_enabled' in pending:
+        write('burst_enabled')
+    if 'amplitude' in pending:
+        write('amplitude')
+    # 5. Enable the output
+    if output and ('output' in pending or hold_off):
+        pending.pop('output', None)
+        commands.append(format_command(channel, 'output', True))
+    return tuple(commands), state
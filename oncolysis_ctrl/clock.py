@@ -0,0 +1,88 @@
+"""
+Clock Module
+============
+
+This module contains the clocks used by the `Controller` and the control loop for timekeeping,
+sleeping and polling the command queue. `REAL_CLOCK` uses wall-clock time. A `VirtualClock`
+advances only when the controller waits, so that a simulated protocol runs as fast as the code
+allows while producing the same sequence of events and callbacks as a real-time run.
+"""
+import queue
+import threading
+import time
+
+
+class Clock:
+    """
+    Wall-clock time source
+    """
+    virtual = False
+
+    def time(self):
+        """
+        Current time
+
+        :return: time (s)
+        """
+        return time.time()
+
+    def sleep(self, seconds):
+        """
+        Wait for a period of time
+
+        :param seconds: time to wait (s)
+        """
+        time.sleep(seconds)
+
+    def get(self, q, timeout):
+        """
+        Get a message from a queue, waiting up to `timeout`
+
+        :param q: queue to read from
+        :param timeout: maximum time to wait (s)
+        :return: message
+        :raises queue.Empty: if no message arrived in time
+        """
+        return q.get(timeout=timeout)
+
+
+class VirtualClock(Clock):
+    """
+    Virtual time source for fast-forward simulation. Time starts at `start` and only moves forward
+    when `sleep` is called or a queue poll times out.
+    """
+    virtual = True
+
+    def __init__(self, start=0.0):
+        """
+        VirtualClock constructor
+
+        :param start: initial time (s)
+        """
+        self.now = start
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        """
+        Move the clock forward
+
+        :param seconds: time to advance (s)
+        """
+        with self.lock:
+            self.now += max(0.0, seconds)
+
+    def get(self, q, timeout):
+        try:
+            return q.get(False)
+        except queue.Empty:
+            self.advance(timeout)
+            raise
+
+
+REAL_CLOCK = Clock()
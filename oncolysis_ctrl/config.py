@@ -10,6 +10,10 @@ import os
 DEFAULT_CONFIG = 'invitro_8mm'
 HERE = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILENAME = os.path.join(HERE, 'CONFIG_ID.txt')
+LOG_PATH = os.path.join(HERE, '..', '..', 'logs')
+CONFIG_PATH = os.path.join(HERE, 'configurations')
+INDEX_FILENAME = os.path.join(CONFIG_PATH, '__pycache__', 'config_index.txt')
+DATA_EXTENSIONS = ('.toml', '.json')
 CONFIG_IDS = ('INVITRO_5MM', 'INVITRO_7MM', 'INVITRO_8MM', 'INVITRO_9MM', 'INVIVO_FLANK')
 
 
@@ -17,12 +21,97 @@ def get_constants(cid=DEFAULT_CONFIG):
     """
     Get the constants for the specified configuration ID.
 
+    Configurations written as data files (TOML/JSON) take precedence over Python modules, and are
+    compiled and validated by `config_compiler` on first use.
     :param cid: The configuration ID to get constants for.
     :return: The constants module for the specified configuration ID.
     """
+    path = get_config_path(cid)
+    if not path.endswith('.py'):
+        from oncolysis_ctrl import config_compiler
+        return config_compiler.load(path)
     return importlib.import_module(f'oncolysis_ctrl.configurations.constants_{cid.lower()}')
 
 
+def get_config_path(cid):
+    """
+    Get the path of the source file for the specified configuration ID.
+
+    :param cid: The configuration ID.
+    :return: The path to the configuration data file if there is one, otherwise to the constants module.
+    """
+    for ext in DATA_EXTENSIONS:
+        path = os.path.join(CONFIG_PATH, f'constants_{cid.lower()}{ext}')
+        if os.path.exists(path):
+            return path
+    return os.path.join(CONFIG_PATH, f'constants_{cid.lower()}.py')
+
+
+def read_config_name(path):
+    """
+    Read the NAME of a configuration module from its source file without executing it.
+
+    :param path: The path to the constants module.
+    :return: The configuration name, or None if NAME is not assigned a literal in the file.
+    """
+    if not path.endswith('.py'):
+        return None
+    import ast  # only needed when the index is stale
+    with open(path, 'r') as f:
+        tree = ast.parse(f.read(), filename=path)
+    name = None
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant):
+            if any(isinstance(target, ast.Name) and target.id == 'NAME' for target in node.targets):
+                name = node.value.value
+    return name
+
+
+def get_config_index(config_ids=CONFIG_IDS):
+    """
+    Get the name and source path of each configuration, without importing the constants modules.
+
+    The index is cached in INDEX_FILENAME as tab-separated lines of ID, mtime, size and name, and an
+    entry is only re-read when its source file has changed. Configurations that inherit NAME from
+    another module fall back to importing it.
+    :param config_ids: The configuration IDs to index.
+    :return: dict of {config ID: {'name': name, 'path': path}}
+    """
+    cache = {}
+    try:
+        with open(INDEX_FILENAME, 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 4:
+                    cache[fields[0]] = {'mtime': fields[1], 'size': fields[2], 'name': fields[3]}
+    except OSError:
+        pass
+    index = {}
+    changed = False
+    for cid in config_ids:
+        path = get_config_path(cid)
+        stat = os.stat(path)
+        mtime, size = repr(stat.st_mtime), str(stat.st_size)
+        entry = cache.get(cid)
+        if entry is None or entry['mtime'] != mtime or entry['size'] != size:
+            name = read_config_name(path)
+            if name is None:
+                name = get_constants(cid).NAME
+            entry = {'name': name, 'mtime': mtime, 'size': size}
+            cache[cid] = entry
+            changed = True
+        index[cid] = {'name': entry['name'], 'path': path}
+    if changed:
+        try:
+            os.makedirs(os.path.dirname(INDEX_FILENAME), exist_ok=True)
+            with open(INDEX_FILENAME, 'w', encoding='utf-8') as f:
+                for key, val in cache.items():
+                    f.write(f'{key}\t{val["mtime"]}\t{val["size"]}\t{val["name"]}\n')
+        except OSError:
+            pass
+    return index
+
+
 def get_config_id():
     """
     Get the current configuration ID.
@@ -50,12 +139,26 @@ def set_config_id(cid):
         f.write(cid)
 
 
-CONFIG_NAMES = []
-for config_id in CONFIG_IDS:
-    constants = get_constants(config_id)
-    CONFIG_NAMES.append(constants.NAME)
-CONFIG_NAMES = tuple(CONFIG_NAMES)
+CONFIG_INDEX = get_config_index(CONFIG_IDS)
+CONFIG_NAMES = tuple(CONFIG_INDEX[config_id]['name'] for config_id in CONFIG_IDS)
+
+def load_config(cid):
+    """
+    Switch the active configuration in-process.
+
+    Sets `config_id` and `constants` to the new configuration and saves the ID, so the same
+    configuration is used on the next launch. Objects that were created from the previous
+    constants (e.g. a `Controller`) must be updated explicitly.
+    :param cid: The configuration ID to load.
+    :return: The constants module for the configuration.
+    """
+    global config_id, constants
+    new_constants = get_constants(cid)
+    set_config_id(cid)
+    config_id = cid.upper()
+    constants = new_constants
+    return constants
+
 
 config_id = get_config_id()
 constants = get_constants(config_id)
-REBOOT = False
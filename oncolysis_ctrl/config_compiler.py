@@ -0,0 +1,514 @@
+"""
+Configuration Compiler Module
+=============================
+
+This module loads configurations written as data files (``constants_<id>.toml`` or
+``constants_<id>.json`` in the configurations folder) instead of Python modules. A data file holds
+the same upper-case constants as a constants module, plus an optional ``extends`` key naming the
+configuration(s) it is based on (``"global"`` by default), which plays the role of the star imports
+in the Python modules::
+
+    extends = ["global", "invivo"]
+    ID = "INVIVO_FLANK"
+    NAME = "In Vivo - Flank"
+    FREQUENCIES_KHZ = [100, 150, 230]
+
+    [CALIB.100]
+    p_ref = 601
+    coeff_a = 0.000635469
+    coeff_b = 1.55504
+
+Loading a data file compiles it: the constants are merged with the base configuration,
+normalized (table keys become frequencies, lists become tuples) and validated against `SCHEMA`
+and the cross-checks in `validate` (units and ranges, defaults present in their option lists,
+calibration and RF switch coverage of every frequency, and default power settings within the
+safety envelope). The result is cached as a pickle in
+``configurations/__pycache__``, keyed by a hash of the contents of the file and all of its bases,
+so that a configuration is only recompiled when one of its sources changes.
+
+Python constants modules can be validated with the same rules, and exported to JSON::
+
+    python -m oncolysis_ctrl.config_compiler                 # validate every configuration
+    python -m oncolysis_ctrl.config_compiler -export ID PATH # write a configuration as JSON
+"""
+import hashlib
+import importlib
+import json
+import logging
+import os
+import pickle
+import sys
+import types
+from oncolysis_ctrl import calibration, config, envelope
+logger = logging.getLogger("oc.config_compiler")
+
+COMPILER_VERSION = 1
+DATA_EXTENSIONS = config.DATA_EXTENSIONS
+SWITCH_POSITIONS = range(1, 9)
+
+
+class ConfigError(ValueError):
+    """
+    Raised when a configuration cannot be compiled
+    """
+
+
+class Field:
+    """
+    Schema entry for a single constant
+    """
+    def __init__(self, kind, units=None, low=None, high=None, optional=False):
+        """
+        Field constructor
+
+        :param kind: 'str', 'number', 'int', 'strs', 'numbers', 'ints' or 'table'
+        :param units: units of the value (for messages)
+        :param low: lowest allowed value (inclusive)
+        :param high: highest allowed value (inclusive)
+        :param optional: True if None is allowed
+        """
+        self.kind = kind
+        self.units = units
+        self.low = low
+        self.high = high
+        self.optional = optional
+
+
+SCHEMA = {'ID': Field('str'),
+          'NAME': Field('str'),
+          'AMPLIFIER_GAIN': Field('number', 'V/V', 1, 1e4),
+          'POWER_MODE': Field('str'),
+          'POWER_MODES': Field('strs'),
+          'POWER_SETTINGS': Field('table'),
+          'SAFETY_LIMITS': Field('table'),
+          'DOSE_MI_THRESHOLD': Field('number', '', 0, 10),
+          'DOSE_LIMITS': Field('table'),
+          'WATCHDOG_INTERVAL_S': Field('number', 's', 0, 60, optional=True),
+          'WATCHDOG_BUDGET': Field('number', '', 0, 1),
+          'WATCHDOG_MAX_LATENCY_S': Field('number', 's', 0, 10),
+          'IO_TIMEOUT_S': Field('number', 's', 0, 60, optional=True),
+          'IO_RETRIES': Field('int', '', 0, 10),
+          'IO_BACKOFF_S': Field('number', 's', 0, 10),
+          'IO_BACKOFF_MAX_S': Field('number', 's', 0, 60),
+          'RECONNECT_ATTEMPTS': Field('int', '', 0, 10),
+          'DURATIONS_S': Field('numbers', 's', 1, 24 * 3600),
+          'DURATION_S': Field('number', 's', 1, 24 * 3600),
+          'FREQUENCIES_KHZ': Field('numbers', 'kHz', 1, 10000),
+          'FREQUENCY_KHZ': Field('number', 'kHz', 1, 10000),
+          'CALIB': Field('table'),
+          'RADIALL_VID': Field('int', '', 0, 0xFFFF),
+          'RADIALL_PID': Field('int', '', 0, 0xFFFF),
+          'RADIALL_SN': Field('strs'),
+          'RF_SWITCH_SETTINGS': Field('table'),
+          'RIGOL_DG4162_VID': Field('int', '', 0, 0xFFFF),
+          'RIGOL_DG4162_PID': Field('int', '', 0, 0xFFFF),
+          'CHANNELS': Field('ints', '', 1, 2),
+          'MAX_VOLTAGE': Field('number', 'V', 0, 10),
+          'TRANSMIT_CHANNEL': Field('int', '', 1, 2),
+          'BURST_PERIOD': Field('number', 's', 0, 100),
+          'BURST_LENGTHS': Field('numbers', 's', 0, 10),
+          'BURST_LENGTH': Field('number', 's', 0, 10),
+          'BURST_DUTY_CYCLES': Field('numbers', '', 0, 1),
+          'BURST_DUTY_CYCLE': Field('number', '', 0, 1),
+          'BURST_PARAMS_TEMPLATE': Field('table'),
+          'SOURCE_PARAMS_TEMPLATE': Field('table')}
+CALIB_FIELDS = {'p_ref': ('kPa', 0, 1e5), 'coeff_a': ('kPa/V^2', -1e3, 1e3), 'coeff_b': ('kPa/V', 0, 1e4)}
+POWER_SETTINGS_FIELDS = ('units', 'label', 'minmax', 'step', 'default')
+SAFETY_LIMITS_FIELDS = {'mi': '', 'isppa': 'W/cm2', 'ispta': 'mW/cm2', 'voltage': 'V'}
+
+
+def get_module_constants(module):
+    """
+    Get the upper-case constants defined in a module
+
+    :param module: constants module
+    :return: dict of constants
+    """
+    return {key: getattr(module, key) for key in dir(module) if key.isupper()}
+
+
+def find_source(name, folder):
+    """
+    Find the source file of a configuration, preferring data files over Python modules
+
+    :param name: configuration name (e.g. 'invivo_flank' or 'global')
+    :param folder: configurations folder
+    :return: path to the source file
+    :raises ConfigError: if there is no source for the configuration
+    """
+    for ext in DATA_EXTENSIONS + ('.py',):
+        path = os.path.join(folder, f'constants_{name.lower()}{ext}')
+        if os.path.exists(path):
+            return path
+    raise ConfigError(f'No configuration source for "{name}" in {folder}')
+
+
+def read_data_file(path):
+    """
+    Parse a TOML or JSON configuration file
+
+    :param path: path to the file
+    :return: dict of raw values
+    :raises ConfigError: if the file cannot be parsed
+    """
+    with open(path, 'rb') as f:
+        content = f.read()
+    try:
+        if path.endswith('.toml'):
+            try:
+                import tomllib
+            except ImportError:  # Python < 3.11
+                try:
+                    import tomli as tomllib
+                except ImportError:
+                    raise ConfigError(f'Reading {os.path.basename(path)} requires Python 3.11+ or the tomli package')
+            return tomllib.loads(content.decode('utf-8'))
+        return json.loads(content)
+    except ConfigError:
+        raise
+    except ValueError as e:
+        raise ConfigError(f'Could not parse {os.path.basename(path)}: {e}') from e
+
+
+def get_sources(path, parents=()):
+    """
+    Resolve the source files a configuration is built from
+
+    :param path: path to a configuration source file
+    :param parents: paths of the configurations that extend this one (to detect cycles)
+    :return: list of (path, raw values), bases first. Python modules are represented with raw
+             values None.
+    :raises ConfigError: if a base is missing or the bases are circular
+    """
+    if path in parents:
+        raise ConfigError(f'Circular "extends" in {os.path.basename(path)}')
+    if path.endswith('.py'):
+        return [(path, None)]
+    data = read_data_file(path)
+    bases = data.get('extends', 'global')
+    if isinstance(bases, str):
+        bases = [bases]
+    sources = []
+    for base in bases:
+        sources += get_sources(find_source(base, os.path.dirname(path)), parents + (path,))
+    return sources + [(path, data)]
+
+
+def hash_sources(paths):
+    """
+    Hash the contents of a configuration's source files
+
+    :param paths: source file paths
+    :return: hex digest
+    """
+    digest = hashlib.sha256(f'{COMPILER_VERSION}\n'.encode())
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def to_frequency(key):
+    """
+    Convert a table key (TOML and JSON keys are strings) to a frequency
+
+    :param key: key from a data file
+    :return: frequency (int if integral)
+    """
+    value = float(key)
+    return int(value) if value.is_integer() else value
+
+
+def normalize(values):
+    """
+    Convert raw data file values to the types used by the constants modules
+
+    :param values: dict of raw values
+    :return: dict of normalized values
+    """
+    normalized = {}
+    for key, value in values.items():
+        if key in ('CALIB', 'RF_SWITCH_SETTINGS'):
+            value = {to_frequency(f): (tuple(v) if isinstance(v, list) else v) for f, v in value.items()}
+        elif key == 'POWER_SETTINGS':
+            value = {mode: {**settings, 'minmax': tuple(settings['minmax'])} if 'minmax' in settings else settings
+                     for mode, settings in value.items()}
+        elif isinstance(value, list):
+            value = tuple(value)
+        normalized[key] = value
+    return normalized
+
+
+def check_field(key, value, field, errors):
+    """
+    Check a constant against its schema entry, appending any problems to `errors`
+    """
+    if value is None:
+        if not field.optional:
+            errors.append(f'{key} is required')
+        return
+    kind = field.kind
+    if kind == 'table':
+        if not isinstance(value, dict):
+            errors.append(f'{key} must be a table')
+        return
+    if kind in ('strs', 'numbers', 'ints'):
+        if not isinstance(value, (tuple, list)) or len(value) == 0:
+            errors.append(f'{key} must be a non-empty list')
+            return
+        items = [(f'{key}[{i}]', item) for i, item in enumerate(value)]
+        kind = kind[:-1]
+    else:
+        items = [(key, value)]
+    for name, item in items:
+        if kind == 'str':
+            ok = isinstance(item, str)
+        elif kind == 'int':
+            ok = isinstance(item, int) and not isinstance(item, bool)
+        else:
+            ok = isinstance(item, (int, float)) and not isinstance(item, bool)
+        if not ok:
+            errors.append(f'{name} must be a {kind}, not {item!r}')
+        elif field.low is not None and not field.low <= item <= field.high:
+            errors.append(f'{name} = {item} {field.units} is outside [{field.low}, {field.high}] {field.units}'.strip())
+
+
+def validate(constants):
+    """
+    Validate a complete set of constants
+
+    :param constants: dict of constants
+    :return: list of error messages (empty if the constants are valid)
+    """
+    errors = []
+    for key in constants:
+        if key not in SCHEMA and key != 'extends':
+            errors.append(f'Unknown constant {key}')
+    for key, field in SCHEMA.items():
+        check_field(key, constants.get(key), field, errors)
+    if errors:
+        return errors
+
+    for key, options in (('POWER_MODE', 'POWER_MODES'), ('DURATION_S', 'DURATIONS_S'),
+                         ('FREQUENCY_KHZ', 'FREQUENCIES_KHZ'), ('BURST_LENGTH', 'BURST_LENGTHS'),
+                         ('BURST_DUTY_CYCLE', 'BURST_DUTY_CYCLES'), ('TRANSMIT_CHANNEL', 'CHANNELS')):
+        if constants[key] not in constants[options]:
+            errors.append(f'{key} = {constants[key]!r} is not one of {options}')
+
+    for mode in constants['POWER_MODES']:
+        settings = constants['POWER_SETTINGS'].get(mode)
+        if settings is None:
+            errors.append(f'POWER_SETTINGS has no entry for power mode {mode}')
+            continue
+        missing = [field for field in POWER_SETTINGS_FIELDS if field not in settings]
+        if missing:
+            errors.append(f'POWER_SETTINGS[{mode}] is missing {", ".join(missing)}')
+            continue
+        low, high = settings['minmax']
+        if not low < high:
+            errors.append(f'POWER_SETTINGS[{mode}] minmax {settings["minmax"]} is empty')
+        elif not low <= settings['default'] <= high:
+            errors.append(f'POWER_SETTINGS[{mode}] default {settings["default"]} is outside {settings["minmax"]}')
+        if not settings['step'] > 0:
+            errors.append(f'POWER_SETTINGS[{mode}] step must be positive')
+
+    if set(constants['SAFETY_LIMITS']) != set(SAFETY_LIMITS_FIELDS):
+        errors.append(f'SAFETY_LIMITS must have exactly {", ".join(SAFETY_LIMITS_FIELDS)}')
+    for key, limit in constants['SAFETY_LIMITS'].items():
+        if not (isinstance(limit, (int, float)) and limit > 0):
+            errors.append(f'SAFETY_LIMITS[{key}] must be a positive number ({SAFETY_LIMITS_FIELDS.get(key, "")})')
+
+    for key, limit in constants['DOSE_LIMITS'].items():
+        if limit is not None and not (isinstance(limit, (int, float)) and limit >= 0):
+            errors.append(f'DOSE_LIMITS[{key}] must be a non-negative number')
+
+    max_amplified_voltage = constants['MAX_VOLTAGE'] * constants['AMPLIFIER_GAIN']
+    for frequency, calib in constants['CALIB'].items():
+        if not isinstance(calib, dict) or set(calib) != set(CALIB_FIELDS):
+            errors.append(f'CALIB[{frequency}] must have exactly {", ".join(CALIB_FIELDS)}')
+            continue
+        for field, (units, low, high) in CALIB_FIELDS.items():
+            value = calib[field]
+            if not isinstance(value, (int, float)) or not low <= value <= high:
+                errors.append(f'CALIB[{frequency}].{field} = {value!r} must be in [{low}, {high}] {units}')
+                break
+        else:
+            # p = aV^2 + bV must increase with voltage over the whole output range
+            if 2 * calib['coeff_a'] * max_amplified_voltage + calib['coeff_b'] <= 0:
+                errors.append(f'CALIB[{frequency}] pressure decreases with voltage below '
+                              f'MAX_VOLTAGE ({max_amplified_voltage:0.0f} V amplified)')
+
+    n_switches = len(constants['RADIALL_SN'])
+    for frequency, positions in constants['RF_SWITCH_SETTINGS'].items():
+        if not isinstance(positions, tuple) or len(positions) != n_switches:
+            errors.append(f'RF_SWITCH_SETTINGS[{frequency}] must have one position for each of {n_switches} switches')
+        elif any(position is not None and position not in SWITCH_POSITIONS for position in positions):
+            errors.append(f'RF_SWITCH_SETTINGS[{frequency}] = {positions} has a position outside '
+                          f'{SWITCH_POSITIONS.start}-{SWITCH_POSITIONS.stop - 1}')
+
+    calibrated = list(constants['CALIB'])
+    for frequency in constants['FREQUENCIES_KHZ']:
+        # The calibration is interpolated between calibration points (see `calibration`)
+        if not calibrated or not min(calibrated) <= frequency <= max(calibrated):
+            errors.append(f'{frequency} kHz is outside the calibrated range of CALIB')
+        if frequency not in constants['RF_SWITCH_SETTINGS']:
+            errors.append(f'RF_SWITCH_SETTINGS has no entry for {frequency} kHz')
+    if errors:
+        return errors
+
+    # The default power settings must be safe at every frequency where the power mode can be used
+    safe = envelope.SafetyEnvelope(calibration.Calibration(constants['CALIB']), constants['FREQUENCIES_KHZ'],
+                                   constants['POWER_SETTINGS'], (constants['BURST_LENGTH'],),
+                                   (constants['BURST_DUTY_CYCLE'],), constants['SAFETY_LIMITS'],
+                                   constants['AMPLIFIER_GAIN'], constants['MAX_VOLTAGE'])
+    for mode in constants['POWER_MODES']:
+        settings = constants['POWER_SETTINGS'][mode]
+        for frequency in constants['FREQUENCIES_KHZ']:
+            max_value, binding = safe.lookup(frequency, mode, constants['BURST_LENGTH'], constants['BURST_DUTY_CYCLE'])
+            if settings['minmax'][0] <= max_value < settings['default'] * (1 - 1e-9):
+                errors.append(f'POWER_SETTINGS[{mode}] default {settings["default"]} exceeds the safety envelope '
+                              f'at {frequency} kHz (maximum {max_value:0.4g}, {binding} limit)')
+    return errors
+
+
+def compile_sources(sources):
+    """
+    Merge, normalize and validate the sources of a configuration
+
+    :param sources: list of (path, raw values) from `get_sources`
+    :return: dict of constants
+    :raises ConfigError: if the result is invalid
+    """
+    constants = {}
+    for path, data in sources:
+        if data is None:
+            name = os.path.splitext(os.path.basename(path))[0]
+            constants.update(get_module_constants(importlib.import_module(f'oncolysis_ctrl.configurations.{name}')))
+            continue
+        values = normalize({key: value for key, value in data.items() if key != 'extends'})
+        if 'DOSE_LIMITS' in values:
+            # Limits left out of a data file are unlimited (TOML has no null)
+            values['DOSE_LIMITS'] = {**{key: None for key in constants.get('DOSE_LIMITS', {})},
+                                     **values['DOSE_LIMITS']}
+        constants.update(values)
+    errors = validate(constants)
+    if errors:
+        raise ConfigError(f'{os.path.basename(sources[-1][0])}: ' + '; '.join(errors))
+    return constants
+
+
+def get_cache_filename(path, digest):
+    """
+    Get the filename of the compiled form of a configuration
+
+    :param path: path to the configuration data file
+    :param digest: hash of the configuration's sources
+    :return: path to the cache file
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(os.path.dirname(path), '__pycache__', f'{name}.{digest[:16]}.pickle')
+
+
+def make_module(path, constants):
+    """
+    Wrap compiled constants in a module object, so that they are used like a constants module
+
+    :param path: path to the configuration data file
+    :param constants: dict of constants
+    :return: module
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    module = types.ModuleType(f'oncolysis_ctrl.configurations.{name}', 'Compiled configuration')
+    module.__file__ = path
+    module.__dict__.update(constants)
+    return module
+
+
+_loaded = {}
+
+
+def load(path):
+    """
+    Load a configuration data file, compiling it only if one of its sources changed
+
+    The compiled form is looked up by the hash of the file itself, and is used if the hash of the
+    whole chain of sources it was compiled from still matches.
+    :param path: path to the configuration data file
+    :return: constants module (the same object while the sources are unchanged)
+    :raises ConfigError: if the configuration is invalid
+    """
+    loaded = _loaded.get(path)
+    if loaded is not None and hash_sources(loaded[0]) == loaded[1]:
+        return loaded[2]
+    cache_filename = get_cache_filename(path, hash_sources([path]))
+    try:
+        with open(cache_filename, 'rb') as f:
+            paths, digest, constants = pickle.load(f)
+        if hash_sources(paths) != digest:
+            constants = None
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        constants = None
+    if constants is None:
+        logger.info(f'[load] Compiling {os.path.basename(path)}')
+        sources = get_sources(path)
+        paths = [source_path for source_path, _ in sources]
+        digest = hash_sources(paths)
+        constants = compile_sources(sources)
+        cache_dir = os.path.dirname(cache_filename)
+        prefix = os.path.splitext(os.path.basename(path))[0] + '.'
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            for filename in os.listdir(cache_dir):
+                if filename.startswith(prefix) and filename.endswith('.pickle'):
+                    os.remove(os.path.join(cache_dir, filename))
+            with open(cache_filename, 'wb') as f:
+                pickle.dump((paths, digest, constants), f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            logger.warning(f'[load] Could not write {cache_filename}: {e}')
+    module = make_module(path, constants)
+    _loaded[path] = (paths, digest, module)
+    return module
+
+
+def export(constants, path):
+    """
+    Write a configuration to a JSON data file
+
+    :param constants: constants module or dict
+    :param path: output path
+    :return: None
+    """
+    if isinstance(constants, types.ModuleType):
+        constants = get_module_constants(constants)
+    data = {key: ({str(k): v for k, v in value.items()} if key in ('CALIB', 'RF_SWITCH_SETTINGS') else value)
+            for key, value in constants.items() if key in SCHEMA}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4)
+        f.write('\n')
+
+
+def main(args):
+    """
+    Validate every configuration, or export one to JSON
+
+    :param args: command line arguments
+    :return: exit code
+    """
+    if args[:1] == ['-export']:
+        cid, path = args[1:3]
+        export(config.get_constants(cid), path)
+        print(f'Exported {cid} to {path}')
+        return 0
+    failed = 0
+    for cid in args or config.CONFIG_IDS:
+        try:
+            errors = validate(get_module_constants(config.get_constants(cid)))
+        except ConfigError as e:
+            errors = [str(e)]
+        print(f'{cid}: {"OK" if not errors else "; ".join(errors)}')
+        failed += bool(errors)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -7,6 +7,11 @@ Each configuration is a module. Modules can import one another to re-use
 constants across multiple configurations, so that each specific configuration
 only has to contain the constants that are unique to it.
 
+A configuration can also be written as a TOML or JSON data file
+(``constants_<id>.toml`` or ``constants_<id>.json``), which takes precedence over a
+module with the same ID. Data files are validated and compiled by
+`oncolysis_ctrl/config_compiler`.
+
 `oncolysis_ctl/config` is the main module for the system configuration, which
 invokes the modules found here.
 """
\ No newline at end of file
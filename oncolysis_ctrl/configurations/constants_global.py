@@ -12,13 +12,13 @@ POWER_SETTINGS = {
         'label': 'Constant Pressure',
         'minmax': (0, 1000),
         'step': 25,
-        'default': 750},
+        'default': 450},
     'constant_mi': {
         'units': '%',
         'label': 'Constant MI',
         'minmax': (0, 200),
         'step': 5,
-        'default': 100},
+        'default': 20},
     'constant_ispta': {
         'units': 'mW/cm2',
         'label': 'Constant ISPTA (Adjusted MI)',
@@ -36,9 +36,35 @@ POWER_SETTINGS = {
         'label': 'Constant ISPPA',
         'minmax': (0, 100),
         'step': 1,
-        'default': 50}}
+        'default': 7}}
 
 
+# Safety Limits (MI, ISPPA in W/cm2, ISPTA in mW/cm2, function generator voltage in V). The default
+# power settings must be within the limits at every frequency (see config_compiler.validate)
+SAFETY_LIMITS = {'mi': 1.91,
+                 'isppa': 190.1,
+                 'ispta': 720.1,
+                 'voltage': 1.01}
+
+# Acoustic Dose
+DOSE_MI_THRESHOLD = 1.91
+DOSE_LIMITS = {'on_time_s': None,
+               'energy_j_cm2': None,
+               'time_above_mi_s': None,
+               'ispta_s': None}
+
+# Hardware Watchdog
+WATCHDOG_INTERVAL_S = 0.5
+WATCHDOG_BUDGET = 0.02
+WATCHDOG_MAX_LATENCY_S = 0.05
+
+# Instrument I/O (timeout of each transaction, retries of reads, backoff before a retry, reconnection)
+IO_TIMEOUT_S = 2.0
+IO_RETRIES = 2
+IO_BACKOFF_S = 0.05
+IO_BACKOFF_MAX_S = 1.0
+RECONNECT_ATTEMPTS = 3
+
 DURATIONS_S = (5, 30, 60 * 1, 60 * 2, 60 * 5, 60 * 10, 60 * 15)
 DURATION_S = 120
 
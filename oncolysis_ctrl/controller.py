@@ -8,56 +8,113 @@ the connections and communication to the hardware, translating high level instru
 low level commands. The ControlQueue object provides a thread-safe interface to the Controller, 
 which is necessary for the GUI. The control_loop function is the main loop for the ControlQueue,
 processing the commands entered in the Queue and issuing them to the Controller. 
+
+Instrument I/O is bounded by the timeouts and retries of a `transport.RetryPolicy` shared by the
+devices. When a transport error persists, the control loop calls `Controller.recover`, which
+reconnects the sessions and reconciles the hardware, and runs the interrupted action again.
 """
+import concurrent.futures
 import queue
 import tkinter.messagebox
 from multiprocessing import Queue
 from threading import Thread
-from oncolysis_ctrl import config, rf_switch, function_generator
+from oncolysis_ctrl import config, rf_switch, function_generator, dose, clock, watchdog, reconcile, calibration, \
+    envelope, tracing, channel_state, transport
 import logging
-import time
 import numpy as np
+import time
 import traceback
 logger = logging.getLogger("oc.controller")
 constants = config.constants
 PRESSURE = constants.POWER_SETTINGS[constants.POWER_MODE]['default']
+# Interval at which the control loop checks the treatment time and dose limits while treating (s)
+POLL_INTERVAL_S = 0.1
+# Stages of `Controller.open`, reported to the progress callback
+OPEN_STAGES = {'enumerate': 'Finding instruments...',
+               'open_fgen': 'Function generator connected',
+               'open_switches': 'RF switches connected',
+               'configure': 'Configuring...'}
+
+
+def get_hardware_id(constants, rf_switch_sn=None):
+    """
+    Identify the hardware used by a configuration
+    :param constants: constants module of the configuration
+    :param rf_switch_sn: serial numbers of the RF switches (None for those of the configuration)
+    :return: tuple of function generator and RF switch identifiers, comparable to `Controller.get_hardware_id()`
+    """
+    if rf_switch_sn is None:
+        rf_switch_sn = constants.RADIALL_SN
+    return (constants.RIGOL_DG4162_VID, constants.RIGOL_DG4162_PID, tuple(constants.CHANNELS),
+            constants.TRANSMIT_CHANNEL,
+            tuple((constants.RADIALL_VID, constants.RADIALL_PID, sn) for sn in rf_switch_sn))
+
+
+def ask_simulate():
+    """
+    Ask the user whether to continue in simulation mode after a connection failure
+    :return: True to continue in simulation mode
+    """
+    msgbox = tkinter.messagebox.askquestion('Could not connect to hardware',
+                                            'Open in simulation mode?',
+                                            icon='warning')
+    return msgbox == 'yes'
 
 
 class Controller(object):
     """ 
     Controller class for the Oncolysis System    
     """
-    def __init__(self, frequencies=constants.FREQUENCIES_KHZ, pressure=PRESSURE,
-                 duration=constants.DURATION_S, transmit_channel=constants.TRANSMIT_CHANNEL,
+    def __init__(self, frequencies=constants.FREQUENCIES_KHZ, frequency_options=constants.FREQUENCIES_KHZ,
+                 pressure=PRESSURE, duration=constants.DURATION_S, transmit_channel=constants.TRANSMIT_CHANNEL,
                  rf_switch_settings=constants.RF_SWITCH_SETTINGS, rf_switch_sn=constants.RADIALL_SN,
+                 fgen_resource=None,
                  burst_params=constants.BURST_PARAMS_TEMPLATE, burst_length=constants.BURST_LENGTH,
-                 power_mode=constants.POWER_MODE,
+                 burst_lengths=constants.BURST_LENGTHS, duty_cycles=constants.BURST_DUTY_CYCLES,
+                 power_mode=constants.POWER_MODE, power_settings=constants.POWER_SETTINGS,
                  source_params_template=constants.SOURCE_PARAMS_TEMPLATE,
                  burst_params_template=constants.BURST_PARAMS_TEMPLATE,
                  burst_duty_cycle=constants.BURST_DUTY_CYCLE, amplifier_gain=constants.AMPLIFIER_GAIN,
-                 voltage_calibration=constants.CALIB, simulate=False):
+                 voltage_calibration=constants.CALIB, safety_limits=constants.SAFETY_LIMITS,
+                 dose_limits=constants.DOSE_LIMITS,
+                 dose_mi_threshold=constants.DOSE_MI_THRESHOLD, simulate=False, ask_simulate=ask_simulate,
+                 clock=clock.REAL_CLOCK, history=None):
         """
         Controller constructor
 
         :param frequencies: list of frequencies to treat
+        :param frequency_options: frequencies of the configuration (tabulated in the safety envelope)
         :param pressure: pressure to treat at
         :param duration: duration of treatment
         :param transmit_channel: channel to transmit on
         :param rf_switch_settings: settings for the RF Switch
         :param rf_switch_sn: serial number of the RF Switch
+        :param fgen_resource: VISA resource name of the function generator (None to search by USB ID)
         :param burst_params: burst parameters
         :param burst_length: burst length
+        :param burst_lengths: burst length options (tabulated in the safety envelope)
+        :param duty_cycles: duty cycle options (tabulated in the safety envelope)
         :param power_mode: power mode
+        :param power_settings: allowed power modes and their ranges
         :param source_params_template: source parameters
         :param burst_params_template: burst parameters
         :param burst_duty_cycle: burst duty cycle
         :param amplifier_gain: amplifier gain
         :param voltage_calibration: voltage calibration
+        :param safety_limits: limits of MI, ISPPA (W/cm2), ISPTA (mW/cm2) and function generator voltage (V)
+        :param dose_limits: cumulative dose limits for a session
+        :param dose_mi_threshold: MI threshold for accumulating time above MI
         :param simulate: simulate hardware
+        :param ask_simulate: function called when the hardware cannot be connected, returning True to
+                             continue in simulation mode (None to never fall back to simulation).
+                             It is called from the thread running `open`.
+        :param clock: time source for treatment timing (a `clock.VirtualClock` requires simulate=True)
+        :param history: `history.RunStore` recording the runs (None to not record them)
         """
-        self.fgen = function_generator.FunctionGenerator()
+        self.io_policy = transport.RetryPolicy()
+        self.fgen = function_generator.FunctionGenerator(resource=fgen_resource, policy=self.io_policy)
         self.xmit = self.fgen.channels[transmit_channel]
-        self.switches = tuple(rf_switch.RFSwitch(sn=sn) for sn in rf_switch_sn)
+        self.switches = tuple(rf_switch.RFSwitch(sn=sn, policy=self.io_policy) for sn in rf_switch_sn)
         self.rf_switch_settings = rf_switch_settings
         self.frequencies = frequencies
         self.power_value = pressure
@@ -67,42 +124,84 @@ class Controller(object):
         self.is_connected = False
         self.connection_error = False
         self.simulate = simulate
+        self.ask_simulate = ask_simulate
+        self.clock = clock
         self.frequency = None
         self.treat_time_start = None
         self.treat_time_elapsed = 0
         self.treat_on = False
         self.power_mode = power_mode
+        self.power_settings = power_settings
         self.voltage = 0
         self.source_params_template = source_params_template
         self.burst_params_template = burst_params_template
         self.burst_duty_cycle = burst_duty_cycle
         self.amplifier_gain = amplifier_gain
         self.voltage_calibration = voltage_calibration
+        self.calibration = calibration.Calibration(voltage_calibration)
+        self.safety_limits = safety_limits
+        self.build_envelope(frequency_options, burst_lengths, duty_cycles)
+        self.dose = dose.DoseIntegrator(mi_threshold=dose_mi_threshold, limits=dose_limits)
+        self.watchdog = watchdog.HealthWatchdog(self)
+        self.reconcile_report = None
+        self.history = history
+        self.run_id = None
+        self.run_active = False
+        self.run_notes = ''
         self.update_voltage()
 
-    def open(self):
+    @tracing.traced('open')
+    def open(self, progress=None):
         """
-        Open Connection to Hardware
+        Open Connection to Hardware. The function generator and the RF switches are opened concurrently.
+        :param progress: function called with the name of each stage of the connection (see `OPEN_STAGES`)
         :return: None
         """
+        def report(stage):
+            logger.info('[open] %s', OPEN_STAGES[stage])
+            if progress is not None:
+                progress(stage)
+
+        def open_fgen():
+            with tracing.span('open.fgen'):
+                self.fgen.open()
+            report('open_fgen')
+
+        def open_switches():
+            with tracing.span('open.switches'):
+                for switch in self.switches:
+                    switch.open()
+            report('open_switches')
+
         if self.is_connected:
             logger.error('[disconnect] Already Connected')
+        elif self.clock.virtual and not self.simulate:
+            raise RuntimeError('[open] A virtual clock can only be used in simulation mode')
         else:
             self.connection_error = False
             if not self.simulate:
+                t0 = time.perf_counter()
                 try:
-                    self.fgen.open()
-                    self.xmit.set_output(enabled=False)
-                    self.xmit.apply(**self.source_params_template)
-                    self.xmit.set_burst(**self.burst_params_template)
-                    for switch in self.switches:
-                        switch.open()
-                    logger.info('[open] Connected')
+                    report('enumerate')
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='open') as executor:
+                        fgen_future = executor.submit(open_fgen)
+                        switches_future = executor.submit(open_switches)
+                    # Raise the function generator error first, as when the devices were opened in turn
+                    fgen_future.result()
+                    switches_future.result()
+                    with tracing.span('open.reconcile'):
+                        report('configure')
+                        source_params, burst_params, switch_positions = self.get_desired_state()
+                        self.reconcile_report = reconcile.reconcile(self.xmit, source_params, burst_params,
+                                                                    switches=self.switches,
+                                                                    switch_positions=switch_positions)
+                    logger.info('[open] Connected in %.0f ms', (time.perf_counter() - t0) * 1e3)
                 except ConnectionError as e:
-                    msgbox = tkinter.messagebox.askquestion('Could not connect to hardware',
-                                                            'Open in simulation mode?',
-                                                            icon='warning')
-                    if msgbox == 'yes':
+                    # The other devices were opened concurrently: release them
+                    for device in (self.fgen,) + self.switches:
+                        if device.is_open:
+                            device.close()
+                    if self.ask_simulate is not None and self.ask_simulate():
                         logger.warning('[open] Could not connect to hardware. Opening in simulation mode')
                         self.simulate = True
                     else:
@@ -110,6 +209,171 @@ class Controller(object):
                         self.connection_error = True
             self.is_connected = True
 
+    def get_desired_state(self):
+        """
+        Get the hardware state the controller expects, for reconciliation on connect.
+        The output is always expected to be disabled.
+
+        :return: (source parameters, burst parameters, RF switch positions)
+        """
+        source_params = dict(self.source_params_template)
+        burst_params = dict(self.burst_params_template)
+        switch_positions = ()
+        if self.frequency is not None:
+            burst_length = self.calc_burst_length(self.frequency)
+            source_params.update(frequency=self.frequency * 1e3, amplitude=float(self.voltage))
+            burst_params.update(cycles=int(burst_length * 1e3 * self.frequency), period=self.burst_params['period'])
+            switch_positions = self.get_switch_positions(self.frequency) or ()
+        return source_params, burst_params, switch_positions
+
+    def get_hardware_id(self):
+        """
+        Identify the hardware this controller connects to
+        :return: tuple of function generator and RF switch identifiers
+        """
+        return (self.fgen.vid, self.fgen.pid, tuple(self.fgen.channels), self.xmit.channel,
+                tuple((switch.target_port['vid'], switch.target_port['pid'], switch.target_port['sn'])
+                      for switch in self.switches))
+
+    def set_constants(self, constants, rf_switch_sn=None):
+        """
+        Switch to a new configuration in place.
+
+        Treatment settings, calibration and switch mappings are reset to the configuration's
+        defaults. If the configuration uses the same hardware, the function generator and RF switch
+        objects (and any open sessions) are kept; otherwise they are replaced, which requires the
+        controller to be disconnected.
+
+        :param constants: constants module of the new configuration
+        :param rf_switch_sn: serial numbers of the RF switches, for a rig whose switches are not those
+                             of the configuration (None for those of the configuration)
+        :return: True if the hardware objects were kept
+        """
+        if self.treat_on:
+            raise RuntimeError('[set_constants] Cannot change configuration during treatment')
+        if rf_switch_sn is None:
+            rf_switch_sn = constants.RADIALL_SN
+        hardware_id = get_hardware_id(constants, rf_switch_sn)
+        keep_hardware = hardware_id == self.get_hardware_id()
+        if not keep_hardware:
+            if self.is_connected:
+                raise RuntimeError('[set_constants] Disconnect before switching to a configuration with other hardware')
+            self.fgen = function_generator.FunctionGenerator(vid=constants.RIGOL_DG4162_VID,
+                                                             pid=constants.RIGOL_DG4162_PID,
+                                                             channels=constants.CHANNELS,
+                                                             max_voltage=constants.MAX_VOLTAGE,
+                                                             resource=self.fgen.resource,
+                                                             policy=self.io_policy)
+            self.xmit = self.fgen.channels[constants.TRANSMIT_CHANNEL]
+            self.switches = tuple(rf_switch.RFSwitch(sn=sn, vid=constants.RADIALL_VID, pid=constants.RADIALL_PID,
+                                                     policy=self.io_policy)
+                                  for sn in rf_switch_sn)
+        for channel in self.fgen.channels.values():
+            channel.max_voltage = constants.MAX_VOLTAGE
+        self.rf_switch_settings = constants.RF_SWITCH_SETTINGS
+        self.frequencies = [f for f in self.frequencies if f in constants.FREQUENCIES_KHZ]
+        self.frequency = None
+        self.power_mode = constants.POWER_MODE
+        self.power_settings = constants.POWER_SETTINGS
+        self.power_value = constants.POWER_SETTINGS[constants.POWER_MODE]['default']
+        self.burst_params = constants.BURST_PARAMS_TEMPLATE
+        self.burst_length = constants.BURST_LENGTH
+        self.duration = constants.DURATION_S
+        self.source_params_template = constants.SOURCE_PARAMS_TEMPLATE
+        self.burst_params_template = constants.BURST_PARAMS_TEMPLATE
+        self.burst_duty_cycle = constants.BURST_DUTY_CYCLE
+        self.amplifier_gain = constants.AMPLIFIER_GAIN
+        self.voltage_calibration = constants.CALIB
+        self.calibration = calibration.Calibration(constants.CALIB)
+        self.safety_limits = constants.SAFETY_LIMITS
+        self.build_envelope(constants.FREQUENCIES_KHZ, constants.BURST_LENGTHS, constants.BURST_DUTY_CYCLES)
+        self.dose = dose.DoseIntegrator(mi_threshold=constants.DOSE_MI_THRESHOLD, limits=constants.DOSE_LIMITS)
+        self.watchdog.interval = constants.WATCHDOG_INTERVAL_S
+        self.watchdog.budget = constants.WATCHDOG_BUDGET
+        self.watchdog.max_latency = constants.WATCHDOG_MAX_LATENCY_S
+        self.io_policy.timeout = constants.IO_TIMEOUT_S
+        self.io_policy.retries = constants.IO_RETRIES
+        self.io_policy.backoff_base = constants.IO_BACKOFF_S
+        self.io_policy.backoff_max = constants.IO_BACKOFF_MAX_S
+        self.io_policy.reconnect_attempts = constants.RECONNECT_ATTEMPTS
+        self.update_voltage()
+        logger.info(f'[set_constants] Loaded configuration {constants.ID} '
+                    f'({"kept" if keep_hardware else "replaced"} hardware connections)',
+                    extra={'event': 'config', 'config_id': constants.ID})
+        return keep_hardware
+
+    def reconcile(self):
+        """
+        Bring the connected hardware to the state expected by the controller
+        :return: ReconcileReport, or None if not connected to hardware
+        """
+        if not self.is_connected or self.simulate or self.connection_error:
+            return None
+        source_params, burst_params, switch_positions = self.get_desired_state()
+        self.reconcile_report = reconcile.reconcile(self.xmit, source_params, burst_params,
+                                                    switches=self.switches,
+                                                    switch_positions=switch_positions)
+        return self.reconcile_report
+
+    def reconnect(self):
+        """
+        Drop the hardware sessions and open them again, without writing to the instruments first
+        :return: None
+        """
+        with tracing.span('reconnect.fgen'):
+            self.fgen.reconnect()
+        with tracing.span('reconnect.switches'):
+            for switch in self.switches:
+                switch.reconnect()
+
+    @tracing.traced('recover')
+    def recover(self, err):
+        """
+        Reconnect to the hardware after a transport error, and bring it back to the state expected by
+        the controller. A treatment segment in progress ends when the error is handled, and a new one
+        starts once the hardware is reconciled, so the time spent recovering is not counted as
+        treatment time.
+
+        :param err: the transport error
+        :return: None
+        :raises transport.TransportError: if the hardware could not be reconnected
+        """
+        if not self.is_connected or self.simulate or self.connection_error:
+            raise err
+        logger.error(f'[recover] Transport error: {err!r}. Reconnecting',
+                     extra={'event': 'recover', 'error': repr(err)})
+        if type(err) is not transport.TransportError:
+            # Failed reads were counted by the retry policy, before raising a TransportError
+            self.io_policy.count_error(err)
+        t0 = time.perf_counter()
+        was_treating = self.treat_on
+        if was_treating:
+            # The output state is unknown until the hardware is reconciled, which disables it
+            self.stop_treatment(reset_timer=False, disable_output=False)
+        attempts = max(self.io_policy.reconnect_attempts, 1)
+        ok = False
+        try:
+            for attempt in range(attempts):
+                try:
+                    self.reconnect()
+                    self.reconcile()
+                    ok = True
+                    break
+                except Exception as e:
+                    if not (transport.is_transient(e) or isinstance(e, ConnectionError)):
+                        raise
+                    logger.warning(f'[recover] Attempt {attempt + 1} of {attempts} failed: {e!r}')
+                    if attempt + 1 == attempts:
+                        raise transport.TransportError(f'Could not reconnect after {attempts} attempts: {e!r}') from e
+                    time.sleep(self.io_policy.backoff(attempt))
+        finally:
+            elapsed = time.perf_counter() - t0
+            self.io_policy.record_recovery(elapsed, ok, err)
+        logger.info('[recover] Reconnected in %.0f ms', elapsed * 1e3,
+                    extra={'event': 'recovered', 'recovery_ms': elapsed * 1e3})
+        if was_treating:
+            self.start_treatment(reset_timer=False)
+
     def close(self):
         """
         Close Connection to Hardware
@@ -138,9 +402,49 @@ class Controller(object):
         :param frequencies: list of frequencies to treat
         :return: None
         """
+        for frequency in frequencies:
+            self.calibration.check(frequency)
         self.frequencies = frequencies
         logger.info(f'[set_frequencies] Set frequencies to {frequencies}')
 
+    def build_envelope(self, frequencies, burst_lengths, duty_cycles):
+        """
+        Precompute the safe operating envelope for the current calibration and power settings
+        :param frequencies: frequency options (kHz)
+        :param burst_lengths: burst length options (s)
+        :param duty_cycles: duty cycle options
+        :return: None
+        """
+        self.envelope = envelope.SafetyEnvelope(self.calibration, frequencies, self.power_settings, burst_lengths,
+                                                duty_cycles, self.safety_limits, self.amplifier_gain,
+                                                self.xmit.max_voltage)
+
+    def check_envelope(self):
+        """
+        Check the treatment settings against the safe operating envelope
+        :return: list of (frequency, maximum power value, binding constraint) for each frequency where
+                 the power setting is too high
+        """
+        violations = self.envelope.check(self.frequencies, self.power_mode, self.power_value, self.burst_length,
+                                         self.burst_duty_cycle)
+        for frequency, max_value, binding in violations:
+            logger.error(f'[check_envelope] {frequency} kHz: power {self.power_value} exceeds {max_value:0.4g} '
+                         f'({binding} limit)')
+        return violations
+
+    def get_switch_positions(self, frequency_khz):
+        """
+        Get the RF switch positions for a frequency. Frequencies between the mapped ones use the
+        positions of the nearest mapped frequency (in log-frequency).
+        :param frequency_khz: frequency (kHz)
+        :return: tuple of switch positions, or None if no frequencies are mapped
+        """
+        positions = self.rf_switch_settings.get(frequency_khz)
+        if positions is None and frequency_khz is not None and self.rf_switch_settings:
+            nearest = min(self.rf_switch_settings, key=lambda f: abs(np.log(f / frequency_khz)))
+            positions = self.rf_switch_settings[nearest]
+        return positions
+
     def set_frequency(self, frequency_khz):
         """
         Set frequency to treat
@@ -150,33 +454,50 @@ class Controller(object):
         if not self.is_ready():
             logger.error(f'[set_frequency] device not ready')
             raise ConnectionError('device not ready')
-        self.frequency = frequency_khz
-        self.update_voltage()
-        burst_length = self.calc_burst_length(frequency_khz)
-        burst_cycles = int(burst_length * 1e3 * frequency_khz)
-        burst_period = self.burst_params['period']
-        logger.info(f'[set_frequency] Set frequency to {frequency_khz} kHz')
-        logger.info(f'[set_frequency] set voltage to {self.voltage:0.3f} V')
-        logger.info(f'[set_frequency] set burst to {burst_cycles} cycles ({burst_length*1e3:0.3g} ms),'
-                    f'period={burst_period*1e3:0.4g} ms')
-        if not self.simulate:
-            if frequency_khz in self.rf_switch_settings:
-                for switch, position in zip(self.switches, self.rf_switch_settings[frequency_khz]):
-                    switch.set_position(position)
-            else:
-                logger.warning(f"[set_frequency] Unmapped frequency {frequency_khz}. Can't set RF Switch")
-            self.xmit.set_frequency(frequency=frequency_khz * 1e3)
-            self.xmit.set_voltage(voltage=self.voltage)
-            self.xmit.set_burst(cycles=burst_cycles,
-                                period=burst_period)
-            settings = self.xmit.get_settings()
-            logger.info('[set_frequency] Verify source settings:')
-            for key, val in settings.items():
-                logger.info(f'[set_frequency]     {key} = {val}')
-            burst = self.xmit.get_burst()
-            logger.info('[set_frequency] Verify burst settings:')
-            for key, val in burst.items():
-                logger.info(f'[set_frequency]     {key} = {val}')
+        t0 = time.perf_counter()
+        with tracing.span('set_frequency', frequency_khz=frequency_khz):
+            self.frequency = frequency_khz
+            with tracing.span('set_frequency.calc'):
+                self.update_voltage()
+                burst_length = self.calc_burst_length(frequency_khz)
+                burst_cycles = int(burst_length * 1e3 * frequency_khz)
+                burst_period = self.burst_params['period']
+            logger.info('[set_frequency] Set frequency to %s kHz', frequency_khz)
+            logger.info('[set_frequency] set voltage to %0.3f V', self.voltage)
+            logger.info('[set_frequency] set burst to %d cycles (%0.3g ms),period=%0.4g ms',
+                        burst_cycles, burst_length * 1e3, burst_period * 1e3)
+            if not self.simulate:
+                with tracing.span('set_frequency.switch'):
+                    positions = self.get_switch_positions(frequency_khz)
+                    if positions is None:
+                        logger.warning(f"[set_frequency] Unmapped frequency {frequency_khz}. Can't set RF Switch")
+                    else:
+                        if frequency_khz not in self.rf_switch_settings:
+                            logger.info('[set_frequency] %s kHz is not mapped. Using switch positions %s',
+                                        frequency_khz, positions)
+                        for switch, position in zip(self.switches, positions):
+                            switch.set_position(position)
+                with tracing.span('set_frequency.fgen_write'):
+                    self.xmit.set_state(channel_state.ChannelState(frequency=frequency_khz * 1e3,
+                                                                   amplitude=float(self.voltage),
+                                                                   burst_cycles=burst_cycles,
+                                                                   burst_period=burst_period))
+                with tracing.span('set_frequency.verify'):
+                    settings = self.xmit.get_settings()
+                    burst = self.xmit.get_burst()
+                with tracing.span('set_frequency.log'):
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info('[set_frequency] Verify source settings:')
+                        for key, val in settings.items():
+                            logger.info('[set_frequency]     %s = %s', key, val)
+                        logger.info('[set_frequency] Verify burst settings:')
+                        for key, val in burst.items():
+                            logger.info('[set_frequency]     %s = %s', key, val)
+            latency_ms = (time.perf_counter() - t0) * 1e3
+            logger.info('[set_frequency] Transition to %s kHz took %0.2f ms', frequency_khz, latency_ms,
+                        extra={'event': 'transition', 'frequency_khz': frequency_khz, 'voltage': self.voltage,
+                               'burst_cycles': burst_cycles, 'burst_period_s': burst_period,
+                               'latency_ms': latency_ms})
 
     def set_pressure(self, pressure):
         """
@@ -189,9 +510,9 @@ class Controller(object):
             raise ConnectionError('device not ready')
         self.power_value = pressure
 
-        logger.info(f'[set_pressure] Pressure={pressure}, Voltage={self.voltage}')
+        logger.info('[set_pressure] Pressure=%s, Voltage=%s', pressure, self.voltage)
         if not self.simulate:
-            self.xmit.set_voltage(voltage=self.voltage)
+            self.xmit.set_state(channel_state.ChannelState(amplitude=float(self.voltage)))
 
     def update_voltage(self):
         """
@@ -199,10 +520,10 @@ class Controller(object):
         :return: None
         """
         pressure_target = self.calc_pressure_target(self.frequency, self.power_value)
-        logger.info(f'[update_voltage] target pressure: {pressure_target} kPa')
+        logger.info('[update_voltage] target pressure: %s kPa', pressure_target)
         target_voltage = self.calc_voltage(self.frequency, pressure_target)
         amplified_voltage = target_voltage * self.amplifier_gain
-        logger.info(f'[update_voltage] output voltage:{amplified_voltage: 0.1f} V, input_voltage:{target_voltage: 0.3f} V')
+        logger.info('[update_voltage] output voltage:% 0.1f V, input_voltage:% 0.3f V', amplified_voltage, target_voltage)
         self.voltage = target_voltage
 
     def calc_voltage(self, frequency, pressure_target):
@@ -214,8 +535,9 @@ class Controller(object):
         """
         if frequency is None:
             return 0
-        a = self.voltage_calibration[frequency]['coeff_a']
-        b = self.voltage_calibration[frequency]['coeff_b']
+        calib = self.calibration.get(frequency)
+        a = calib['coeff_a']
+        b = calib['coeff_b']
         c = -1 * pressure_target
         amplified_voltage = np.round((-b + np.sqrt(b ** 2 - 4 * a * c)) / (2 * a), 2)
         target_voltage = amplified_voltage / self.amplifier_gain
@@ -231,14 +553,14 @@ class Controller(object):
         if frequency is None:
             return 0
         if self.power_mode == 'constant_mi':
-            pressure_target = value / 100 * self.voltage_calibration[frequency]['p_ref']
+            pressure_target = value / 100 * self.calibration.get(frequency)['p_ref']
         elif self.power_mode == 'constant_pressure':
             pressure_target = value
         elif self.power_mode == 'constant_ispta':
             isppa = value*1e-3 / self.burst_duty_cycle # W/cm2
             pressure_target = np.sqrt(isppa*3e6)*1e-1
         elif self.power_mode == 'constant_ispta_mi100':
-            pressure_target = self.voltage_calibration[frequency]['p_ref']
+            pressure_target = self.calibration.get(frequency)['p_ref']
         elif  self.power_mode == 'constant_isppa':
             isppa = value
             pressure_target = np.sqrt(isppa*3e6)*1e-1
@@ -246,6 +568,88 @@ class Controller(object):
             raise ValueError(f'Bad power mode {self.power_mode}')
         return pressure_target
 
+    def calc_acoustic_params(self, frequency):
+        """
+        Calculate the acoustic output parameters at a frequency for the current power settings
+        :param frequency: frequency to treat at
+        :return: dict of pressure (kPa), mi, isppa (W/cm2), ispta (mW/cm2), voltage (V),
+                 burst_length (s), period (s), duty_cycle and the relative uncertainty of the voltage
+                 calibration at the frequency (0 at calibrated frequencies)
+        """
+        pressure_target = self.calc_pressure_target(frequency, self.power_value)
+        voltage_target = self.calc_voltage(frequency, pressure_target)
+        mi = pressure_target * 1e-3 / np.sqrt(frequency * 1e-3)
+        isppa = (pressure_target * 1e3) ** 2 / 3e6 / 1e4
+        adjusted_burst_length = self.calc_burst_length(frequency)
+        period = self.burst_length / self.burst_duty_cycle
+        adjusted_duty_cycle = adjusted_burst_length / period
+        ispta = isppa * adjusted_duty_cycle * 1e3
+        return {'pressure': pressure_target,
+                'mi': mi,
+                'isppa': isppa,
+                'ispta': ispta,
+                'voltage': voltage_target,
+                'burst_length': adjusted_burst_length,
+                'period': period,
+                'duty_cycle': adjusted_duty_cycle,
+                'uncertainty': self.calibration.get_uncertainty(frequency)['voltage']}
+
+    def calc_acoustic_params_array(self, frequencies, power_value=None, power_mode=None, burst_length=None,
+                                   duty_cycle=None, calib=None):
+        """
+        Calculate the acoustic output parameters at many frequencies at once, as `calc_acoustic_params`
+        :param frequencies: array of frequencies
+        :param power_value: power setting, or array broadcast with the frequencies (default: the current setting)
+        :param power_mode: power mode (default: the current mode)
+        :param burst_length: burst length (s), or array broadcast with the frequencies (default: the current setting)
+        :param duty_cycle: duty cycle, or array broadcast with the frequencies (default: the current setting)
+        :param calib: calibration at the frequencies, as returned by `Calibration.evaluate` (None to evaluate it)
+        :return: dict of arrays of pressure (kPa), mi, isppa (W/cm2), ispta (mW/cm2), voltage (V),
+                 burst_length (s), period (s) and duty_cycle
+        """
+        power_value = np.asarray(self.power_value if power_value is None else power_value, dtype=float)
+        power_mode = self.power_mode if power_mode is None else power_mode
+        burst_length = np.asarray(self.burst_length if burst_length is None else burst_length, dtype=float)
+        duty_cycle = np.asarray(self.burst_duty_cycle if duty_cycle is None else duty_cycle, dtype=float)
+        frequencies = np.asarray(frequencies, dtype=float)
+        shape = np.broadcast(frequencies, power_value, burst_length, duty_cycle).shape
+        if calib is None:
+            calib = self.calibration.evaluate(frequencies)
+        if power_mode == 'constant_mi':
+            pressure_target = power_value / 100 * calib['p_ref']
+        elif power_mode == 'constant_pressure':
+            pressure_target = power_value
+        elif power_mode == 'constant_ispta':
+            pressure_target = np.sqrt(power_value * 1e-3 / duty_cycle * 3e6) * 1e-1
+        elif power_mode == 'constant_ispta_mi100':
+            pressure_target = calib['p_ref']
+        elif power_mode == 'constant_isppa':
+            pressure_target = np.sqrt(power_value * 3e6) * 1e-1
+        else:
+            raise ValueError(f'Bad power mode {power_mode}')
+        pressure_target = np.broadcast_to(pressure_target, shape)
+        a = calib['coeff_a']
+        b = calib['coeff_b']
+        amplified_voltage = np.round((-b + np.sqrt(b ** 2 + 4 * a * pressure_target)) / (2 * a), 2)
+        voltage_target = amplified_voltage / self.amplifier_gain
+        mi = pressure_target * 1e-3 / np.sqrt(frequencies * 1e-3)
+        isppa = (pressure_target * 1e3) ** 2 / 3e6 / 1e4
+        period = np.broadcast_to(burst_length / duty_cycle, shape)
+        if power_mode == 'constant_ispta_mi100':
+            adjusted_burst_length = period * power_value * 1e-3 / isppa
+        else:
+            adjusted_burst_length = np.broadcast_to(burst_length, shape)
+        adjusted_duty_cycle = adjusted_burst_length / period
+        ispta = isppa * adjusted_duty_cycle * 1e3
+        return {'pressure': pressure_target,
+                'mi': mi,
+                'isppa': isppa,
+                'ispta': ispta,
+                'voltage': voltage_target,
+                'burst_length': adjusted_burst_length,
+                'period': period,
+                'duty_cycle': adjusted_duty_cycle}
+
     def calc_burst_length(self, frequency):
         """
         Calculate burst length based on frequency and power settings
@@ -255,7 +659,7 @@ class Controller(object):
         if frequency is None:
             return self.burst_length
         if self.power_mode == 'constant_ispta_mi100':
-            pressure_kpa = self.voltage_calibration[frequency]['p_ref']  # Pressure @ MI1.9
+            pressure_kpa = self.calibration.get(frequency)['p_ref']  # Pressure @ MI1.9
             isppa = (pressure_kpa*1e3)**2 / 3e6/1e4
             ispta = self.power_value
             max_burst_length = self.burst_length
@@ -295,6 +699,82 @@ class Controller(object):
         self.duration = duration
         logger.info(f'[set_duration] Set duration to {duration}')
 
+    def configure(self, frequencies=None, power_mode=None, power_value=None, duration=None,
+                  burst_length=None, duty_cycle=None, simulate=None):
+        """
+        Update several treatment settings at once. Settings left as None are unchanged.
+
+        :param frequencies: list of frequencies to treat
+        :param power_mode: power mode
+        :param power_value: power setting (in the units of the power mode)
+        :param duration: duration of treatment at each frequency (s)
+        :param burst_length: burst length (s)
+        :param duty_cycle: burst duty cycle
+        :param simulate: simulate hardware (only while disconnected)
+        :return: None
+        :raises envelope.EnvelopeError: if the settings exceed the safe operating envelope (no
+                                        setting is changed)
+        """
+        if self.treat_on or self.run_active or self.run_id is not None:
+            raise RuntimeError('[configure] Cannot configure while a run is in progress')
+        if simulate is not None and self.is_connected and bool(simulate) != self.simulate:
+            raise RuntimeError('[configure] Cannot change simulation mode while connected')
+        if power_mode is not None and power_mode not in self.power_settings:
+            raise ValueError(f'Bad power mode {power_mode}')
+        if frequencies is not None:
+            frequencies = list(frequencies)
+            for frequency in frequencies:
+                self.calibration.check(frequency)
+        new_value = self.power_value if power_value is None else power_value
+        violations = self.envelope.check(self.frequencies if frequencies is None else frequencies,
+                                         self.power_mode if power_mode is None else power_mode,
+                                         new_value,
+                                         self.burst_length if burst_length is None else burst_length,
+                                         self.burst_duty_cycle if duty_cycle is None else duty_cycle)
+        if violations:
+            frequency, max_value, binding = violations[0]
+            raise envelope.EnvelopeError(f'[configure] Power {new_value} exceeds the safety envelope at '
+                                         f'{frequency} kHz (maximum {max_value:0.4g}, {binding} limit)')
+        if simulate is not None:
+            self.simulate = bool(simulate)
+        if power_mode is not None:
+            self.power_mode = power_mode
+        if power_value is not None:
+            self.power_value = power_value
+        if burst_length is not None:
+            self.set_burst_length(burst_length)
+        if duty_cycle is not None:
+            self.set_duty_cycle(duty_cycle)
+        if duration is not None:
+            self.set_duration(duration)
+        if frequencies is not None:
+            self.set_frequencies(frequencies)
+        self.update_voltage()
+
+    def get_status(self):
+        """
+        Get a snapshot of the controller state
+        :return: dict of state values
+        """
+        return {'is_connected': self.is_connected,
+                'is_ready': self.is_ready(),
+                'connection_error': self.connection_error,
+                'simulate': self.simulate,
+                'treat_on': self.treat_on,
+                'treat_time': self.check_treatment_time(),
+                'frequency': self.frequency,
+                'frequencies': list(self.frequencies),
+                'power_mode': self.power_mode,
+                'power_value': self.power_value,
+                'duration': self.duration,
+                'burst_length': self.burst_length,
+                'duty_cycle': self.burst_duty_cycle,
+                'voltage': float(self.voltage),
+                'dose': self.dose.get_session_totals(self.clock.time()),
+                'watchdog': self.watchdog.report(),
+                'transport': self.io_policy.report()}
+
+    @tracing.traced('start_treatment')
     def start_treatment(self, reset_timer=True):
         """
         Start treatment
@@ -305,13 +785,21 @@ class Controller(object):
             if self.treat_on:
                 logger.warning('[start_treatment] Already on')
             else:
-                logger.info(f'[start_treatment] Treating {self.frequency} kHz')
+                logger.info('[start_treatment] Treating %s kHz', self.frequency,
+                            extra={'event': 'treatment_start', 'frequency_khz': self.frequency,
+                                   'voltage': self.voltage, 'power_mode': self.power_mode,
+                                   'power_value': self.power_value})
+                # Enable the output first, so that the treatment does not start if it cannot be enabled
+                if not self.simulate:
+                    self.xmit.set_output(enabled=True)
                 if reset_timer or (self.treat_time_start is None):
                     self.treat_time_elapsed = 0
-                self.treat_time_start = time.time()
+                self.treat_time_start = self.clock.time()
                 self.treat_on = True
-                if not self.simulate:
-                    self.xmit.set_output(enabled=True)
+                if self.frequency is not None:
+                    params = self.calc_acoustic_params(self.frequency)
+                    self.dose.start_segment(self.frequency, self.treat_time_start,
+                                            mi=params['mi'], ispta=params['ispta'])
         else:
             logger.error(f'[start_treatment] device not ready')
             raise ConnectionError('[start_treatment] device not ready')
@@ -324,15 +812,18 @@ class Controller(object):
         if not self.treat_on:
             time_elapsed = self.treat_time_elapsed
         else:
-            segment_time = time.time() - self.treat_time_start
+            segment_time = self.clock.time() - self.treat_time_start
             time_elapsed = self.treat_time_elapsed + segment_time
         return time_elapsed
 
-    def stop_treatment(self, reset_timer=True, wait_for_time=0):
+    @tracing.traced('stop_treatment')
+    def stop_treatment(self, reset_timer=True, wait_for_time=0, disable_output=True):
         """
-        Stop treatment
+        Stop treatment. If the output cannot be disabled because of a transport error, the treatment
+        is still stopped, and the error raised after, for the hardware to be recovered.
         :param reset_timer: reset timer. Default True
         :param wait_for_time: wait for time. Default 0
+        :param disable_output: disable the output. Default True (False when the connection is lost)
         :return: None
         """
         if not self.treat_on:
@@ -341,24 +832,116 @@ class Controller(object):
             total_time_elapsed = self.check_treatment_time()
             if wait_for_time > total_time_elapsed:
                 logger.info(f'[stop_treatment] Waiting for treatment time to reach {wait_for_time:0.2f} s')
-                time.sleep(wait_for_time-total_time_elapsed)
-            if not self.simulate:
-                self.xmit.set_output(enabled=False)
+                wait_time = wait_for_time - total_time_elapsed
+                time_to_limit = self.dose.time_to_limit(self.clock.time())
+                if time_to_limit is not None and time_to_limit < wait_time:
+                    logger.warning(f'[stop_treatment] Dose limit reached after {time_to_limit:0.2f} s')
+                    wait_time = time_to_limit
+                with tracing.span('stop_treatment.wait', wait_s=wait_time):
+                    self.clock.sleep(wait_time)
+            error = None
+            if not self.simulate and disable_output:
+                try:
+                    self.xmit.set_output(enabled=False)
+                except Exception as err:
+                    if not transport.is_transient(err):
+                        raise
+                    error = err
+            t = self.clock.time()
+            self.dose.stop_segment(t)
+            if self.history is not None and self.run_id is not None and self.frequency is not None:
+                self.history.add_segment(self.run_id, self.frequency, self.treat_time_start,
+                                         t - self.treat_time_start, self.voltage)
             self.treat_on = False
-            logger.info(f'[stop_treatment] Stopped treatment (elapsed time: {total_time_elapsed:0.2f})')
+            logger.info('[stop_treatment] Stopped treatment (elapsed time: %0.2f)', total_time_elapsed,
+                        extra={'event': 'treatment_stop', 'frequency_khz': self.frequency,
+                               'elapsed_s': total_time_elapsed})
             if reset_timer:
                 logger.info(f'[stop_treatment] Resetting timer')
                 self.treat_time_elapsed = 0
                 self.treat_time_start = None
             else:
                 self.treat_time_elapsed = total_time_elapsed
+            if error is not None:
+                raise error
+
+    def begin_run(self):
+        """
+        Record the start of a run in the history, with the current settings. The settings cannot be
+        changed until the run ends.
+        :return: None
+        """
+        self.run_active = True
+        if self.history is not None:
+            protocol = {'frequencies': self.frequencies, 'power_mode': self.power_mode,
+                        'power_value': self.power_value, 'duration': self.duration,
+                        'burst_length': self.burst_length, 'duty_cycle': self.burst_duty_cycle}
+            self.run_id = self.history.start_run(config.config_id, protocol, simulate=self.simulate,
+                                                 notes=self.run_notes)
+
+    def end_run(self, status, error=None):
+        """
+        Record the end of the current run in the history
+        :param status: how the run ended
+        :param error: error message, if the run ended on an error
+        :return: None
+        """
+        if self.history is not None and self.run_id is not None:
+            self.history.end_run(self.run_id, status, error=error,
+                                 dose_totals=self.dose.get_session_totals(self.clock.time()))
+        self.run_id = None
+        self.run_active = False
+
+    def check_dose_limits(self):
+        """
+        Check the accumulated session dose against the cumulative limits
+        :return: list of dose fields that have reached their limit
+        """
+        return self.dose.check_limits(self.clock.time())
+
+
+def run_protocol(controller, protocol, on_treat=None, on_wait=None, on_end=None):
+    """
+    Run a protocol to completion on the calling thread
+
+    Opens the controller, runs the sequence and closes the controller again. With a simulated
+    controller using a `clock.VirtualClock`, this runs the full protocol in a fraction of its
+    real duration, with the same sequence of callbacks as a real-time run.
+
+    :param controller: controller object
+    :param protocol: dict of settings accepted by `Controller.configure`
+    :param on_treat: callback to execute on treat
+    :param on_wait: callback to execute on wait
+    :param on_end: callback to execute on end
+    :return: dict of session dose totals
+    """
+    commands = queue.Queue()
+    result = {}
+
+    def end(message='Treatment Complete'):
+        result['message'] = message
+        if on_end is not None:
+            on_end(message)
+        commands.put('KILL')
+
+    def error(err):
+        result['error'] = err
+
+    controller.configure(**protocol)
+    for command in ('OPEN', 'START'):
+        commands.put(command)
+    control_loop(controller, commands, on_treat=on_treat, on_wait=on_wait, on_end=end, on_error=error)
+    if 'error' in result:
+        raise result['error']
+    return controller.dose.get_session_totals()
 
 
 class ControlQueue:
     """
     Control Queue for Oncolysis System
     """
-    def __init__(self, controller, on_open=None, on_treat=None, on_wait=None, on_end=None, on_close=None, on_error=None):
+    def __init__(self, controller, on_open=None, on_treat=None, on_wait=None, on_end=None, on_close=None, on_error=None,
+                 on_progress=None):
         """
         Control Queue constructor
         :param controller: controller object
@@ -368,6 +951,7 @@ class ControlQueue:
         :param on_end: callback to execute on end
         :param on_close: callback to execute on close
         :param on_error: callback to execute on error
+        :param on_progress: callback to execute at each stage of opening the connection, with the stage name
         :return: None
         """
         self.controller = controller
@@ -378,6 +962,7 @@ class ControlQueue:
         self.on_end = on_end
         self.on_close = on_close
         self.on_error = on_error
+        self.on_progress = on_progress
         self.control_loop_thread = self.get_new_thread()
 
     def get_new_thread(self):
@@ -386,7 +971,8 @@ class ControlQueue:
         :return: [Thread] new thread
         """
         return Thread(target=control_loop, args=(self.controller, self.control_queue, self.on_open, self.on_treat,
-                                                 self.on_wait, self.on_end, self.on_close, self.on_error))
+                                                 self.on_wait, self.on_end, self.on_close, self.on_error,
+                                                 self.on_progress))
 
     def start_queue(self):
         """
@@ -395,6 +981,13 @@ class ControlQueue:
         """
         self.control_loop_thread.start()
 
+    def get_dose_totals(self, t=None):
+        """
+        :param t: current time (s). If None, the active segment is not included
+        :return: dict of session dose totals of the controller
+        """
+        return self.controller.dose.get_session_totals(t)
+
     def put(self, msg):
         """
         Put a message in the queue
@@ -448,6 +1041,12 @@ class ControlQueue:
         """
         self.put('TREAT')
 
+    def reconcile(self):
+        """
+        Submit a command to reconcile the hardware with the controller state
+        """
+        self.put('RECONCILE')
+
     def kill(self):
         """
         Submit a command to kill the thread
@@ -457,7 +1056,8 @@ class ControlQueue:
         self.control_loop_thread = self.get_new_thread()
 
 
-def control_loop(controller, control_queue, on_open=None, on_treat=None, on_wait=None, on_end=None, on_close=None, on_error=None):
+def control_loop(controller, control_queue, on_open=None, on_treat=None, on_wait=None, on_end=None, on_close=None, on_error=None,
+                 on_progress=None):
     """
     Control Loop for Oncolysis System
     
@@ -469,6 +1069,7 @@ def control_loop(controller, control_queue, on_open=None, on_treat=None, on_wait
     :param on_end: callback to execute on end
     :param on_close: callback to execute on close
     :param on_error: callback to execute on error
+    :param on_progress: callback to execute at each stage of opening the connection, with the stage name
     :return: None
     """
     logger.info('[control_loop] started')
@@ -481,70 +1082,123 @@ def control_loop(controller, control_queue, on_open=None, on_treat=None, on_wait
         """
         freq = controller.frequencies[index]
         controller.set_frequency(frequency_khz=freq)
-        logger.info(f'[control_loop] Starting {freq} kHz')
+        logger.info('[control_loop] Starting %s kHz', freq)
         controller.start_treatment(reset_timer=True)
         if on_treat is not None:
             on_treat(index)
 
+    def recovering(action, *args, **kwargs):
+        """
+        Run a controller action. After a transport error, recover the hardware and run it again.
+        :param action: controller method
+        :return: result of the action
+        """
+        try:
+            return action(*args, **kwargs)
+        except Exception as err:
+            if not transport.is_transient(err):
+                raise
+            controller.recover(err)
+            return action(*args, **kwargs)
+
     try:
         run_flag = False
         freq_index = 0
         while True:
             try:
-                command = control_queue.get(False)
+                if run_flag:
+                    command = controller.clock.get(control_queue, POLL_INTERVAL_S)
+                else:
+                    command = control_queue.get()
             except queue.Empty:
                 if run_flag:
-                    treat_time = controller.check_treatment_time()
-                    if on_wait is not None:
-                        on_wait(treat_time, controller.duration)
-                    if treat_time >= controller.duration:
-                        logger.info(f'[control_loop] {controller.frequency} kHz complete')
-                        controller.stop_treatment(reset_timer=True)
-                        freq_index += 1
-                        if freq_index < len(controller.frequencies):
-                            start_freq_index(freq_index)
-                        else:
-                            logger.info(f'[control_loop] Sequence complete')
+                    with tracing.span('control_loop.poll'):
+                        exceeded = controller.check_dose_limits()
+                        if exceeded:
+                            logger.warning(f'[control_loop] Dose limit reached ({", ".join(exceeded)}). Stopping')
+                            recovering(controller.stop_treatment, reset_timer=True)
+                            controller.end_run('Dose Limit Reached')
                             run_flag = False
                             if on_end is not None:
-                                on_end()
-                time.sleep(0.1)
+                                on_end('Dose Limit Reached')
+                            continue
+                        treat_time = controller.check_treatment_time()
+                        if on_wait is not None:
+                            on_wait(treat_time, controller.duration)
+                        recovering(controller.watchdog.poll, slack=controller.duration - treat_time)
+                        if treat_time >= controller.duration:
+                            logger.info('[control_loop] %s kHz complete', controller.frequency)
+                            recovering(controller.stop_treatment, reset_timer=True)
+                            freq_index += 1
+                            if freq_index < len(controller.frequencies):
+                                recovering(start_freq_index, freq_index)
+                            else:
+                                logger.info(f'[control_loop] Sequence complete', extra={'event': 'sequence_complete'})
+                                logger.info(f'[control_loop] Watchdog: {controller.watchdog.report()}')
+                                controller.end_run('Treatment Complete')
+                                run_flag = False
+                                if on_end is not None:
+                                    on_end()
                 continue
-            logger.info(f'[control_loop] {command} received')
-            if command == 'OPEN':
-                controller.open()
-                if on_open is not None:
-                    on_open()
-            elif command == 'CLOSE':
-                controller.close()
-            elif command == 'START':
-                freq_index = 0
-                start_freq_index(freq_index)
-                run_flag = True
-            elif command == 'PAUSE':
-                controller.stop_treatment(reset_timer=False)
-                run_flag = True
-            elif command == 'RESUME':
-                controller.start_treatment(reset_timer=False)
-                run_flag = True
-            elif command == 'STOP':
-                controller.stop_treatment(reset_timer=True)
-                run_flag = False
-            elif command == 'RESET':
-                freq_index = 0
-                run_flag = False
-            elif command == 'TREAT':
-                controller.start_treatment(reset_timer=True)
-                controller.stop_treatment(reset_timer=True, wait_for_time=controller.duration)
-            elif command == 'KILL':
-                break
+            logger.info('[control_loop] %s received', command, extra={'event': 'command', 'command': command})
+            with tracing.span('control_loop.command', command=command):
+                if command == 'OPEN':
+                    controller.open(progress=on_progress)
+                    if on_open is not None:
+                        on_open()
+                elif command == 'CLOSE':
+                    controller.close()
+                elif command == 'START':
+                    if controller.check_envelope():
+                        run_flag = False
+                        if on_end is not None:
+                            on_end('Safety Limit Exceeded')
+                        continue
+                    freq_index = 0
+                    controller.dose.reset()
+                    controller.watchdog.reset()
+                    controller.begin_run()
+                    recovering(start_freq_index, freq_index)
+                    run_flag = True
+                elif command == 'PAUSE':
+                    recovering(controller.stop_treatment, reset_timer=False)
+                    run_flag = True
+                elif command == 'RESUME':
+                    recovering(controller.start_treatment, reset_timer=False)
+                    run_flag = True
+                elif command == 'STOP':
+                    recovering(controller.stop_treatment, reset_timer=True)
+                    controller.end_run('Stopped')
+                    # The dose totals are final once the treatment has stopped
+                    if run_flag and on_end is not None:
+                        on_end('Treatment Aborted')
+                    run_flag = False
+                elif command == 'RESET':
+                    if controller.run_active:
+                        controller.end_run('Reset')
+                    freq_index = 0
+                    run_flag = False
+                elif command == 'RECONCILE':
+                    recovering(controller.reconcile)
+                elif command == 'TREAT':
+                    if controller.check_envelope():
+                        if on_end is not None:
+                            on_end('Safety Limit Exceeded')
+                        continue
+                    recovering(controller.start_treatment, reset_timer=True)
+                    recovering(controller.stop_treatment, reset_timer=True, wait_for_time=controller.duration)
+                elif command == 'KILL':
+                    break
 
     except BaseException as err:
         logger.critical(f"[control_loop] Unexpected {err=}, {type(err)=}")
+        controller.end_run('Error', error=repr(err))
         if on_error is not None:
             on_error(err)
     finally:
         try:
+            if controller.run_active or controller.run_id is not None:
+                controller.end_run('Interrupted')
             controller.close()
             if on_close is not None:
                 on_close()
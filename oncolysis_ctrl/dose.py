@@ -0,0 +1,170 @@
+"""
+Acoustic Dose Module
+====================
+
+This module contains the `DoseIntegrator` class, which accumulates the acoustic exposure delivered
+over a treatment session. The controller reports each period of enabled output as a segment with
+constant acoustic parameters, so the totals can be updated in constant time when a segment starts
+or stops, and the running totals (including the active segment) can be evaluated at any moment
+without iterating over the history.
+"""
+import json
+import logging
+from oncolysis_ctrl import config
+constants = config.constants
+logger = logging.getLogger("oc.dose")
+
+DOSE_FIELDS = ('on_time_s', 'energy_j_cm2', 'time_above_mi_s', 'ispta_s')
+DOSE_UNITS = {'on_time_s': 's',
+              'energy_j_cm2': 'J/cm2',
+              'time_above_mi_s': 's',
+              'ispta_s': 'mW*s/cm2'}
+
+
+class DoseIntegrator:
+    """
+    Dose Integrator
+    ===============
+
+    Accumulates, per frequency, the time with the output enabled, the delivered energy density
+    (J/cm2), the time spent above the MI threshold and the delivered ISPTA*s (mW*s/cm2).
+    """
+    def __init__(self, mi_threshold=constants.DOSE_MI_THRESHOLD, limits=constants.DOSE_LIMITS):
+        """
+        DoseIntegrator constructor
+
+        :param mi_threshold: mechanical index above which time is accumulated in `time_above_mi_s`
+        :param limits: dict of cumulative session limits, keyed by dose field (None to disable)
+        """
+        self.mi_threshold = mi_threshold
+        self.limits = {key: val for key, val in limits.items() if val is not None}
+        self.totals = {}
+        self.session = dict.fromkeys(DOSE_FIELDS, 0.0)
+        self.segment = None
+
+    def reset(self):
+        """
+        Clear all accumulated totals
+        :return: None
+        """
+        self.totals = {}
+        self.session = dict.fromkeys(DOSE_FIELDS, 0.0)
+        self.segment = None
+
+    def start_segment(self, frequency, t, mi, ispta):
+        """
+        Start accumulating a segment of enabled output
+
+        :param frequency: frequency (kHz)
+        :param t: start time (s)
+        :param mi: mechanical index of the output
+        :param ispta: spatial-peak temporal-average intensity of the output (mW/cm2)
+        :return: None
+        """
+        if self.segment is not None:
+            logger.warning('[start_segment] Segment already active. Closing it first')
+            self.stop_segment(t)
+        rates = {'on_time_s': 1.0,
+                 'energy_j_cm2': ispta * 1e-3,
+                 'time_above_mi_s': 1.0 if mi > self.mi_threshold else 0.0,
+                 'ispta_s': ispta}
+        self.segment = (frequency, t, rates)
+
+    def stop_segment(self, t):
+        """
+        Stop the active segment and add it to the totals
+
+        :param t: stop time (s)
+        :return: None
+        """
+        if self.segment is None:
+            return
+        frequency, t_start, rates = self.segment
+        dt = max(0.0, t - t_start)
+        totals = self.totals.setdefault(frequency, dict.fromkeys(DOSE_FIELDS, 0.0))
+        for key, rate in rates.items():
+            totals[key] += rate * dt
+            self.session[key] += rate * dt
+        self.segment = None
+
+    def get_session_totals(self, t=None):
+        """
+        Get the session totals, including the active segment
+
+        :param t: current time (s). If None, the active segment is not included
+        :return: dict of session totals
+        """
+        session = dict(self.session)
+        if self.segment is not None and t is not None:
+            _, t_start, rates = self.segment
+            dt = max(0.0, t - t_start)
+            for key, rate in rates.items():
+                session[key] += rate * dt
+        return session
+
+    def get_totals(self, t=None):
+        """
+        Get the per-frequency totals, including the active segment
+
+        :param t: current time (s). If None, the active segment is not included
+        :return: dict of {frequency: dict of totals}
+        """
+        totals = {frequency: dict(vals) for frequency, vals in self.totals.items()}
+        if self.segment is not None and t is not None:
+            frequency, t_start, rates = self.segment
+            dt = max(0.0, t - t_start)
+            vals = totals.setdefault(frequency, dict.fromkeys(DOSE_FIELDS, 0.0))
+            for key, rate in rates.items():
+                vals[key] += rate * dt
+        return totals
+
+    def check_limits(self, t=None):
+        """
+        Check the session totals against the cumulative limits
+
+        :param t: current time (s)
+        :return: list of dose fields that have reached their limit
+        """
+        session = self.get_session_totals(t)
+        return [key for key, limit in self.limits.items() if session[key] >= limit]
+
+    def time_to_limit(self, t):
+        """
+        Time remaining in the active segment until the first limit is reached
+
+        :param t: current time (s)
+        :return: time (s), or None if no limit will be reached
+        """
+        if self.segment is None:
+            return None
+        _, _, rates = self.segment
+        session = self.get_session_totals(t)
+        remaining = [(limit - session[key]) / rates[key] for key, limit in self.limits.items() if rates[key] > 0]
+        if len(remaining) == 0:
+            return None
+        return max(0.0, min(remaining))
+
+    def to_dict(self, t=None):
+        """
+        Get a serializable summary of the accumulated dose
+
+        :param t: current time (s)
+        :return: dict of summary values
+        """
+        return {'units': DOSE_UNITS,
+                'mi_threshold': self.mi_threshold,
+                'limits': self.limits,
+                'session': self.get_session_totals(t),
+                'frequencies': {str(frequency): vals for frequency, vals in self.get_totals(t).items()}}
+
+    def save(self, filename, t=None):
+        """
+        Save the accumulated dose to a JSON file
+
+        :param filename: output filename
+        :param t: current time (s)
+        :return: None
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(t), f, indent=2)
+        logger.info(f'[save] Saved dose totals to {filename}')
@@ -0,0 +1,333 @@
+"""
+Protocol Dry-Run Module
+=======================
+
+This module contains the `ProtocolEstimator` class, which predicts the outcome of running
+protocols on a `controller.Controller` without running them: how the run ends, its runtime, the
+RF switch commands and moves, the peak MI, ISPPA, ISPTA and function generator voltage, and the
+delivered dose. It evaluates a whole batch of candidate protocols in one call, with numpy arrays
+over (protocol, frequency segment), at hundreds of thousands of protocols per second.
+
+The estimate follows the control loop step by step:
+
+* a protocol whose frequencies are outside the calibrated range (or empty) ends in an error,
+  before treating;
+* a protocol exceeding the safety envelope at any of its frequencies is refused
+  (`Controller.configure` raises an `envelope.EnvelopeError`);
+* each frequency is treated until the first poll of the control loop (every
+  `controller.POLL_INTERVAL_S`) at which its treatment time has reached the duration;
+* the run stops early at the first poll at which a cumulative dose limit has been reached, with
+  the same per-segment dose rates as the `dose.DoseIntegrator`.
+
+The acoustic parameters are those of `Controller.calc_acoustic_params_array`, the limits those of
+the controller's `envelope.SafetyEnvelope` and `dose.DoseIntegrator`, and the switch positions
+those of `Controller.get_switch_positions`, so that the estimate stays consistent with the
+controller. `validate` runs protocols through `controller.run_protocol` on a virtual clock and
+compares the results with the estimate. The runtime and time-based totals can differ from a real
+run by the timing of the polls (at most one poll interval per frequency).
+"""
+import logging
+import numpy as np
+from oncolysis_ctrl import calibration, clock, controller as controller_module, dose, envelope
+logger = logging.getLogger("oc.dryrun")
+
+STATUSES = ('Treatment Complete', 'Dose Limit Reached', 'Safety Limit Exceeded', 'Error')
+COMPLETE, DOSE_LIMIT, SAFETY_LIMIT, ERROR = range(len(STATUSES))
+PEAK_FIELDS = ('mi', 'isppa', 'ispta', 'voltage')
+SETTING_KEYS = ('power_value', 'duration', 'burst_length', 'duty_cycle')
+# Tolerance of the comparison of the number of polls (floating point error in the timing)
+EPS = 1e-9
+
+
+class ProtocolEstimator:
+    """
+    Protocol Estimator
+    ==================
+
+    Vectorized dry run of batches of protocols on a controller's configuration.
+    """
+    def __init__(self, controller, poll_interval=controller_module.POLL_INTERVAL_S):
+        """
+        ProtocolEstimator constructor. The controller's calibration, limits and switch settings are
+        read at each call of `estimate`, so the estimator follows `Controller.set_constants`.
+
+        :param controller: `controller.Controller` the protocols would run on
+        :param poll_interval: interval at which the control loop checks the treatment time (s)
+        """
+        self.controller = controller
+        self.poll_interval = poll_interval
+
+    def get_switch_positions(self, frequencies):
+        """
+        Get the RF switch positions at many frequencies, as `Controller.get_switch_positions`
+
+        :param frequencies: array of frequencies (kHz)
+        :return: integer array with a trailing axis per switch (-1 where a switch is not set)
+        """
+        c = self.controller
+        n_switches = len(c.switches)
+        mapped = np.array(sorted(c.rf_switch_settings), dtype=float)
+        if len(mapped) == 0:
+            return np.full(np.shape(frequencies) + (n_switches,), -1, dtype=int)
+        table = np.full((len(mapped), n_switches), -1, dtype=int)
+        for i, frequency in enumerate(sorted(c.rf_switch_settings)):
+            for j, position in enumerate(c.rf_switch_settings[frequency][:n_switches]):
+                if position is not None:
+                    table[i, j] = position
+        # Nearest mapped frequency in log-frequency
+        log_mapped = np.log(mapped)
+        midpoints = (log_mapped[1:] + log_mapped[:-1]) / 2
+        index = np.searchsorted(midpoints, np.log(frequencies))
+        return table[index]
+
+    def estimate(self, frequencies, power_value=None, power_mode=None, duration=None, burst_length=None,
+                 duty_cycle=None):
+        """
+        Estimate the outcome of a batch of protocols. Settings left as None take the controller's
+        current settings.
+
+        :param frequencies: array of frequencies (kHz) of shape (n_protocols, n_frequencies), padded
+                            at the end with NaN for protocols with fewer frequencies, or a single
+                            list of frequencies shared by all protocols
+        :param power_value: power setting, or array of one per protocol
+        :param power_mode: power mode, or array of one per protocol
+        :param duration: duration of treatment at each frequency (s), or array of one per protocol
+        :param burst_length: burst length (s), or array of one per protocol
+        :param duty_cycle: duty cycle, or array of one per protocol
+        :return: dict of arrays of one value per protocol: 'status' (index into STATUSES),
+                 'runtime_s', 'n_segments' (frequencies treated), 'switch_commands' (positions set),
+                 'switch_moves' (positions changed, counting the first position set on each switch),
+                 'max_mi', 'max_isppa', 'max_ispta' (mW/cm2) and 'max_voltage' (V) over the
+                 frequencies treated, and the session dose totals (`dose.DOSE_FIELDS`)
+        """
+        c = self.controller
+        frequencies = np.atleast_2d(np.asarray(frequencies, dtype=float))
+        settings = {'power_value': c.power_value if power_value is None else power_value,
+                    'duration': c.duration if duration is None else duration,
+                    'burst_length': c.burst_length if burst_length is None else burst_length,
+                    'duty_cycle': c.burst_duty_cycle if duty_cycle is None else duty_cycle}
+        settings = {key: np.asarray(value, dtype=float) for key, value in settings.items()}
+        power_mode = np.asarray(c.power_mode if power_mode is None else power_mode)
+        n = np.broadcast(frequencies[:, 0], power_mode, *settings.values()).shape[0]
+        frequencies = np.broadcast_to(frequencies, (n, frequencies.shape[1]))
+        settings = {key: np.broadcast_to(value, (n,)) for key, value in settings.items()}
+        if power_mode.ndim == 0:
+            return self.estimate_mode(frequencies, str(power_mode), settings)
+        # Sort the protocols by power mode, and estimate each mode on a contiguous block
+        codes = np.full(n, -1)
+        modes = list(c.power_settings)
+        for i, mode in enumerate(modes):
+            codes[power_mode == mode] = i
+        if np.any(codes < 0):
+            raise ValueError(f'Bad power mode {power_mode[codes < 0][0]}')
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(modes) + 1))
+        result = None
+        for i, mode in enumerate(modes):
+            rows = order[bounds[i]:bounds[i + 1]]
+            if len(rows) == 0:
+                continue
+            block = self.estimate_mode(frequencies[rows], mode, {key: value[rows] for key, value in settings.items()})
+            if result is None:
+                result = {key: np.zeros(n, dtype=value.dtype) for key, value in block.items()}
+            for key, value in block.items():
+                result[key][rows] = value
+        if result is None:
+            result = self.estimate_mode(frequencies, c.power_mode, settings)
+        return result
+
+    def estimate_mode(self, frequencies, power_mode, settings):
+        """
+        Estimate the outcome of a batch of protocols with the same power mode
+
+        :param frequencies: array of frequencies (kHz) of shape (n_protocols, n_frequencies), padded with NaN
+        :param power_mode: power mode
+        :param settings: dict of arrays of one 'power_value', 'duration', 'burst_length' and
+                         'duty_cycle' per protocol
+        :return: dict of arrays, as `estimate`
+        """
+        c = self.controller
+        n, k = frequencies.shape
+        result = {'status': np.full(n, COMPLETE, dtype=int)}
+
+        # Configuration: every frequency within the calibrated range
+        valid = ~np.isnan(frequencies)
+        cal = c.calibration
+        covered = valid & (frequencies >= cal.f_min) & (frequencies <= cal.f_max)
+        error = np.any(valid & ~covered, axis=1) | ~valid[:, 0]
+        frequencies = np.where(covered, frequencies, cal.f_min)
+        calib = cal.evaluate(frequencies)
+
+        # Acoustic parameters of each segment, and the safety envelope at START
+        column = {key: value[:, np.newaxis] for key, value in settings.items()}
+        params = c.calc_acoustic_params_array(frequencies, power_value=column['power_value'], power_mode=power_mode,
+                                              burst_length=column['burst_length'], duty_cycle=column['duty_cycle'],
+                                              calib=calib)
+        max_value, _ = envelope.calc_max_values(frequencies, power_mode, column['duty_cycle'], calib,
+                                                c.power_settings[power_mode]['minmax'], c.envelope.limits,
+                                                c.envelope.amplifier_gain, c.envelope.max_voltage)
+        exceeded = np.any(valid & (column['power_value'] > max_value * (1 + 1e-9)), axis=1)
+        result['status'][exceeded] = SAFETY_LIMIT
+        result['status'][error] = ERROR
+
+        # Timing: each segment lasts a whole number of polls, back to back
+        poll = self.poll_interval
+        segment_time = np.maximum(np.ceil(settings['duration'] / poll - EPS), 1) * poll
+        runtime = np.where(result['status'] == COMPLETE, valid.sum(axis=1) * segment_time, 0.0)
+        start = np.arange(k) * segment_time[:, np.newaxis]
+
+        # Dose rates of each segment, as `DoseIntegrator.start_segment`, and the first poll at which
+        # a cumulative limit is reached
+        ispta = np.where(valid, params['ispta'], 0.0)
+        rates = {'on_time_s': valid.astype(float),
+                 'energy_j_cm2': ispta * 1e-3,
+                 'time_above_mi_s': (valid & (params['mi'] > c.dose.mi_threshold)).astype(float),
+                 'ispta_s': ispta}
+        t_limit = np.full(n, np.inf)
+        for key, limit in c.dose.limits.items():
+            dose_segment = rates[key] * segment_time[:, np.newaxis]
+            before = np.cumsum(dose_segment, axis=1) - dose_segment
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t_key = start + np.maximum(limit - before, 0.0) / rates[key]
+            t_key = np.where(valid & (before + dose_segment >= limit), t_key, np.inf)
+            t_limit = np.minimum(t_limit, np.min(t_key, axis=1))
+        t_stop = np.maximum(np.ceil(t_limit / poll - EPS), 1) * poll
+        limited = (result['status'] == COMPLETE) & (t_stop <= runtime + EPS)
+        result['status'][limited] = DOSE_LIMIT
+        runtime = np.where(limited, t_stop, runtime)
+        result['runtime_s'] = runtime
+
+        # Segments treated, and the time each was on
+        treated = valid & (start < runtime[:, np.newaxis] - EPS)
+        on_time = np.clip(runtime[:, np.newaxis] - start, 0.0, segment_time[:, np.newaxis]) * treated
+        result['n_segments'] = treated.sum(axis=1)
+        for field in PEAK_FIELDS:
+            result[f'max_{field}'] = np.max(np.where(treated, params[field], 0.0), axis=1)
+        for key in dose.DOSE_FIELDS:
+            result[key] = np.einsum('ij,ij->i', rates[key], on_time)
+
+        # RF switches: every treated segment sets each mapped switch, which moves when its position changes
+        positions = np.where(treated[..., np.newaxis], self.get_switch_positions(frequencies), -1)
+        result['switch_commands'] = np.sum(positions >= 0, axis=(1, 2))
+        moves = np.zeros(n, dtype=int)
+        last = np.full((n, positions.shape[2]), -1, dtype=int)
+        for j in range(k):
+            current = positions[:, j]
+            moves += np.sum((current >= 0) & (current != last), axis=1)
+            last = np.where(current >= 0, current, last)
+        result['switch_moves'] = moves
+        return result
+
+    def estimate_protocols(self, protocols):
+        """
+        Estimate the outcome of a list of protocols
+
+        :param protocols: list of dicts of settings accepted by `Controller.configure`
+        :return: dict of arrays, as `estimate`
+        """
+        return self.estimate(**self.pack(protocols))
+
+    def pack(self, protocols):
+        """
+        Pack a list of protocols into the arrays taken by `estimate`. Settings missing from a
+        protocol take the controller's current settings, as with `Controller.configure`.
+
+        :param protocols: list of dicts of settings accepted by `Controller.configure`
+        :return: dict of keyword arguments of `estimate`
+        """
+        c = self.controller
+        defaults = {'frequencies': c.frequencies, 'power_mode': c.power_mode, 'power_value': c.power_value,
+                    'duration': c.duration, 'burst_length': c.burst_length, 'duty_cycle': c.burst_duty_cycle}
+        frequency_lists = [protocol.get('frequencies', defaults['frequencies']) for protocol in protocols]
+        k = max((len(frequencies) for frequencies in frequency_lists), default=0)
+        packed = {'frequencies': np.full((len(protocols), max(k, 1)), np.nan)}
+        for i, frequencies in enumerate(frequency_lists):
+            packed['frequencies'][i, :len(frequencies)] = frequencies
+        packed['power_mode'] = np.array([protocol.get('power_mode', defaults['power_mode']) for protocol in protocols])
+        for key in SETTING_KEYS:
+            packed[key] = np.array([protocol.get(key, defaults[key]) for protocol in protocols], dtype=float)
+        return packed
+
+
+def unpack(result, i):
+    """
+    Get the estimate of one protocol from the arrays returned by `ProtocolEstimator.estimate`
+
+    :param result: dict of arrays
+    :param i: index of the protocol
+    :return: dict of values, with the status as a string
+    """
+    values = {key: value[i].item() for key, value in result.items()}
+    values['status'] = STATUSES[values['status']]
+    return values
+
+
+def validate(make_controller, protocols, rtol=1e-6):
+    """
+    Run protocols through `controller.run_protocol` on simulated controllers with a virtual clock,
+    and compare the results with the estimate
+
+    :param make_controller: function returning a new `controller.Controller` with simulate=True
+    :param protocols: list of protocol dicts
+    :param rtol: relative tolerance of the acoustic parameters and dose rates
+    :return: list of (protocol index, field, estimated value, actual value) for each mismatch
+    """
+    estimator = ProtocolEstimator(make_controller())
+    estimate = estimator.estimate_protocols(protocols)
+    mismatches = []
+    for i, protocol in enumerate(protocols):
+        c = make_controller()
+        c.clock = clock.VirtualClock()
+        segments = []
+        start_segment = c.dose.start_segment
+
+        def record(frequency, t, mi, ispta):
+            segments.append({'frequency': frequency, 'mi': mi, 'ispta': ispta})
+            start_segment(frequency, t, mi, ispta)
+        c.dose.start_segment = record
+        messages = []
+        try:
+            totals = controller_module.run_protocol(c, protocol, on_end=messages.append)
+            status = messages[-1] if messages else STATUSES[ERROR]
+        except envelope.EnvelopeError:
+            totals = dict.fromkeys(dose.DOSE_FIELDS, 0.0)
+            status = STATUSES[SAFETY_LIMIT]
+        except (calibration.CalibrationError, IndexError, ValueError):
+            totals = dict.fromkeys(dose.DOSE_FIELDS, 0.0)
+            status = STATUSES[ERROR]
+        expected = unpack(estimate, i)
+        # Each segment can run over by one poll of floating point error in the virtual time
+        slack = expected['n_segments'] * estimator.poll_interval + EPS
+        actual = {'status': status, 'n_segments': len(segments),
+                  'runtime_s': totals['on_time_s'],
+                  'max_mi': max((s['mi'] for s in segments), default=0.0),
+                  'max_ispta': max((s['ispta'] for s in segments), default=0.0)}
+        # A dose limit reached within the last polls of a run or segment can end it one segment
+        # earlier or later: only the runtime must then agree. The runtime of a run stopped by a
+        # dose limit also depends on the dose rate after the extra polls, so the dose totals
+        # (compared below) are checked instead.
+        timing_ok = abs(expected['runtime_s'] - actual['runtime_s']) <= slack or \
+            expected['status'] == actual['status'] == STATUSES[DOSE_LIMIT]
+        boundary = (expected['status'] != actual['status'] or expected['n_segments'] != actual['n_segments']) and \
+            {expected['status'], actual['status']} <= {STATUSES[COMPLETE], STATUSES[DOSE_LIMIT]} and \
+            abs(expected['n_segments'] - actual['n_segments']) <= 1
+        for key, value in actual.items():
+            if key == 'runtime_s':
+                ok = timing_ok
+            elif boundary:
+                ok = timing_ok
+            elif isinstance(value, str):
+                ok = expected[key] == value
+            else:
+                ok = np.isclose(expected[key], value, rtol=rtol, atol=0)
+            if not ok:
+                mismatches.append((i, key, expected[key], value))
+        for key in dose.DOSE_FIELDS:
+            rate_max = max(actual['max_ispta'], 1.0) * (1e-3 if key == 'energy_j_cm2' else 1.0)
+            if abs(expected[key] - totals[key]) > slack * rate_max + rtol * abs(totals[key]):
+                mismatches.append((i, key, expected[key], totals[key]))
+    if mismatches:
+        logger.warning(f'[validate] {len(mismatches)} mismatches in {len(protocols)} protocols')
+    else:
+        logger.info(f'[validate] Estimate matches {len(protocols)} runs')
+    return mismatches
@@ -0,0 +1,202 @@
+"""
+Safe Operating Envelope Module
+==============================
+
+This module contains the `SafetyEnvelope` class, which precomputes the maximum power setting
+allowed by the safety limits of a configuration (`SAFETY_LIMITS`: MI, ISPPA, ISPTA and the
+function generator input voltage, which is also capped by `MAX_VOLTAGE`), for every combination
+of frequency, power mode, burst length and duty cycle in the configuration's option lists.
+
+Every acoustic output is non-decreasing in the power setting, so each limit translates into a
+maximum pressure, and the lowest of these is converted back to a power setting in the units of
+each power mode. The limit that sets the maximum is recorded as the binding constraint
+(``'range'`` if the top of the power mode's range is reached first). Combinations in the table
+are a dictionary lookup; other combinations (e.g. interpolated frequencies) are computed on demand
+with the same formulas.
+
+The app limits the power slider to the envelope maximum of the selected frequencies,
+`controller.Controller.configure` raises an `EnvelopeError` for settings outside the envelope, and
+`controller.control_loop` refuses to start or fire a protocol outside it ('Safety Limit
+Exceeded'). The default power setting of every power mode must be within the envelope at every
+frequency of a configuration where the power mode is usable (`config_compiler.validate`).
+"""
+import itertools
+import logging
+import numpy as np
+logger = logging.getLogger("oc.envelope")
+
+CONSTRAINTS = ('mi', 'isppa', 'ispta', 'voltage', 'range')
+
+
+class EnvelopeError(ValueError):
+    """
+    Raised when settings exceed the safe operating envelope
+    """
+
+
+def pressure_to_isppa(pressure):
+    """
+    :param pressure: peak negative pressure (kPa)
+    :return: ISPPA (W/cm2)
+    """
+    return (pressure * 1e3) ** 2 / 3e6 / 1e4
+
+
+def isppa_to_pressure(isppa):
+    """
+    :param isppa: ISPPA (W/cm2)
+    :return: peak negative pressure (kPa)
+    """
+    return np.sqrt(isppa * 3e6) * 1e-1
+
+
+def calc_max_values(frequency, power_mode, duty_cycle, calib, power_range, limits, amplifier_gain, max_voltage):
+    """
+    Calculate the maximum power setting allowed by the safety limits
+
+    :param frequency: array of frequencies (kHz)
+    :param power_mode: power mode
+    :param duty_cycle: array of duty cycles (broadcast with frequency)
+    :param calib: dict of arrays of p_ref, coeff_a and coeff_b at each frequency
+    :param power_range: (min, max) of the power mode
+    :param limits: dict of limits for 'mi', 'isppa' (W/cm2), 'ispta' (mW/cm2) and 'voltage' (V)
+    :param amplifier_gain: amplifier gain
+    :param max_voltage: maximum function generator voltage (V)
+    :return: (array of maximum power values, array of indices into CONSTRAINTS)
+    """
+    frequency = np.asarray(frequency, dtype=float)
+    duty_cycle = np.asarray(duty_cycle, dtype=float)
+    p_ref = np.asarray(calib['p_ref'], dtype=float)
+    shape = np.broadcast(frequency, duty_cycle).shape
+    # Maximum amplified voltage, and the pressure it produces
+    voltage = min(limits['voltage'], max_voltage) * amplifier_gain
+    p_voltage = np.asarray(calib['coeff_a']) * voltage ** 2 + np.asarray(calib['coeff_b']) * voltage
+    p_mi = limits['mi'] * np.sqrt(frequency * 1e-3) * 1e3
+    p_isppa = isppa_to_pressure(limits['isppa'])
+    if power_mode == 'constant_ispta_mi100':
+        # Pressure is fixed at p_ref; the power setting is the ISPTA, reached by adjusting the burst length
+        p_fixed = np.broadcast_to(p_ref, shape)
+        ok = (p_fixed <= p_mi) & (p_fixed <= p_isppa) & (p_fixed <= p_voltage)
+        binding = np.select([p_fixed > p_mi, p_fixed > p_isppa, p_fixed > p_voltage],
+                            [CONSTRAINTS.index('mi'), CONSTRAINTS.index('isppa'), CONSTRAINTS.index('voltage')],
+                            CONSTRAINTS.index('ispta'))
+        max_value = np.where(ok, limits['ispta'], -np.inf)
+    else:
+        p_ispta = isppa_to_pressure(limits['ispta'] * 1e-3 / duty_cycle)
+        p_limits = np.broadcast_arrays(p_mi, p_isppa, p_ispta, p_voltage)
+        binding = np.argmin(p_limits, axis=0)
+        p_max = np.min(p_limits, axis=0)
+        if power_mode == 'constant_mi':
+            max_value = p_max / p_ref * 100
+        elif power_mode == 'constant_pressure':
+            max_value = p_max
+        elif power_mode == 'constant_isppa':
+            max_value = pressure_to_isppa(p_max)
+        elif power_mode == 'constant_ispta':
+            max_value = pressure_to_isppa(p_max) * duty_cycle * 1e3
+        else:
+            raise ValueError(f'Bad power mode {power_mode}')
+    max_value = np.broadcast_to(max_value, shape)
+    binding = np.broadcast_to(binding, shape)
+    capped = max_value >= power_range[1]
+    return np.where(capped, power_range[1], max_value), np.where(capped, CONSTRAINTS.index('range'), binding)
+
+
+class SafetyEnvelope:
+    """
+    Safety Envelope
+    ===============
+
+    Table of the maximum power setting for every combination of a configuration's options.
+    """
+    def __init__(self, calibration, frequencies, power_settings, burst_lengths, duty_cycles, limits,
+                 amplifier_gain, max_voltage):
+        """
+        SafetyEnvelope constructor. Builds the table.
+
+        :param calibration: `calibration.Calibration` of the configuration
+        :param frequencies: frequencies (kHz)
+        :param power_settings: power settings of each power mode (as POWER_SETTINGS)
+        :param burst_lengths: burst lengths (s)
+        :param duty_cycles: duty cycles
+        :param limits: dict of limits for 'mi', 'isppa' (W/cm2), 'ispta' (mW/cm2) and 'voltage' (V)
+        :param amplifier_gain: amplifier gain
+        :param max_voltage: maximum function generator voltage (V)
+        """
+        self.calibration = calibration
+        self.power_settings = power_settings
+        self.limits = dict(limits)
+        self.amplifier_gain = amplifier_gain
+        self.max_voltage = max_voltage
+        frequencies = [f for f in frequencies if calibration.covers(f)]
+        f_grid, dc_grid = np.meshgrid(np.array(frequencies, dtype=float), np.array(duty_cycles, dtype=float),
+                                      indexing='ij')
+        calib = calibration.evaluate(f_grid)
+        self.table = {}
+        for power_mode, settings in power_settings.items():
+            max_value, binding = calc_max_values(f_grid, power_mode, dc_grid, calib, settings['minmax'], self.limits,
+                                                 amplifier_gain, max_voltage)
+            for (i, f), (j, dc) in itertools.product(enumerate(frequencies), enumerate(duty_cycles)):
+                entry = (float(max_value[i, j]), CONSTRAINTS[binding[i, j]])
+                # The limits do not depend on the burst length, only on the duty cycle
+                for burst_length in burst_lengths:
+                    self.table[(f, power_mode, burst_length, dc)] = entry
+        logger.info(f'[init] Safety envelope with {len(self.table)} entries')
+
+    def lookup(self, frequency, power_mode, burst_length, duty_cycle):
+        """
+        Get the maximum power setting for a combination of settings
+
+        :param frequency: frequency (kHz)
+        :param power_mode: power mode
+        :param burst_length: burst length (s)
+        :param duty_cycle: duty cycle
+        :return: (maximum power value, binding constraint). The maximum is -inf if no power setting
+                 is allowed.
+        :raises CalibrationError: if the frequency is outside the calibrated range
+        """
+        entry = self.table.get((frequency, power_mode, burst_length, duty_cycle))
+        if entry is None:
+            calib = self.calibration.get(frequency)
+            max_value, binding = calc_max_values(frequency, power_mode, duty_cycle, calib,
+                                                 self.power_settings[power_mode]['minmax'], self.limits,
+                                                 self.amplifier_gain, self.max_voltage)
+            entry = (float(max_value), CONSTRAINTS[int(binding)])
+        return entry
+
+    def get_max_value(self, frequencies, power_mode, burst_length, duty_cycle):
+        """
+        Get the maximum power setting allowed at all of a set of frequencies
+
+        :param frequencies: frequencies (kHz)
+        :param power_mode: power mode
+        :param burst_length: burst length (s)
+        :param duty_cycle: duty cycle
+        :return: (maximum power value, binding constraint, frequency it applies to), or the top of the
+                 power mode's range if no frequencies are given
+        """
+        result = (self.power_settings[power_mode]['minmax'][1], 'range', None)
+        for frequency in frequencies:
+            max_value, binding = self.lookup(frequency, power_mode, burst_length, duty_cycle)
+            if max_value < result[0]:
+                result = (max_value, binding, frequency)
+        return result
+
+    def check(self, frequencies, power_mode, power_value, burst_length, duty_cycle):
+        """
+        Check settings against the envelope
+
+        :param frequencies: frequencies (kHz)
+        :param power_mode: power mode
+        :param power_value: power setting
+        :param burst_length: burst length (s)
+        :param duty_cycle: duty cycle
+        :return: list of (frequency, maximum power value, binding constraint) for each frequency where
+                 the power setting is too high
+        """
+        violations = []
+        for frequency in frequencies:
+            max_value, binding = self.lookup(frequency, power_mode, burst_length, duty_cycle)
+            if power_value > max_value * (1 + 1e-9):
+                violations.append((frequency, max_value, binding))
+        return violations
@@ -6,10 +6,15 @@ This module provides Classes for controlling the function generator.
 While the serial commands can be directly issued according to the function
 generator's API via function_generator.inst, this class provides a series
 of convenience methods for configuring the function generator.
+
+Each `Channel` keeps the `channel_state.ChannelState` it last wrote, so that `Channel.set_state`
+only writes the settings that change.
+
+Every transaction times out after the timeout of the `transport.RetryPolicy` of the function
+generator, and queries, which are idempotent, are retried after transport errors.
 """
 import logging
-import pyvisa
-from oncolysis_ctrl import config
+from oncolysis_ctrl import config, channel_state, transport
 constants = config.constants
 logger = logging.getLogger("oc.function_generator")
 
@@ -26,7 +31,10 @@ class FunctionGenerator:
     def __init__(self, vid=constants.RIGOL_DG4162_VID,
                  pid=constants.RIGOL_DG4162_PID,
                  channels=constants.CHANNELS,
-                 max_voltage=constants.MAX_VOLTAGE):
+                 max_voltage=constants.MAX_VOLTAGE,
+                 resource=None,
+                 resource_manager=None,
+                 policy=None):
         """
         Initialize function generator. Does not open connection.
         
@@ -34,14 +42,21 @@ class FunctionGenerator:
         :param pid: product id for USB device (defaults for RIGOL DG4162)
         :param channels: tuple of available channels (default (1,2))
         :param max_voltage: maximum allowable voltage (to protect RF Amp, default 1.0V)
+        :param resource: VISA resource name to open (e.g. 'USB0::0x1AB1::0x0641::DG4E000000001::INSTR').
+                         If None, search for a single instrument matching vid and pid
+        :param resource_manager: VISA resource manager to open the instrument with (None for
+                                 `pyvisa.ResourceManager()`)
+        :param policy: `transport.RetryPolicy` of the I/O (None for the default policy)
         """
         self.is_open = False
-        self.resource = None
+        self.resource = resource
+        self.resource_manager = resource_manager
         self.inst = None
         self.idn = ''
         self.vid = vid
         self.pid = pid
-        self.channels = {ch: Channel(ch, self.inst, max_voltage=max_voltage) for ch in channels}
+        self.policy = policy if policy is not None else transport.RetryPolicy()
+        self.channels = {ch: Channel(ch, self.inst, max_voltage=max_voltage, policy=self.policy) for ch in channels}
 
     def open(self):
         """
@@ -51,22 +66,71 @@ class FunctionGenerator:
             logger.warning('[close] Already connected')
         else:
             logger.info('[open] Connecting to Function Generator...')
-            rm = pyvisa.ResourceManager()
+            rm = self.resource_manager
+            if rm is None:
+                import pyvisa  # slow to import, so only loaded to connect
+                rm = pyvisa.ResourceManager()
             resources = rm.list_resources()
-            vidstr = f'{self.vid:04X}'
-            pidstr = f'{self.pid:04X}'
-            matches = [resource for resource in resources if ((vidstr in resource) and (pidstr in resource))]
-            n = len(matches)
-            if n != 1:
-                raise ConnectionError(f'Found {n} matching instruments for vid=x{self.vid:04X}, pid=x{self.pid:04X}')
-            self.resource = matches[0]
+            if self.resource is None:
+                vidstr = f'{self.vid:04X}'
+                pidstr = f'{self.pid:04X}'
+                matches = [resource for resource in resources if ((vidstr in resource) and (pidstr in resource))]
+                n = len(matches)
+                if n != 1:
+                    raise ConnectionError(f'Found {n} matching instruments for vid=x{self.vid:04X}, pid=x{self.pid:04X}')
+                self.resource = matches[0]
+            elif self.resource not in resources:
+                raise ConnectionError(f'Instrument {self.resource} not found')
             self.inst = rm.open_resource(self.resource)
+            # VISA timeouts are in ms (None to wait indefinitely)
+            self.inst.timeout = self.policy.timeout * 1e3 if self.policy.timeout is not None else None
             for ch in self.channels:
                 self.channels[ch].inst = self.inst
-            self.idn = self.inst.query('*IDN?')
+                self.channels[ch].state = channel_state.ChannelState()
+            self.idn = self.query('*IDN?')
             self.is_open = True
             logger.info(f'[open] {self.idn}')
 
+    def reconnect(self):
+        """
+        Drop the session, without writing to the instrument, and open a new one. The state of the
+        channels is unknown until it is read or written again.
+        """
+        if self.inst is not None:
+            try:
+                self.inst.close()
+            except Exception as e:
+                logger.warning(f'[reconnect] Could not close the session: {e!r}')
+        self.is_open = False
+        self.open()
+
+    def query(self, command):
+        """
+        Query the instrument, retrying after transport errors
+
+        :param command: SCPI query
+        :return: response
+        """
+        return self.policy.call(command, self.inst.query, command)
+
+    def ping(self):
+        """
+        Check that the instrument responds
+
+        :return: response to `*OPC?` ('1' when all pending operations are complete)
+        """
+        return self.query('*OPC?').strip()
+
+    def get_error(self):
+        """
+        Read the oldest entry from the instrument error queue
+
+        :return: (error code, message). Code 0 means the queue is empty
+        """
+        response = self.query('SYSTEM:ERROR?').strip()
+        code, _, message = response.partition(',')
+        return int(code), message.strip().strip('"')
+
     def close(self):
         """
         Closes the connection to the function generator
@@ -78,6 +142,8 @@ class FunctionGenerator:
             except BaseException as e:
                 logger.error('Unable to deactivate output. Attempting to reset.')
                 self.inst.write('*RST')
+                for ch in self.channels:
+                    self.channels[ch].state = channel_state.ChannelState()
                 raise
             self.inst.close()
             self.is_open = False
@@ -96,17 +162,67 @@ class Channel:
     is provided through the `inst` attribute, but most functionality is
     provided through the methods of this class.
     """
-    def __init__(self, channel, inst, max_voltage=None):
+    def __init__(self, channel, inst, max_voltage=None, policy=None):
         """
         Instantiate function generator channel
 
         :param channel: channel number (1 or 2 for RIGOL)
         :param inst: pyvisa connection to instrument
         :param max_voltage: maximum voltage limit (V)
+        :param policy: `transport.RetryPolicy` of the queries (None for the default policy)
         """
         self.channel = channel
         self.inst = inst
         self.max_voltage = max_voltage
+        self.policy = policy if policy is not None else transport.RetryPolicy()
+        self.state = channel_state.ChannelState()
+
+    def query(self, command):
+        """
+        Query the instrument, retrying after transport errors
+
+        :param command: SCPI query
+        :return: response
+        """
+        return self.policy.call(command, self.inst.query, command)
+
+    def remember(self, **fields):
+        """
+        Record settings written to the channel in its state
+
+        :param fields: fields of `channel_state.ChannelState` (None to forget a value)
+        """
+        self.state = self.state.replace(**fields)
+
+    def get_state(self):
+        """
+        Read the state of the channel from the instrument, and keep it as the current state
+
+        :return: `channel_state.ChannelState`
+        """
+        self.state = channel_state.ChannelState.from_params(self.get_settings(), self.get_burst(),
+                                                            output=self.get_output_enabled())
+        return self.state
+
+    def set_state(self, target):
+        """
+        Move the channel to a target state, writing only the settings that change, in a safe order
+        (see `channel_state.compile_transition`)
+
+        :param target: `channel_state.ChannelState` (None fields are left unchanged)
+        :return: tuple of the commands written
+        """
+        commands, state = channel_state.compile_transition(self.state, target, self.channel, self.max_voltage)
+        try:
+            for command in commands:
+                logger.info('[set_state] %s', command)
+                self.inst.write(command)
+        except BaseException:
+            # The state of the channel is unknown after a failed write
+            self.state = channel_state.ChannelState()
+            raise
+        self.state = state
+        return commands
 
     def apply(self, mode, frequency=None, amplitude=None, offset=None, phase=None, delay=None):
         """
@@ -142,8 +258,10 @@ class Channel:
                     raise ValueError('[apply] Invalid Parameters')
                 else:
                     break
-        logger.info(f'[apply] {argstr}')
+        logger.info('[apply] %s', argstr)
         self.inst.write(argstr)
+        self.remember(function=mode, frequency=frequency, amplitude=amplitude, offset=offset,
+                      phase=phase if 'PULS' not in mode else None)
 
     def get_settings(self):
         """
@@ -151,8 +269,8 @@ class Channel:
 
         :return: dict of settings. Usable as input with `set_input(**settings)`
         """
-        settings = self.inst.query(f'SOURCE{self.channel}:APPLY?')
-        logger.info(f'[get_settings] {settings}')
+        settings = self.query(f'SOURCE{self.channel}:APPLY?')
+        logger.info('[get_settings] %s', settings)
         setlist = settings.strip()[1:-1].split(',')
         mode = setlist[0]
         if 'NOIS' in mode:
@@ -195,8 +313,18 @@ class Channel:
         for attr, value in d.items():
             if value is not None:
                 command = f'OUTPUT{self.channel}:{attr} {value}'
-                logger.info(f'[set_output] {command}')
+                logger.info('[set_output] %s', command)
                 self.inst.write(command)
+        if enabled is not None:
+            self.remember(output=enabled)
+
+    def get_output_enabled(self):
+        """
+        Query only the output state of this channel
+
+        :return: True if the output is enabled
+        """
+        return self.query(f'OUTPUT{self.channel}:STAT?').strip() == 'ON'
 
     def get_output(self):
         """
@@ -211,7 +339,7 @@ class Channel:
         d = {}
         for attr in attrs:
             command = f'OUTPUT{self.channel}:{attr}?'
-            d[attr] = self.inst.query(command).strip()
+            d[attr] = self.query(command).strip()
         setdict = {'enabled': enable_map[d['STAT']],
                    'impedance': 'INF' if d['IMP'] == 'INFINITY' else float(d['IMP']),
                    'noise_scale': float(d['NOISE:SCALE']),
@@ -265,14 +393,19 @@ class Channel:
         for attr, value in d.items():
             if value is not None:
                 command = f'SOURCE{self.channel}:BURST:{attr} {value}'
-                logger.info(f'[set_burst] {command}')
+                logger.info('[set_burst] %s', command)
                 self.inst.write(command)
+        written = channel_state.ChannelState.from_params(burst_params={
+            'enabled': enabled, 'period': period, 'mode': mode, 'cycles': cycles, 'phase': phase, 'delay': delay,
+            'trig_negative': trig_negative, 'trig_source': trig_source, 'trig_out_en': trig_out_en,
+            'trig_out_negative': trig_out_negative, 'gate_invert': gate_invert})
+        self.state = self.state.update(written)
 
     def trig_burst(self):
         """
         Trigger a burst immediately
         """
-        logger.info(f'[trig_burst] triggering burst on channel {self.channel}')
+        logger.info('[trig_burst] triggering burst on channel %s', self.channel)
         self.inst.write(f'SOURCE{self.channel}:BURST:TRIGGER:IMMEDIATE')
 
     def get_burst(self):
@@ -289,7 +422,7 @@ class Channel:
         d = {}
         for attr in attrs:
             command = f'SOURCE{self.channel}:BURST:{attr}?'
-            d[attr] = self.inst.query(command).strip()
+            d[attr] = self.query(command).strip()
         setdict = {'enabled': enable_map[d['STAT']],
                    'period': float(d['INTERNAL:PERIOD']),
                    'mode': d['MODE'],
@@ -309,9 +442,10 @@ class Channel:
 
         :param frequency: frequency (Hz)
         """
-        logger.info(f'[set_frequency] Setting frequency to {frequency}')
+        logger.info('[set_frequency] Setting frequency to %s', frequency)
         command = f'SOURCE{self.channel}:FREQUENCY:FIXED {frequency}'
         self.inst.write(command)
+        self.remember(frequency=frequency)
         if len(kwargs) > 0:
             raise NotImplementedError()
 
@@ -322,7 +456,7 @@ class Channel:
         :return: frequency (Hz)
         """
         command = f'SOURCE{self.channel}:FREQUENCY:FIXED?'
-        frequency = float(self.inst.query(command).strip())
+        frequency = float(self.query(command).strip())
         return frequency
 
     def set_function(self, **kwargs):    
@@ -349,9 +483,10 @@ class Channel:
 
         :param float period: seconds
          """
-        logger.info(f'[set_period] Setting period to {period}')
+        logger.info('[set_period] Setting period to %s', period)
         command = f'SOURCE{self.channel}:PERIOD {period}'
         self.inst.write(command)
+        self.remember(frequency=None)
 
     def get_period(self):
         """
@@ -360,7 +495,7 @@ class Channel:
         :return: period (s)
         """
         command = f'SOURCE{self.channel}:PERIOD?'
-        return float(self.inst.query(command).strip())
+        return float(self.query(command).strip())
 
     def set_phase(self, **kwargs):
         raise NotImplementedError()
@@ -402,8 +537,13 @@ class Channel:
         for attr, value in d.items():
             if value is not None:
                 command = f'SOURCE{self.channel}:VOLTAGE:{attr} {value}'
-                logger.info(f'[set_voltage] {command}')
+                logger.info('[set_voltage] %s', command)
                 self.inst.write(command)
+        if hi is not None or lo is not None or unit is not None:
+            # The amplitude and offset follow from the levels, in the unit set
+            self.remember(amplitude=None, offset=None)
+        else:
+            self.state = self.state.update(channel_state.ChannelState(amplitude=voltage, offset=offset))
 
     def get_voltage(self):
         """
@@ -416,7 +556,7 @@ class Channel:
         d = {}
         for attr in attrs:
             command = f'SOURCE{self.channel}:VOLTAGE:{attr}?'
-            d[attr] = self.inst.query(command).strip()
+            d[attr] = self.query(command).strip()
         setdict = {'voltage': float(d['LEVEL:IMMEDIATE:AMPLITUDE']),
                    'hi': float(d['LEVEL:IMMEDIATE:HIGH']),
                    'low': float(d['LEVEL:IMMEDIATE:LOW']),
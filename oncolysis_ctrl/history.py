@@ -0,0 +1,344 @@
+"""
+Run History Module
+==================
+
+This module keeps a local history of treatment runs in an SQLite database, `RunStore`. Each run
+records the configuration ID, the protocol parameters, the delivered dose, how the run ended
+(status and error) and the operator's notes, and each period of enabled output within a run is
+recorded as a segment with its frequency, start time, on-time and commanded voltage.
+
+Writes never block the caller: `start_run`, `add_segment`, `end_run` and `add_note` put the rows
+on a queue, and a writer thread commits them in batches, one transaction per batch. The database
+is in WAL mode, so that queries (`query_runs`, `get_segments`), which open their own connection,
+do not wait for the writer. The runs are indexed by date, configuration, power and frequency, for
+a history browser over tens of thousands of runs::
+
+    python -m oncolysis_ctrl.history [-db FILE] [-config CONFIG_ID] [-since YYYY-MM-DD] [-until YYYY-MM-DD]
+                                     [-frequency KHZ] [-power-mode MODE] [-limit N]
+"""
+import datetime
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from oncolysis_ctrl import config, dose
+logger = logging.getLogger("oc.history")
+
+HISTORY_FILENAME = os.path.join(config.LOG_PATH, 'history.sqlite3')
+BATCH_SIZE = 500
+FLUSH_INTERVAL_S = 0.5
+RUN_FIELDS = ('run_id', 'started', 'ended', 'config_id', 'simulate', 'frequencies', 'power_mode', 'power_value',
+              'duration', 'burst_length', 'duty_cycle', 'status', 'error', 'notes') + dose.DOSE_FIELDS
+SEGMENT_FIELDS = ('run_id', 'frequency', 'started', 'on_time_s', 'voltage')
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    started REAL NOT NULL,
+    ended REAL,
+    config_id TEXT,
+    simulate INTEGER,
+    frequencies TEXT,
+    power_mode TEXT,
+    power_value REAL,
+    duration REAL,
+    burst_length REAL,
+    duty_cycle REAL,
+    status TEXT,
+    error TEXT,
+    notes TEXT,
+    {', '.join(f'{field} REAL' for field in dose.DOSE_FIELDS)}
+);
+CREATE TABLE IF NOT EXISTS segments (
+    run_id TEXT NOT NULL,
+    frequency REAL,
+    started REAL,
+    on_time_s REAL,
+    voltage REAL
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE INDEX IF NOT EXISTS runs_config ON runs (config_id, started);
+CREATE INDEX IF NOT EXISTS runs_power ON runs (power_mode, power_value, started);
+CREATE INDEX IF NOT EXISTS segments_run ON segments (run_id);
+CREATE INDEX IF NOT EXISTS segments_frequency ON segments (frequency, run_id);
+"""
+
+
+def connect(filename):
+    """
+    Open the history database, creating it if needed
+
+    :param filename: database file
+    :return: `sqlite3.Connection`
+    """
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(filename, timeout=10)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def to_timestamp(date):
+    """
+    :param date: `datetime.datetime`, `datetime.date`, ISO date string or UNIX time
+    :return: UNIX time (s)
+    """
+    if isinstance(date, (int, float)):
+        return float(date)
+    if isinstance(date, str):
+        date = datetime.datetime.fromisoformat(date)
+    if not isinstance(date, datetime.datetime):
+        date = datetime.datetime.combine(date, datetime.time())
+    return date.timestamp()
+
+
+class RunStore:
+    """
+    Run Store
+    =========
+
+    SQLite store of treatment runs, written from a background thread.
+    """
+    def __init__(self, filename=HISTORY_FILENAME, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL_S):
+        """
+        RunStore constructor. Opens (or creates) the database and starts the writer thread.
+
+        :param filename: database file
+        :param batch_size: maximum number of writes per transaction
+        :param flush_interval: time to wait for more writes before committing a batch (s)
+        """
+        self.filename = filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.n_written = 0
+        self.n_batches = 0
+        connect(filename).close()
+        self.thread = threading.Thread(target=self.writer, name='history', daemon=True)
+        self.thread.start()
+
+    def start_run(self, config_id, protocol, simulate=False, notes='', started=None):
+        """
+        Record the start of a run
+
+        :param config_id: configuration ID
+        :param protocol: dict of frequencies, power_mode, power_value, duration, burst_length and duty_cycle
+        :param simulate: True if the hardware is simulated
+        :param notes: operator notes
+        :param started: start time (UNIX time, default now)
+        :return: run ID
+        """
+        run_id = uuid.uuid4().hex
+        row = {'run_id': run_id,
+               'started': time.time() if started is None else started,
+               'config_id': config_id,
+               'simulate': int(bool(simulate)),
+               'frequencies': json.dumps([float(f) for f in protocol.get('frequencies', ())]),
+               'notes': notes or None}
+        for key in ('power_mode', 'power_value', 'duration', 'burst_length', 'duty_cycle'):
+            value = protocol.get(key)
+            row[key] = value if value is None or isinstance(value, str) else float(value)
+        self.queue.put(('INSERT INTO runs ({}) VALUES ({})'.format(', '.join(row), ', '.join('?' * len(row))),
+                        tuple(row.values())))
+        return run_id
+
+    def add_segment(self, run_id, frequency, started, on_time_s, voltage):
+        """
+        Record a period of enabled output
+
+        :param run_id: run ID
+        :param frequency: frequency (kHz)
+        :param started: start time (s)
+        :param on_time_s: time with the output enabled (s)
+        :param voltage: commanded voltage (V)
+        """
+        self.queue.put(('INSERT INTO segments (run_id, frequency, started, on_time_s, voltage) VALUES (?, ?, ?, ?, ?)',
+                        (run_id, float(frequency), float(started), float(on_time_s), float(voltage))))
+
+    def end_run(self, run_id, status, error=None, dose_totals=None, ended=None):
+        """
+        Record the end of a run
+
+        :param run_id: run ID
+        :param status: how the run ended (e.g. 'Treatment Complete')
+        :param error: error message, if the run ended on an error
+        :param dose_totals: dict of session dose totals (see `dose.DOSE_FIELDS`)
+        :param ended: end time (UNIX time, default now)
+        """
+        dose_totals = dose_totals or {}
+        values = [time.time() if ended is None else ended, status, error] + \
+                 [dose_totals.get(field) for field in dose.DOSE_FIELDS]
+        assignments = ', '.join(f'{field} = ?' for field in ('ended', 'status', 'error') + dose.DOSE_FIELDS)
+        self.queue.put((f'UPDATE runs SET {assignments} WHERE run_id = ?', tuple(values) + (run_id,)))
+
+    def add_note(self, run_id, note):
+        """
+        Append an operator note to a run
+
+        :param run_id: run ID
+        :param note: note text
+        """
+        self.queue.put(("UPDATE runs SET notes = CASE WHEN notes IS NULL THEN ? ELSE notes || char(10) || ? END "
+                        "WHERE run_id = ?", (note, note, run_id)))
+
+    def writer(self):
+        """
+        Writer thread: commit the queued writes in batches, until `close` is called
+        """
+        conn = connect(self.filename)
+        try:
+            while True:
+                item = self.queue.get()
+                batch = [item]
+                deadline = time.monotonic() + self.flush_interval
+                while item is not None and len(batch) < self.batch_size:
+                    try:
+                        item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    batch.append(item)
+                writes = [item for item in batch if item is not None]
+                try:
+                    with conn:
+                        for sql, params in writes:
+                            conn.execute(sql, params)
+                    self.n_written += len(writes)
+                    self.n_batches += 1
+                except sqlite3.Error as e:
+                    logger.error(f'[writer] Could not write {len(writes)} rows: {e}')
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+                if len(writes) < len(batch):
+                    break
+        finally:
+            conn.close()
+
+    def flush(self):
+        """
+        Wait until the queued writes are committed
+        """
+        if self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        """
+        Commit the queued writes and stop the writer thread
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            logger.info(f'[close] Wrote {self.n_written} rows in {self.n_batches} transactions')
+
+    def query_runs(self, since=None, until=None, config_id=None, frequency=None, power_mode=None,
+                   min_power=None, max_power=None, limit=100, offset=0):
+        """
+        Query the runs, most recent first
+
+        :param since: earliest start (datetime, date, ISO string or UNIX time)
+        :param until: latest start (datetime, date, ISO string or UNIX time)
+        :param config_id: configuration ID
+        :param frequency: frequency treated in the run (kHz)
+        :param power_mode: power mode
+        :param min_power: minimum power value
+        :param max_power: maximum power value
+        :param limit: maximum number of runs (None for all)
+        :param offset: number of runs to skip, for paging
+        :return: list of dicts of the `RUN_FIELDS`
+        """
+        clauses = []
+        params = []
+        if since is not None:
+            clauses.append('started >= ?')
+            params.append(to_timestamp(since))
+        if until is not None:
+            clauses.append('started < ?')
+            params.append(to_timestamp(until))
+        if config_id is not None:
+            clauses.append('config_id = ?')
+            params.append(config_id)
+        if power_mode is not None:
+            clauses.append('power_mode = ?')
+            params.append(power_mode)
+        if min_power is not None:
+            clauses.append('power_value >= ?')
+            params.append(min_power)
+        if max_power is not None:
+            clauses.append('power_value <= ?')
+            params.append(max_power)
+        if frequency is not None:
+            clauses.append('run_id IN (SELECT run_id FROM segments WHERE frequency = ?)')
+            params.append(float(frequency))
+        sql = f'SELECT {", ".join(RUN_FIELDS)} FROM runs'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY started DESC'
+        if limit is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            params += [limit, offset]
+        conn = sqlite3.connect(self.filename, timeout=10)
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+        runs = [dict(zip(RUN_FIELDS, row)) for row in rows]
+        for run in runs:
+            run['frequencies'] = json.loads(run['frequencies']) if run['frequencies'] else []
+        return runs
+
+    def get_segments(self, run_id):
+        """
+        :param run_id: run ID
+        :return: list of dicts of the `SEGMENT_FIELDS` of the run, in order
+        """
+        conn = sqlite3.connect(self.filename, timeout=10)
+        try:
+            rows = conn.execute(f'SELECT {", ".join(SEGMENT_FIELDS)} FROM segments WHERE run_id = ? ORDER BY started',
+                                (run_id,)).fetchall()
+        finally:
+            conn.close()
+        return [dict(zip(SEGMENT_FIELDS, row)) for row in rows]
+
+
+def main(args):
+    """
+    List runs from the command line
+
+    :param args: command line arguments
+    :return: exit code
+    """
+    options = {'-db': None, '-config': None, '-since': None, '-until': None, '-frequency': None,
+               '-power-mode': None, '-limit': '50'}
+    i = 0
+    while i < len(args):
+        if args[i] in options and i + 1 < len(args):
+            options[args[i]] = args[i + 1]
+            i += 2
+        else:
+            print(__doc__)
+            return 1
+    store = RunStore(options['-db'] or HISTORY_FILENAME)
+    try:
+        runs = store.query_runs(since=options['-since'], until=options['-until'], config_id=options['-config'],
+                                frequency=None if options['-frequency'] is None else float(options['-frequency']),
+                                power_mode=options['-power-mode'], limit=int(options['-limit']))
+    finally:
+        store.close()
+    for run in runs:
+        started = datetime.datetime.fromtimestamp(run['started']).strftime('%Y-%m-%d %H:%M:%S')
+        frequencies = ','.join(f'{f:g}' for f in run['frequencies'])
+        print(f'{started}  {run["config_id"] or "":<14} {run["power_mode"] or "":<22} {run["power_value"] or 0:>8g}  '
+              f'{frequencies:<24} {run["status"] or "(running)"}')
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,291 @@
+"""
+Logging Module
+==============
+
+This module sets up the application logs. Log calls only put the record on a queue; a
+`logging.handlers.QueueListener` thread does the formatting and writes to the console and the
+session log, so that console and disk I/O stay out of the frequency transition path.
+
+The message is interpolated with its arguments when the record is queued (the arguments may
+change after the call returns), but the formatting of the log line (timestamp, level, name) and
+of any traceback is left to the listener. Hot-path log calls pass their arguments separately
+(``logger.info('[apply] %s', command)``) so that nothing is formatted at all when the level is
+filtered out.
+
+The session log is a JSON lines file: one JSON object per record, with ``time`` (Unix time),
+``level``, ``name``, ``message``, the session fields given to `setup_logging` and any typed event
+fields passed with ``extra`` (see `EVENT_FIELDS`). It is rotated when it reaches
+`LOG_MAX_BYTES`, and rotated files are compressed with gzip. The session log is named after the
+start time and the PID of its process (`make_log_filename`), and compressed when logging stops.
+Session logs left uncompressed by processes that have exited (e.g. after a crash) are compressed in
+the background at startup; the logs of running processes, such as a server and its GUI client,
+are left alone. `session_log` loads them for analysis.
+"""
+import atexit
+import copy
+import glob
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import threading
+
+LOG_FORMAT = '%(asctime)s | %(levelname)s | %(name)s | %(message)s'
+LOGGER_NAME = "oc"
+LOG_EXTENSION = '.jsonl'
+LOG_MAX_BYTES = 20 * 1024 * 1024
+LOG_BACKUP_COUNT = 50
+# Typed fields of the structured events, passed with `extra`
+EVENT_FIELDS = {'event': str,             # event type, e.g. 'command', 'transition', 'treatment_start'
+                'command': str,           # control loop command
+                'config_id': str,         # configuration ID
+                'frequency_khz': float,   # frequency (kHz)
+                'voltage': float,         # function generator voltage (V)
+                'power_mode': str,        # power mode
+                'power_value': float,     # power setting, in the units of the power mode
+                'burst_cycles': int,      # cycles per burst
+                'burst_period_s': float,  # burst period (s)
+                'elapsed_s': float,       # treatment time (s)
+                'latency_ms': float}      # duration of the operation (ms)
+RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+listener = None
+logfile_path = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves the formatting of the log line to the listener
+    """
+    def prepare(self, record):
+        """
+        Prepare a record for the queue, resolving only what can change after the log call
+
+        :param record: log record
+        :return: copy of the record with the message interpolated
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def to_json(value):
+    """
+    Convert values that `json` cannot serialize (e.g. numpy scalars)
+
+    :param value: value
+    :return: serializable value
+    """
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one line of JSON
+    """
+    def __init__(self, fields=None):
+        """
+        :param fields: dict of fields added to every line (e.g. session and host)
+        """
+        super().__init__()
+        self.fields = dict(fields or {})
+
+    def format(self, record):
+        """
+        :param record: log record
+        :return: JSON line
+        """
+        entry = {'time': round(record.created, 6), 'level': record.levelname, 'name': record.name}
+        entry.update(self.fields)
+        entry['message'] = record.getMessage()
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, separators=(',', ':'), default=to_json)
+
+
+def make_log_filename(logpath, timestamp):
+    """
+    :param logpath: log directory
+    :param timestamp: start time of the session
+    :return: path of the session log of this process, named after the start time and the PID, so
+             that processes started in the same second write to different logs
+    """
+    return os.path.join(logpath, f'{timestamp}_{os.getpid()}{LOG_EXTENSION}')
+
+
+def get_log_pid(filename):
+    """
+    :param filename: session log
+    :return: PID of the process writing the log (None if its name does not include it)
+    """
+    stem = os.path.basename(filename)[:-len(LOG_EXTENSION)]
+    _, sep, pid = stem.rpartition('_')
+    return int(pid) if sep and pid.isdigit() else None
+
+
+def is_process_running(pid):
+    """
+    :param pid: process ID
+    :return: True if a process with this ID is running
+    """
+    if sys.platform == 'win32':
+        import ctypes
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        synchronize, wait_timeout, error_access_denied = 0x00100000, 0x102, 5
+        handle = kernel32.OpenProcess(synchronize, False, pid)
+        if not handle:
+            return ctypes.get_last_error() == error_access_denied
+        try:
+            return kernel32.WaitForSingleObject(handle, 0) == wait_timeout
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def get_compressed_filename(filename):
+    """
+    :param filename: session log
+    :return: name of the compressed log, which does not exist yet
+    """
+    dest = filename + '.gz'
+    base = filename[:-len(LOG_EXTENSION)]
+    i = 1
+    while os.path.exists(dest):
+        dest = f'{base}-{i}{LOG_EXTENSION}.gz'
+        i += 1
+    return dest
+
+
+def compress_log(source, dest):
+    """
+    Compress a log file with gzip (the rotator of the session log). The log is only ever present
+    once: if it cannot be removed (e.g. it is open in another process on Windows), the compressed
+    copy is removed again.
+
+    :param source: log file
+    :param dest: compressed file
+    """
+    tmp = dest + '.tmp'
+    with open(source, 'rb') as f_in, gzip.open(tmp, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.replace(tmp, dest)
+    try:
+        os.remove(source)
+    except OSError:
+        os.remove(dest)
+        raise
+
+
+def compress_old_logs(logpath, current=None):
+    """
+    Compress session logs left uncompressed by processes that have exited. Logs of running
+    processes, and logs whose name does not include the PID of their process, are left alone.
+
+    :param logpath: log directory
+    :param current: log file of this session (not compressed)
+    """
+    for filename in glob.glob(os.path.join(logpath, f'*{LOG_EXTENSION}')):
+        if current is not None and os.path.samefile(filename, current):
+            continue
+        pid = get_log_pid(filename)
+        if pid is None or is_process_running(pid):
+            continue
+        try:
+            compress_log(filename, get_compressed_filename(filename))
+        except OSError as e:
+            logging.getLogger(f'{LOGGER_NAME}.logs').warning(f'[compress_old_logs] Could not compress {filename}: {e}')
+
+
+def make_file_handler(logfile, fields=None, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+    """
+    Create the handler of the session log
+
+    :param logfile: path of the session log
+    :param fields: dict of fields added to every line
+    :param max_bytes: size at which the log is rotated
+    :param backup_count: number of rotated files kept
+    :return: `logging.handlers.RotatingFileHandler`
+    """
+    handler = logging.handlers.RotatingFileHandler(logfile, maxBytes=max_bytes, backupCount=backup_count,
+                                                   encoding='utf-8')
+    handler.namer = lambda name: name + '.gz'
+    handler.rotator = compress_log
+    handler.setFormatter(JsonFormatter(fields))
+    handler.addFilter(logging.Filter(LOGGER_NAME))
+    return handler
+
+
+def setup_logging(logfile=None, level=logging.INFO, stream=sys.stdout, fields=None):
+    """
+    Route logging through a queue to the console and (for the "oc" loggers) the session log
+
+    :param logfile: path of the session log (None for console only)
+    :param level: log level
+    :param stream: console stream
+    :param fields: dict of fields added to every line of the session log (e.g. session and host)
+    :return: the `logging.handlers.QueueListener` writing the logs
+    """
+    global listener, logfile_path
+    stop_logging()
+    handlers = []
+    console_handler = logging.StreamHandler(stream)
+    console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handlers.append(console_handler)
+    if logfile is not None:
+        handlers.append(make_file_handler(logfile, fields))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, DeferredQueueHandler):
+            root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    logfile_path = logfile
+    if logfile is not None:
+        threading.Thread(target=compress_old_logs, args=(os.path.dirname(logfile), logfile),
+                         daemon=True).start()
+    return listener
+
+
+def stop_logging():
+    """
+    Stop the listener, after it has written all queued records, and compress the session log
+    """
+    global listener, logfile_path
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        listener = None
+    if logfile_path is not None and os.path.exists(logfile_path):
+        try:
+            compress_log(logfile_path, get_compressed_filename(logfile_path))
+        except OSError as e:
+            print(f'[stop_logging] Could not compress {logfile_path}: {e}', file=sys.stderr)
+    logfile_path = None
+
+
+atexit.register(stop_logging)
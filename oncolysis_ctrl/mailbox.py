@@ -0,0 +1,119 @@
+"""
+GUI Mailbox Module
+==================
+
+Tk widgets may only be used from the thread running the Tk main loop, but the controller reports
+progress from the control loop thread (and, for a remote controller, from the client's reader
+thread). The `Mailbox` carries those events to the main loop: other threads post callbacks to it,
+which only appends to a `collections.deque` (atomic, so no lock is taken and the control loop
+never waits on the GUI), and the main loop drains it with `after()` at a fixed frame rate.
+
+Events that only report the latest state (such as the treatment progress) are posted with a
+coalescing key: of the events with the same key posted within one frame, only the last is run,
+at its place in the order of events, so that a stale progress update never follows the end of a
+treatment.
+
+A thread that needs an answer from the user (such as whether to continue in simulation mode when
+the hardware cannot be connected) uses `call`, which runs a dialog on the main loop and waits for
+its result.
+"""
+import collections
+import logging
+import threading
+import traceback
+logger = logging.getLogger("oc.mailbox")
+
+FRAME_MS = 50
+
+
+class Mailbox:
+    """
+    Mailbox
+    =======
+
+    Lock-free queue of callbacks, run by the Tk main loop.
+    """
+    def __init__(self, root, frame_ms=FRAME_MS):
+        """
+        Mailbox constructor. Call `start` to begin draining.
+
+        :param root: Tk root window
+        :param frame_ms: time between drains (ms)
+        """
+        self.root = root
+        self.frame_ms = frame_ms
+        self.thread = threading.current_thread()
+        self.events = collections.deque()
+        self.n_posted = 0
+        self.n_run = 0
+
+    def post(self, callback, *args, key=None):
+        """
+        Post a callback to run on the main loop. Safe to call from any thread.
+
+        :param callback: function to call
+        :param args: arguments of the call
+        :param key: coalescing key (None to always run the callback)
+        """
+        self.events.append((key, callback, args))
+        self.n_posted += 1
+
+    def wrap(self, callback, key=None):
+        """
+        Wrap a callback so that calling it posts it to the mailbox
+
+        :param callback: function to call on the main loop
+        :param key: coalescing key (None to always run the callback)
+        :return: function with the same arguments, safe to call from any thread
+        """
+        def post(*args):
+            self.post(callback, *args, key=key)
+        return post
+
+    def call(self, callback, *args):
+        """
+        Run a callback on the main loop and wait for its result. Runs it directly when called from
+        the main loop thread.
+
+        :param callback: function to call
+        :param args: arguments of the call
+        :return: the result of the call
+        """
+        if threading.current_thread() is self.thread:
+            return callback(*args)
+        done = threading.Event()
+        result = {}
+
+        def run():
+            try:
+                result['value'] = callback(*args)
+            except Exception as err:
+                result['error'] = err
+            finally:
+                done.set()
+        self.post(run)
+        done.wait()
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    def drain(self):
+        """
+        Run the callbacks posted so far, skipping all but the last of each coalescing key
+        """
+        batch = [self.events.popleft() for _ in range(len(self.events))]
+        last = {key: i for i, (key, callback, args) in enumerate(batch) if key is not None}
+        for i, (key, callback, args) in enumerate(batch):
+            if key is None or last[key] == i:
+                self.n_run += 1
+                try:
+                    callback(*args)
+                except Exception:
+                    logger.error(f'[drain] {getattr(callback, "__name__", callback)} failed:\n{traceback.format_exc()}')
+
+    def start(self):
+        """
+        Drain the mailbox every frame, until the root window is destroyed
+        """
+        self.drain()
+        self.root.after(self.frame_ms, self.start)
@@ -0,0 +1,365 @@
+"""
+Multi-Rig Orchestrator Module
+=============================
+
+This module runs several rigs from one host. Each rig (one function generator and its RF switches)
+is driven by its own `Controller` inside an isolated worker process, so that a crash or a hung USB
+transaction on one rig cannot block the others. The `Orchestrator` holds a shared queue of
+protocols, dispatches them to whichever rig is free, and aggregates the status and telemetry
+reported by the workers.
+
+Each worker talks to the orchestrator over its own pipe. Workers report a heartbeat while idle and
+telemetry from the control loop while treating; a worker that goes silent for longer than
+`hang_timeout` is killed, its job is marked as failed and the worker is restarted.
+
+Rigs can be simulated (``Rig(..., simulate=True)``), so the orchestration can be exercised for any
+number of rigs without hardware::
+
+    rigs = [Rig(f'rig{i}', simulate=True) for i in range(4)]
+    with Orchestrator(rigs) as orch:
+        for protocol in protocols:
+            orch.submit(protocol)
+        results = orch.run()
+"""
+import collections
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import threading
+import time
+from oncolysis_ctrl import config, controller
+logger = logging.getLogger("oc.orchestrator")
+
+HEARTBEAT_S = 1.0
+HANG_TIMEOUT_S = 30.0
+MAX_RESTARTS = 3
+
+
+class Rig:
+    """
+    Description of one rig, passed to its worker process
+    """
+    def __init__(self, rig_id, rf_switch_sn=None, fgen_resource=None, simulate=False, config_id=None):
+        """
+        Rig constructor
+
+        :param rig_id: unique name of the rig
+        :param rf_switch_sn: serial numbers of the rig's RF switches (None for those of the configuration)
+        :param fgen_resource: VISA resource name of the rig's function generator
+        :param simulate: simulate the rig's hardware
+        :param config_id: configuration of the rig (None for the configuration active in this process).
+                          Worker processes may not share the configuration of the host (e.g. under
+                          the spawn start method, they load the one saved in CONFIG_ID.txt).
+        """
+        self.rig_id = rig_id
+        self.config_id = config.config_id if config_id is None else config_id
+        self.rf_switch_sn = tuple(config.get_constants(self.config_id).RADIALL_SN if rf_switch_sn is None
+                                  else rf_switch_sn)
+        self.fgen_resource = fgen_resource
+        self.simulate = simulate
+
+    def __repr__(self):
+        return f'Rig({self.rig_id!r}, config={self.config_id}, sn={self.rf_switch_sn}, resource={self.fgen_resource!r})'
+
+
+class Orchestrator:
+    """
+    Orchestrator
+    ============
+
+    Maps rigs to worker processes and dispatches protocols from a shared job queue. A protocol is a
+    dict of settings accepted by `Controller.configure` (frequencies, power_mode, power_value,
+    duration, burst_length, duty_cycle).
+    """
+    def __init__(self, rigs, hang_timeout=HANG_TIMEOUT_S, heartbeat=HEARTBEAT_S, max_restarts=MAX_RESTARTS,
+                 on_event=None):
+        """
+        Orchestrator constructor. Does not start the workers.
+
+        :param rigs: list of `Rig` objects
+        :param hang_timeout: time without any message from a worker before it is considered hung (s)
+        :param heartbeat: worker heartbeat interval while idle (s)
+        :param max_restarts: maximum number of times a failed worker is restarted
+        :param on_event: callback for every worker message, called as on_event(rig_id, kind, data)
+        """
+        self.rigs = {rig.rig_id: rig for rig in rigs}
+        self.hang_timeout = hang_timeout
+        self.heartbeat = heartbeat
+        self.max_restarts = max_restarts
+        self.on_event = on_event
+        self.jobs = collections.deque()
+        self.job_ids = itertools.count(1)
+        self.results = {}
+        self.workers = {}
+        self.status = {rig_id: {'state': 'stopped',
+                                'job_id': None,
+                                'last_seen': None,
+                                'restarts': 0,
+                                'telemetry': {},
+                                'controller': {}} for rig_id in self.rigs}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def start(self):
+        """
+        Start a worker process for every rig
+        """
+        for rig_id in self.rigs:
+            self.start_worker(rig_id)
+
+    def start_worker(self, rig_id):
+        """
+        Start (or restart) the worker process for a rig
+
+        :param rig_id: rig to start
+        """
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=rig_worker, args=(self.rigs[rig_id], child_conn, self.heartbeat),
+                                          name=f'rig-{rig_id}', daemon=True)
+        process.start()
+        child_conn.close()
+        self.workers[rig_id] = (process, conn)
+        status = self.status[rig_id]
+        status.update(state='connecting', job_id=None, last_seen=time.monotonic())
+        logger.info(f'[start_worker] Started {self.rigs[rig_id]} (pid {process.pid})')
+
+    def submit(self, protocol):
+        """
+        Add a protocol to the job queue
+
+        :param protocol: dict of controller settings
+        :return: job id
+        """
+        job_id = next(self.job_ids)
+        self.jobs.append({'job_id': job_id, 'protocol': dict(protocol)})
+        self.results[job_id] = {'state': 'queued', 'rig_id': None}
+        logger.info(f'[submit] Job {job_id}: {protocol}')
+        return job_id
+
+    def dispatch(self):
+        """
+        Assign queued jobs to idle rigs
+        """
+        for rig_id, status in self.status.items():
+            if not self.jobs:
+                break
+            if status['state'] == 'idle':
+                job = self.jobs.popleft()
+                _, conn = self.workers[rig_id]
+                try:
+                    conn.send(('job', job))
+                except OSError as e:
+                    self.jobs.appendleft(job)
+                    self.fail_worker(rig_id, f'could not send job: {e}')
+                    continue
+                status.update(state='busy', job_id=job['job_id'], last_seen=time.monotonic())
+                self.results[job['job_id']].update(state='dispatched', rig_id=rig_id)
+                logger.info(f'[dispatch] Job {job["job_id"]} -> {rig_id}')
+
+    def poll(self, timeout=0.1):
+        """
+        Receive worker messages, detect failed or hung workers, and dispatch queued jobs
+
+        :param timeout: maximum time to wait for a message (s)
+        """
+        conns = {conn: rig_id for rig_id, (_, conn) in self.workers.items()
+                 if self.status[rig_id]['state'] in ('connecting', 'idle', 'busy')}
+        for conn in multiprocessing.connection.wait(list(conns), timeout=timeout):
+            rig_id = conns[conn]
+            try:
+                while self.workers[rig_id][1] is conn and conn.poll():
+                    kind, data = conn.recv()
+                    self.handle(rig_id, kind, data)
+            except (EOFError, OSError):
+                if self.workers[rig_id][1] is conn:
+                    self.fail_worker(rig_id, 'worker exited')
+        now = time.monotonic()
+        for rig_id, status in self.status.items():
+            if status['state'] in ('connecting', 'idle', 'busy'):
+                process, _ = self.workers[rig_id]
+                if not process.is_alive():
+                    self.fail_worker(rig_id, f'worker exited with code {process.exitcode}')
+                elif now - status['last_seen'] > self.hang_timeout:
+                    self.fail_worker(rig_id, f'no response for {now - status["last_seen"]:0.1f} s')
+        self.dispatch()
+
+    def handle(self, rig_id, kind, data):
+        """
+        Update the aggregated status from a worker message
+
+        :param rig_id: rig that sent the message
+        :param kind: message type
+        :param data: message data
+        """
+        status = self.status[rig_id]
+        status['last_seen'] = time.monotonic()
+        if kind == 'ready':
+            status['state'] = 'idle'
+            logger.info(f'[handle] {rig_id} ready')
+        elif kind == 'heartbeat':
+            status['controller'] = data['status']
+        elif kind == 'telemetry':
+            status['telemetry'] = data
+        elif kind == 'job_end':
+            self.results[data['job_id']].update(state='complete', message=data['message'], dose=data['dose'])
+            status.update(state='idle', job_id=None)
+            logger.info(f'[handle] {rig_id} finished job {data["job_id"]}: {data["message"]}')
+        elif kind == 'job_failed':
+            self.results[data['job_id']].update(state='failed', message=data['message'])
+            status.update(state='idle', job_id=None)
+            logger.error(f'[handle] {rig_id} rejected job {data["job_id"]}: {data["message"]}')
+        elif kind == 'error':
+            logger.error(f'[handle] {rig_id} error: {data["message"]}')
+            self.fail_worker(rig_id, data['message'])
+        if self.on_event is not None:
+            self.on_event(rig_id, kind, data)
+
+    def fail_worker(self, rig_id, reason):
+        """
+        Stop a failed worker, fail its job and restart it if allowed
+
+        :param rig_id: rig whose worker failed
+        :param reason: description of the failure
+        """
+        status = self.status[rig_id]
+        logger.error(f'[fail_worker] {rig_id}: {reason}')
+        process, conn = self.workers[rig_id]
+        if process.is_alive():
+            process.kill()
+        process.join(timeout=1)
+        conn.close()
+        if status['job_id'] is not None:
+            self.results[status['job_id']].update(state='failed', message=reason)
+        status.update(state='failed', job_id=None)
+        if status['restarts'] < self.max_restarts:
+            status['restarts'] += 1
+            self.start_worker(rig_id)
+
+    def is_done(self):
+        """
+        Check whether every submitted job has finished
+        :return: True if no jobs are queued or running
+        """
+        if self.jobs:
+            return not any(status['state'] in ('connecting', 'idle', 'busy') for status in self.status.values())
+        return not any(status['state'] == 'busy' for status in self.status.values())
+
+    def run(self, timeout=None):
+        """
+        Process jobs until the queue is empty and all rigs are idle
+
+        :param timeout: maximum time to run (s), or None to run until done
+        :return: dict of job results
+        """
+        t0 = time.monotonic()
+        while not self.is_done():
+            if timeout is not None and time.monotonic() - t0 > timeout:
+                logger.warning('[run] Timed out')
+                break
+            self.poll()
+        return self.results
+
+    def shutdown(self, timeout=5.0):
+        """
+        Stop all workers
+
+        :param timeout: time to wait for each worker to shut down cleanly (s)
+        """
+        for rig_id, (process, conn) in self.workers.items():
+            try:
+                conn.send(('stop', None))
+            except OSError:
+                pass
+        for rig_id, (process, conn) in self.workers.items():
+            process.join(timeout=timeout)
+            if process.is_alive():
+                logger.warning(f'[shutdown] {rig_id} did not stop. Killing')
+                process.kill()
+                process.join()
+            conn.close()
+            self.status[rig_id]['state'] = 'stopped'
+        logger.info('[shutdown] All workers stopped')
+
+
+def rig_worker(rig, conn, heartbeat=HEARTBEAT_S):
+    """
+    Worker process for a single rig
+
+    Opens the rig's controller, then executes jobs received from the orchestrator one at a time,
+    reporting telemetry from the control loop and a heartbeat while idle.
+
+    :param rig: `Rig` to drive
+    :param conn: connection to the orchestrator
+    :param heartbeat: heartbeat interval while idle (s)
+    :return: None
+    """
+    send_lock = threading.Lock()
+    opened = threading.Event()
+    done = threading.Event()
+    outcome = {}
+
+    def send(kind, **data):
+        with send_lock:
+            conn.send((kind, data))
+
+    def on_wait(elapsed_time, max_time):
+        send('telemetry', elapsed_time=elapsed_time, max_time=max_time, frequency=ctrl.frequency,
+             voltage=float(ctrl.voltage), treat_on=ctrl.treat_on)
+
+    def on_end(message='Treatment Complete'):
+        outcome['message'] = message
+        done.set()
+
+    def on_error(err):
+        outcome['error'] = f'{type(err).__name__}: {err}'
+        opened.set()
+        done.set()
+
+    ctrl = controller.Controller(frequencies=[], rf_switch_sn=rig.rf_switch_sn, fgen_resource=rig.fgen_resource,
+                                 simulate=rig.simulate, ask_simulate=None)
+    # The controller defaults are those of the configuration loaded by this process
+    ctrl.set_constants(config.get_constants(rig.config_id), rf_switch_sn=rig.rf_switch_sn)
+    control_queue = controller.ControlQueue(ctrl, on_open=opened.set, on_wait=on_wait, on_end=on_end,
+                                            on_error=on_error)
+    control_queue.start_queue()
+    try:
+        control_queue.open()
+        opened.wait()
+        if 'error' in outcome or ctrl.connection_error:
+            send('error', message=outcome.get('error', f'Could not connect to {rig}'))
+            return
+        send('ready')
+        while True:
+            if not conn.poll(heartbeat):
+                send('heartbeat', status=ctrl.get_status())
+                continue
+            kind, job = conn.recv()
+            if kind == 'stop':
+                break
+            outcome.clear()
+            done.clear()
+            try:
+                ctrl.configure(**job['protocol'])
+            except (TypeError, ValueError, RuntimeError) as e:
+                send('job_failed', job_id=job['job_id'], message=str(e))
+                continue
+            control_queue.start()
+            done.wait()
+            if 'error' in outcome:
+                send('error', message=outcome['error'])
+                return
+            if outcome['message'] == 'Safety Limit Exceeded':
+                send('job_failed', job_id=job['job_id'], message=outcome['message'])
+                continue
+            send('job_end', job_id=job['job_id'], message=outcome['message'],
+                 dose=ctrl.dose.get_session_totals())
+    finally:
+        if control_queue.control_loop_thread.is_alive():
+            control_queue.kill()
+        conn.close()
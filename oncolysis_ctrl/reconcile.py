@@ -0,0 +1,74 @@
+"""
+State Reconciliation Module
+===========================
+
+This module reconciles the state of the hardware with the state the controller wants it to be in.
+Instead of re-applying every setting on connect, the current instrument state is read in a single
+pass, compared against the desired state, and only the fields that differ are written, by
+`channel_state.compile_transition`. Writes are ordered so that the output is safe throughout: the
+output is disabled first, the amplitude is only ever lowered before the waveform is changed and
+raised after it, and the output is never enabled.
+"""
+import logging
+import time
+from oncolysis_ctrl import channel_state
+logger = logging.getLogger("oc.reconcile")
+
+
+class ReconcileReport:
+    """
+    Summary of a reconciliation pass
+    """
+    def __init__(self):
+        self.fields_read = 0
+        self.fields_changed = {}
+        self.commands = ()
+        self.elapsed = 0.0
+
+    def add(self, field, current, desired):
+        self.fields_changed[field] = (current, desired)
+
+    def __str__(self):
+        changes = ', '.join(f'{field}: {current} -> {desired}'
+                            for field, (current, desired) in self.fields_changed.items())
+        return (f'read {self.fields_read} fields, changed {len(self.fields_changed)}'
+                f'{" (" + changes + ")" if changes else ""} with {len(self.commands)} commands '
+                f'in {self.elapsed * 1e3:0.1f} ms')
+
+
+def reconcile(channel, source_params, burst_params, switches=(), switch_positions=()):
+    """
+    Bring a function generator channel and its RF switches to the desired state with the minimum
+    number of writes, keeping the output disabled.
+
+    :param channel: function_generator.Channel to reconcile
+    :param source_params: desired basic waveform settings (as used by `Channel.apply`)
+    :param burst_params: desired burst settings (as used by `Channel.set_burst`)
+    :param switches: RF switches to reconcile
+    :param switch_positions: desired position of each switch (None to leave unchanged)
+    :return: ReconcileReport
+    """
+    report = ReconcileReport()
+    t0 = time.perf_counter()
+
+    # Read the current state in one pass
+    current = channel.get_state()
+    positions = [switch.get_position() for switch, position in zip(switches, switch_positions)
+                 if position is not None]
+    report.fields_read = len(current.asdict()) + len(positions)
+
+    # Diff against the desired state, and write the changes in a safe order
+    target = channel_state.ChannelState.from_params(source_params, burst_params, output=False)
+    for field, values in current.diff(target).items():
+        report.add(field, *values)
+    report.commands = channel.set_state(target)
+
+    desired = [(switch, position) for switch, position in zip(switches, switch_positions) if position is not None]
+    for i, ((switch, position), current_position) in enumerate(zip(desired, positions)):
+        if current_position != position:
+            switch.set_position(position)
+            report.add(f'switch[{i}].position', current_position, position)
+
+    report.elapsed = time.perf_counter() - t0
+    logger.info(f'[reconcile] {report}')
+    return report
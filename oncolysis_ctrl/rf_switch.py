@@ -3,24 +3,25 @@ RF Switch Module
 ================
 
 This module contains the class for the RF Switch.
+
+The Radiall USB interface cannot time out, so its calls are run by a `transport.TimedCaller`,
+which stops waiting for a call after the timeout of the switch's `transport.RetryPolicy`. Position
+reads are retried after transport errors.
 """
 import logging
 import os
 import serial
 import serial.tools.list_ports
-from oncolysis_ctrl import config
-import clr
+from oncolysis_ctrl import config, transport
 import sys
 import time
 HERE = os.path.dirname(__file__)
 DLL_PATH = os.path.join(HERE, '..', 'dll')
-sys.path.append(DLL_PATH)
-clr.AddReference('Radiall_USBInterface')
-from Radiall_USBInterface import USBInterface
 
 constants = config.constants
 
 VI_FILENAME = os.path.join(HERE, '..', 'LabView', 'RADIALL SPnT USB Interface Controller.vi')
+SETTLE_TIME_S = 0.1
 logger = logging.getLogger("oc.rf_switch")
 
 
@@ -32,7 +33,8 @@ class RFSwitch:
     This class represents the RF Switch. It is responsible for connecting to the
     switch, setting the switch position, and disconnecting from the switch.
     """
-    def __init__(self, comport=None, sn=None, vid=constants.RADIALL_VID, pid=constants.RADIALL_PID):
+    def __init__(self, comport=None, sn=None, vid=constants.RADIALL_VID, pid=constants.RADIALL_PID,
+                 settle_time=SETTLE_TIME_S, policy=None):
         """
         RFSwitch constructor
 
@@ -40,13 +42,18 @@ class RFSwitch:
         :param sn: serial number of USB device (e.g. '31ASW22017741') or None
         :param vid: vendor ID
         :param pid: product ID
+        :param settle_time: time to wait after moving the switch, before reading back its position (s)
+        :param policy: `transport.RetryPolicy` of the I/O (None for the default policy)
         """
         self.comport = comport
-        self.interface = USBInterface()
+        self.settle_time = settle_time
+        self.interface = None
         self.position = -1
         self.is_open = False
         self.target_port = {'vid': vid, 'pid': pid, 'sn': sn}
         self.port_info = {}
+        self.policy = policy if policy is not None else transport.RetryPolicy()
+        self.caller = transport.TimedCaller(f'rf_switch-{sn or comport}')
 
     def open(self):
         """
@@ -71,12 +78,37 @@ class RFSwitch:
                 else:
                     self.port_info = matches[0]
                     self.comport = self.port_info['device']
-            connect_ok = self.interface.Initialize(self.comport)
+            if self.interface is None:
+                self.interface = load_interface()()
+            connect_ok = self.call(self.interface.Initialize, self.comport)
             if not connect_ok:
                 raise IOError(f'Could not connect to {self.comport}')
             self.is_open = True
             logger.info(f'[open] Connected to RF Switch  ({self.comport})')
 
+    def call(self, operation, *args):
+        """
+        Call the interface, waiting at most the timeout of the retry policy
+
+        :param operation: method of the interface
+        :param args: arguments of the method
+        :return: result of the call
+        :raises transport.IOTimeout: if the call does not complete within the timeout
+        """
+        return self.caller.call(self.policy.timeout, operation, *args)
+
+    def reconnect(self):
+        """
+        Close the connection, ignoring errors, and open it again
+        """
+        if self.interface is not None:
+            try:
+                self.call(self.interface.Close)
+            except Exception as e:
+                logger.warning(f'[reconnect] Could not close {self.comport}: {e!r}')
+        self.is_open = False
+        self.open()
+
     def set_position(self, position):
         """
         Set position of switch
@@ -84,14 +116,14 @@ class RFSwitch:
         :param int position: requested position setting (skip if None)
         """
         if position is not None:
-            logger.info(f'[set_position] Setting {self.comport} to {position}')
-            self.interface.SetPosition(position)
-            time.sleep(0.1)
-            read_position = self.interface.GetPosition()
+            logger.info('[set_position] Setting %s to %s', self.comport, position)
+            self.call(self.interface.SetPosition, position)
+            time.sleep(self.settle_time)
+            read_position = self.get_position()
             if position != read_position:
                 raise IOError(f'[set_position] {self.comport} read back wrong position ({read_position} != {position})')
             else:
-                logger.info(f'[set_position] Set {self.comport} to {position}')
+                logger.info('[set_position] Set %s to %s', self.comport, position)
             self.position = position
 
     def get_position(self):
@@ -100,14 +132,14 @@ class RFSwitch:
                 
         :return: int switch position
         """
-        return self.interface.GetPosition()
+        return self.policy.call(f'{self.comport} GetPosition', self.call, self.interface.GetPosition)
 
     def close(self):
         """
         Close the connection to the switch
         """
         if self.is_open:
-            close_ok = self.interface.Close()
+            close_ok = self.call(self.interface.Close)
             if not close_ok:
                 raise IOError(f'[close] Failed to close {self.comport}')
             self.is_open = False
@@ -116,6 +148,21 @@ class RFSwitch:
             logger.warning('[close] Already Disconnected')
 
 
+def load_interface():
+    """
+    Load the Radiall USB interface through pythonnet. The .NET runtime is slow to start, so it is
+    only loaded when a switch is first opened.
+
+    :return: the `USBInterface` class
+    """
+    import clr
+    if DLL_PATH not in sys.path:
+        sys.path.append(DLL_PATH)
+    clr.AddReference('Radiall_USBInterface')
+    from Radiall_USBInterface import USBInterface
+    return USBInterface
+
+
 def get_comport(vid, pid=None, sn=None):
     """
     Return device name of COM port matching VID and PID
@@ -0,0 +1,501 @@
+"""
+Controller Server Module
+========================
+
+This module provides a headless service for the Oncolysis System. A `ControllerServer` wraps a
+`Controller` and its `ControlQueue` and exposes them to local clients over a localhost TCP socket,
+so that the rig can be driven from automation scripts or from several frontends at once.
+
+Messages are newline-delimited JSON objects. Clients send requests of the form
+``{"id": 1, "cmd": "start", "params": {}}`` and receive a response with the same id,
+``{"id": 1, "ok": true, "result": ...}``. State changes and telemetry are pushed to subscribed
+clients as ``{"event": "wait", "data": {...}}``.
+
+The `ControlClient` class implements the client side of the protocol, and `RemoteControlQueue`
+provides the same interface as `ControlQueue`, so that the GUI can attach to a running server as
+one of its clients.
+"""
+import itertools
+import json
+import logging
+import queue
+import socket
+import socketserver
+import threading
+from oncolysis_ctrl import config
+from oncolysis_ctrl import controller as controller_module
+from oncolysis_ctrl import dose, history
+
+logger = logging.getLogger("oc.server")
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 50610
+TOPICS = ('status', 'telemetry')
+CLIENT_QUEUE_SIZE = 1000
+
+
+class ControllerServer(socketserver.ThreadingTCPServer):
+    """
+    Controller Server
+    =================
+
+    Serves a single `Controller` to any number of local clients. Commands from all clients are
+    funneled through one `ControlQueue`, and every event from the control loop is fanned out to
+    the clients subscribed to its topic.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, controller, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """
+        ControllerServer constructor
+
+        :param controller: controller object
+        :param host: address to bind to (should be a loopback address)
+        :param port: TCP port to listen on
+        """
+        super().__init__((host, port), ClientHandler)
+        self.controller = controller
+        self.clients = set()
+        self.clients_lock = threading.Lock()
+        self.control_queue = controller_module.ControlQueue(controller,
+                                                            on_open=self.on_open,
+                                                            on_treat=self.on_treat,
+                                                            on_wait=self.on_wait,
+                                                            on_end=self.on_end,
+                                                            on_close=self.on_close,
+                                                            on_error=self.on_error,
+                                                            on_progress=self.on_progress)
+
+    def add_client(self, client):
+        with self.clients_lock:
+            self.clients.add(client)
+        logger.info(f'[add_client] {client.client_address} connected ({len(self.clients)} clients)')
+
+    def remove_client(self, client):
+        with self.clients_lock:
+            self.clients.discard(client)
+        logger.info(f'[remove_client] {client.client_address} disconnected ({len(self.clients)} clients)')
+
+    def broadcast(self, topic, event, data):
+        """
+        Send an event to every client subscribed to a topic
+
+        :param topic: 'status' or 'telemetry'
+        :param event: event name
+        :param data: JSON-serializable event data
+        :return: None
+        """
+        message = encode({'event': event, 'topic': topic, 'data': data})
+        with self.clients_lock:
+            clients = tuple(self.clients)
+        for client in clients:
+            if topic in client.topics:
+                client.send(message)
+
+    def broadcast_status(self, event, **data):
+        data['status'] = self.controller.get_status()
+        self.broadcast('status', event, data)
+
+    def on_open(self):
+        self.broadcast_status('open')
+
+    def on_treat(self, index):
+        self.broadcast_status('treat', index=index)
+
+    def on_wait(self, elapsed_time, max_time):
+        self.broadcast('telemetry', 'wait', {'elapsed_time': elapsed_time,
+                                             'max_time': max_time,
+                                             'frequency': self.controller.frequency,
+                                             'voltage': float(self.controller.voltage),
+                                             'treat_on': self.controller.treat_on,
+                                             'dose': self.controller.dose.get_session_totals(self.controller.clock.time())})
+
+    def on_end(self, message='Treatment Complete'):
+        self.broadcast_status('end', message=message)
+
+    def on_close(self):
+        self.broadcast_status('close')
+
+    def on_progress(self, stage):
+        self.broadcast_status('progress', stage=stage)
+
+    def on_error(self, err):
+        logger.critical(f'[on_error] {err!r}')
+        self.broadcast_status('error', message=str(err), type=type(err).__name__)
+
+    def dispatch(self, cmd, params):
+        """
+        Execute a client request
+
+        :param cmd: command name
+        :param params: dict of command parameters
+        :return: JSON-serializable result
+        """
+        control_queue = self.control_queue
+        if cmd == 'status':
+            return self.controller.get_status()
+        elif cmd == 'configure':
+            self.controller.configure(**params)
+            self.broadcast_status('configure')
+            return self.controller.get_status()
+        elif cmd == 'connect':
+            if not control_queue.control_loop_thread.is_alive():
+                # A thread can only be started once: replace the thread of a control loop that ended
+                # (e.g. on an error)
+                control_queue.control_loop_thread = control_queue.get_new_thread()
+                control_queue.start_queue()
+            control_queue.open()
+        elif cmd == 'disconnect':
+            if control_queue.control_loop_thread.is_alive():
+                control_queue.kill()
+        elif cmd in ('start', 'pause', 'resume', 'stop', 'reset', 'treat', 'reconcile'):
+            getattr(control_queue, cmd)()
+        else:
+            raise ValueError(f'Unknown command {cmd}')
+        return None
+
+
+class ClientHandler(socketserver.StreamRequestHandler):
+    """
+    Handles a single client connection. Outgoing messages are queued and written by a separate
+    thread, so that a slow client never blocks the control loop or the other clients.
+    """
+    def setup(self):
+        super().setup()
+        self.topics = set()
+        self.outbox = queue.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+        self.server.add_client(self)
+
+    def send(self, message):
+        try:
+            self.outbox.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def write_loop(self):
+        while True:
+            message = self.outbox.get()
+            if message is None:
+                break
+            try:
+                self.wfile.write(message)
+                self.wfile.flush()
+            except OSError:
+                break
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                self.send(encode({'id': None, 'ok': False, 'error': f'Invalid request: {e}'}))
+                continue
+            request_id = request.get('id')
+            cmd = request.get('cmd')
+            params = request.get('params') or {}
+            try:
+                if cmd == 'subscribe':
+                    topics = params.get('topics', TOPICS)
+                    self.topics.update(topic for topic in topics if topic in TOPICS)
+                    result = sorted(self.topics)
+                elif cmd == 'unsubscribe':
+                    self.topics.difference_update(params.get('topics', TOPICS))
+                    result = sorted(self.topics)
+                else:
+                    logger.info(f'[handle] {self.client_address}: {cmd} {params}')
+                    result = self.server.dispatch(cmd, params)
+                response = {'id': request_id, 'ok': True, 'result': result}
+            except Exception as e:
+                logger.error(f'[handle] {cmd} failed: {e!r}')
+                response = {'id': request_id, 'ok': False, 'error': str(e)}
+            self.send(encode(response))
+
+    def finish(self):
+        self.server.remove_client(self)
+        try:
+            self.outbox.put_nowait(None)
+        except queue.Full:
+            pass
+        super().finish()
+
+
+class ControlClient:
+    """
+    Control Client
+    ==============
+
+    Client for a `ControllerServer`. Requests block until the server responds, and events are
+    passed to `on_event(event, data)` from a background reader thread.
+    """
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, on_event=None, timeout=10):
+        """
+        ControlClient constructor. Does not open the connection.
+
+        :param host: server address
+        :param port: server port
+        :param on_event: callback for pushed events, called as on_event(event, data)
+        :param timeout: time to wait for a response (s)
+        """
+        self.address = (host, port)
+        self.on_event = on_event
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+
+    def open(self):
+        """
+        Open the connection to the server
+        """
+        self.sock = socket.create_connection(self.address)
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+        logger.info(f'[open] Connected to server at {self.address[0]}:{self.address[1]}')
+
+    def close(self):
+        """
+        Close the connection to the server
+        """
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+            logger.info('[close] Disconnected from server')
+
+    def request(self, cmd, **params):
+        """
+        Send a request and wait for the response
+
+        :param cmd: command name
+        :param params: command parameters
+        :return: result of the command
+        """
+        if self.sock is None:
+            raise ConnectionError('Not connected to server')
+        request_id = next(self.ids)
+        slot = [threading.Event(), None]
+        with self.pending_lock:
+            self.pending[request_id] = slot
+        with self.send_lock:
+            self.sock.sendall(encode({'id': request_id, 'cmd': cmd, 'params': params}))
+        if not slot[0].wait(self.timeout):
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            raise TimeoutError(f'No response to {cmd}')
+        response = slot[1]
+        if not response['ok']:
+            raise RuntimeError(response['error'])
+        return response['result']
+
+    def subscribe(self, topics=TOPICS):
+        return self.request('subscribe', topics=list(topics))
+
+    def read_loop(self):
+        with self.sock.makefile('rb') as rfile:
+            try:
+                for line in rfile:
+                    message = json.loads(line)
+                    if 'event' in message:
+                        if self.on_event is not None:
+                            self.on_event(message['event'], message['data'])
+                    else:
+                        with self.pending_lock:
+                            slot = self.pending.pop(message['id'], None)
+                        if slot is not None:
+                            slot[1] = message
+                            slot[0].set()
+            except (OSError, ValueError) as e:
+                logger.warning(f'[read_loop] Connection lost: {e!r}')
+        if self.on_event is not None:
+            self.on_event('disconnect', {})
+
+
+class RemoteControlQueue:
+    """
+    Remote Control Queue
+    ====================
+
+    Drop-in replacement for `ControlQueue` that forwards commands to a `ControllerServer`. The local
+    controller holds the settings chosen in the GUI and mirrors the connection and output state of
+    the remote controller (from its status and telemetry), and the callbacks are invoked from the client's reader thread, just as the
+    `ControlQueue` callbacks are invoked from the control thread.
+    """
+    def __init__(self, controller, host=DEFAULT_HOST, port=DEFAULT_PORT, on_open=None, on_treat=None,
+                 on_wait=None, on_end=None, on_close=None, on_error=None, on_progress=None):
+        """
+        RemoteControlQueue constructor
+
+        :param controller: local controller object holding the treatment settings
+        :param host: server address
+        :param port: server port
+        :param on_open: callback to execute on open
+        :param on_treat: callback to execute on treat
+        :param on_wait: callback to execute on wait
+        :param on_end: callback to execute on end
+        :param on_close: callback to execute on close
+        :param on_error: callback to execute on error
+        :param on_progress: callback to execute at each stage of opening the connection, with the stage name
+        """
+        self.controller = controller
+        self.client = ControlClient(host, port, on_event=self.on_event)
+        self.on_open = on_open
+        self.on_treat = on_treat
+        self.on_wait = on_wait
+        self.on_end = on_end
+        self.on_close = on_close
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.dose_totals = dict.fromkeys(dose.DOSE_FIELDS, 0.0)
+
+    def sync(self, status):
+        """
+        Mirror the remote connection state on the local controller
+        """
+        self.controller.is_connected = status['is_connected']
+        self.controller.connection_error = status['connection_error']
+        self.controller.simulate = status['simulate']
+        self.sync_output(status)
+
+    def sync_output(self, data):
+        """
+        Mirror the remote output state (from a status or a telemetry event) on the local controller
+        """
+        self.controller.treat_on = data['treat_on']
+        self.controller.frequency = data['frequency']
+        self.controller.voltage = data['voltage']
+        self.dose_totals = data['dose']
+
+    def get_dose_totals(self, t=None):
+        """
+        :param t: current time (s), unused: the totals are those of the last status or telemetry event
+        :return: dict of session dose totals of the remote controller
+        """
+        return self.dose_totals
+
+    def on_event(self, event, data):
+        if 'status' in data:
+            self.sync(data['status'])
+        elif event == 'wait':
+            self.sync_output(data)
+        if event == 'open' and self.on_open is not None:
+            self.on_open()
+        elif event == 'treat' and self.on_treat is not None:
+            self.on_treat(data['index'])
+        elif event == 'wait' and self.on_wait is not None:
+            self.on_wait(data['elapsed_time'], data['max_time'])
+        elif event == 'end' and self.on_end is not None:
+            self.on_end(data['message'])
+        elif event == 'close' and self.on_close is not None:
+            self.on_close()
+        elif event == 'progress' and self.on_progress is not None:
+            self.on_progress(data['stage'])
+        elif event == 'error' and self.on_error is not None:
+            self.on_error(RuntimeError(data['message']))
+        elif event == 'disconnect' and self.controller.is_connected and self.on_error is not None:
+            self.on_error(ConnectionError('Lost connection to controller server'))
+
+    def start_queue(self):
+        """
+        Connect to the server and subscribe to all events
+        """
+        self.client.open()
+        self.client.subscribe()
+        self.client.request('configure', simulate=self.controller.simulate)
+
+    def put(self, msg):
+        """
+        Forward a command to the server
+
+        :param msg: command, as used by `ControlQueue`
+        """
+        if self.client.sock is None:
+            raise ConnectionError('Not connected to server')
+        self.client.request(msg.lower())
+
+    def open(self):
+        self.client.request('connect')
+
+    def start(self):
+        c = self.controller
+        self.client.request('configure', frequencies=list(c.frequencies), power_mode=c.power_mode,
+                            power_value=c.power_value, duration=c.duration, burst_length=c.burst_length,
+                            duty_cycle=c.burst_duty_cycle)
+        self.put('START')
+
+    def resume(self):
+        self.put('RESUME')
+
+    def pause(self):
+        self.put('PAUSE')
+
+    def stop(self):
+        self.put('STOP')
+
+    def reset(self):
+        self.put('RESET')
+
+    def treat(self):
+        self.put('TREAT')
+
+    def reconcile(self):
+        self.put('RECONCILE')
+
+    def kill(self):
+        """
+        Disconnect the remote controller and close the connection to the server
+        """
+        try:
+            self.client.request('disconnect')
+        finally:
+            self.client.close()
+            self.controller.is_connected = False
+
+
+def encode(message):
+    """
+    Encode a message as a line of JSON
+
+    :param message: JSON-serializable message
+    :return: bytes
+    """
+    return (json.dumps(message, default=float) + '\n').encode()
+
+
+def serve(simulate=False, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    Run a headless controller server until interrupted
+
+    :param simulate: If True, the controller will not communicate with the hardware
+    :param host: address to bind to
+    :param port: TCP port to listen on
+    :return: None
+    """
+    store = history.RunStore()
+    ctrl = controller_module.Controller(frequencies=[], simulate=simulate, ask_simulate=None, history=store)
+    # The controller defaults were bound when the module was imported, possibly before the
+    # configuration was loaded
+    ctrl.set_constants(config.constants)
+    server = ControllerServer(ctrl, host=host, port=port)
+    logger.info(f'[serve] Listening on {host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('[serve] Interrupted')
+    finally:
+        if server.control_queue.control_loop_thread.is_alive():
+            server.control_queue.kill()
+        server.server_close()
+        store.close()
+        logger.info('[serve] Shut down')
@@ -0,0 +1,248 @@
+"""
+Session Log Module
+==================
+
+This module loads the JSON lines session logs written by `logs` (plain or gzip-compressed) into a
+columnar table, for analysis of the treatment history and transition latencies across many
+sessions and systems. The logs are streamed one line at a time, and lines of other events are
+skipped before they are parsed when only some events are requested, so that any number of logs
+can be loaded.
+
+The table is a dict of numpy arrays, one per field. The typed fields (`logs.EVENT_FIELDS` and
+``time``) are float arrays, with NaN where a record has no value, or object arrays for text. It
+can be converted to a pandas DataFrame with `to_dataframe` if pandas is installed::
+
+    python -m oncolysis_ctrl.session_log LOG_DIR_OR_FILE [...] [-event EVENT[,EVENT...]] [-csv table.csv]
+"""
+import csv
+import glob
+import gzip
+import json
+import logging
+import os
+import sys
+import numpy as np
+from oncolysis_ctrl import logs
+logger = logging.getLogger("oc.session_log")
+
+NUMERIC_FIELDS = {'time'} | {name for name, kind in logs.EVENT_FIELDS.items() if kind in (int, float)}
+
+
+def find_logs(paths):
+    """
+    Find the session logs in a list of files and directories (searched recursively)
+
+    :param paths: list of files and directories
+    :return: sorted list of log files
+    """
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in (f'*{logs.LOG_EXTENSION}', f'*{logs.LOG_EXTENSION}*.gz'):
+                filenames.extend(glob.glob(os.path.join(path, '**', pattern), recursive=True))
+        else:
+            filenames.append(path)
+    return sorted(set(filenames))
+
+
+def open_log(filename):
+    """
+    :param filename: session log (gzip-compressed if it ends with .gz)
+    :return: text file object
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', encoding='utf-8')
+    return open(filename, 'r', encoding='utf-8')
+
+
+def iter_records(filenames, events=None):
+    """
+    Stream the records of session logs
+
+    :param filenames: list of session logs
+    :param events: list of event types to keep (None for all records)
+    :return: generator of dicts
+    """
+    tokens = None if events is None else [f'"event":"{event}"' for event in events]
+    for filename in filenames:
+        n_bad = 0
+        with open_log(filename) as f:
+            for line in f:
+                if tokens is not None and not any(token in line for token in tokens):
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    n_bad += 1
+                    continue
+                if events is None or record.get('event') in events:
+                    yield record
+        if n_bad:
+            logger.warning(f'[iter_records] Skipped {n_bad} invalid lines in {filename}')
+
+
+def to_array(name, values):
+    """
+    Convert a column to a numpy array
+
+    :param name: field name
+    :param values: list of values (None where missing)
+    :return: float array (NaN where missing) for numeric fields, otherwise object array
+    """
+    numeric = name in NUMERIC_FIELDS or all(isinstance(v, (int, float)) and not isinstance(v, bool)
+                                            for v in values if v is not None)
+    if numeric and any(v is not None for v in values):
+        try:
+            return np.array([np.nan if v is None else v for v in values], dtype=float)
+        except (TypeError, ValueError):
+            pass
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def load(paths, events=None, fields=None):
+    """
+    Load session logs into a columnar table
+
+    :param paths: list of session logs and directories containing them
+    :param events: list of event types to keep (None for all records)
+    :param fields: list of fields to keep (None for all fields found)
+    :return: dict of numpy arrays, one per field
+    """
+    filenames = find_logs(paths)
+    columns = {name: [] for name in fields} if fields is not None else {}
+    n = 0
+    for record in iter_records(filenames, events):
+        if fields is None:
+            for key in record:
+                if key not in columns:
+                    columns[key] = [None] * n
+        for key, column in columns.items():
+            column.append(record.get(key))
+        n += 1
+    logger.info(f'[load] Loaded {n} records from {len(filenames)} logs')
+    return {name: to_array(name, values) for name, values in columns.items()}
+
+
+def to_dataframe(table):
+    """
+    Convert a table to a pandas DataFrame
+
+    :param table: dict of arrays, as returned by `load`
+    :return: `pandas.DataFrame`
+    """
+    import pandas
+    return pandas.DataFrame(table)
+
+
+def group_stats(keys, values):
+    """
+    Statistics of values grouped by key
+
+    :param keys: array of group keys
+    :param values: array of values
+    :return: dict of {key: {'n', 'total', 'median', 'p99', 'max'}}
+    """
+    valid = ~np.isnan(values)
+    keys, values = keys[valid], values[valid]
+    if len(keys) == 0:
+        return {}
+    unique, inverse = np.unique(keys, return_inverse=True)
+    order = np.lexsort((values, inverse))
+    bounds = np.searchsorted(inverse[order], np.arange(len(unique) + 1))
+    stats = {}
+    for k, key in enumerate(unique.tolist()):
+        group = values[order[bounds[k]:bounds[k + 1]]]
+        stats[key] = {'n': len(group),
+                      'total': float(group.sum()),
+                      'median': float(np.median(group)),
+                      'p99': float(np.percentile(group, 99)),
+                      'max': float(group[-1])}
+    return stats
+
+
+def transition_latency(table):
+    """
+    Frequency transition latency by frequency
+
+    :param table: table containing transition events
+    :return: dict of {frequency (kHz): stats of latency (ms)}, as `group_stats`
+    """
+    transitions = table['event'] == 'transition'
+    return group_stats(table['frequency_khz'][transitions], table['latency_ms'][transitions])
+
+
+def treatment_time(table):
+    """
+    Treatment time by frequency
+
+    :param table: table containing treatment_stop events
+    :return: dict of {frequency (kHz): stats of treatment time (s)}, as `group_stats`
+    """
+    stops = table['event'] == 'treatment_stop'
+    return group_stats(table['frequency_khz'][stops], table['elapsed_s'][stops])
+
+
+def write_csv(table, filename):
+    """
+    Write a table to a CSV file
+
+    :param table: dict of arrays
+    :param filename: CSV file
+    """
+    names = list(table)
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        for row in zip(*(table[name].tolist() for name in names)):
+            writer.writerow(['' if v is None or v != v else v for v in row])
+
+
+def main(args):
+    """
+    Summarize session logs from the command line
+
+    :param args: command line arguments
+    :return: exit code
+    """
+    paths = []
+    events = None
+    csv_filename = None
+    i = 0
+    while i < len(args):
+        if args[i] == '-event':
+            events = args[i + 1].split(',')
+            i += 2
+        elif args[i] == '-csv':
+            csv_filename = args[i + 1]
+            i += 2
+        else:
+            paths.append(args[i])
+            i += 1
+    if not paths:
+        print(__doc__)
+        return 1
+    table = load(paths, events=events)
+    n = len(next(iter(table.values()), []))
+    sessions = set(table['session'].tolist()) - {None} if 'session' in table else set()
+    hosts = set(table['host'].tolist()) - {None} if 'host' in table else set()
+    print(f'{n} records, {len(sessions)} sessions, {len(hosts)} hosts')
+    if n and 'event' in table:
+        if 'latency_ms' in table:
+            print('Transition latency (ms):')
+            for f, stats in transition_latency(table).items():
+                print(f'  {f:>8g} kHz  n={stats["n"]:<6d} median={stats["median"]:8.3f}  p99={stats["p99"]:8.3f}  '
+                      f'max={stats["max"]:8.3f}')
+        if 'elapsed_s' in table:
+            print('Treatment time (s):')
+            for f, stats in treatment_time(table).items():
+                print(f'  {f:>8g} kHz  n={stats["n"]:<6d} total={stats["total"]:10.1f}')
+    if csv_filename is not None:
+        write_csv(table, csv_filename)
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
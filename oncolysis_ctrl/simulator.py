@@ -0,0 +1,317 @@
+"""
+Hardware Simulator Module
+=========================
+
+This module contains local stand-ins for the instruments, for benchmarking and exercising the
+driver code paths without hardware:
+
+* `SimulatedInstrument` answers the SCPI commands of the Rigol DG4162 used by
+  `function_generator.Channel`, keeping the settings written so that they are read back by
+  queries, and `SimulatedResourceManager` opens it in place of `pyvisa.ResourceManager`.
+* `SimulatedSwitchInterface` stands in for the Radiall USB interface of an `rf_switch.RFSwitch`.
+
+Each command can be given a latency, to model the USB round trip, and the commands are counted.
+Transport faults can be injected: `stall` makes the next commands hang (the simulated VISA session
+times out as pyvisa does, while the switch interface, like the Radiall DLL, blocks until the stall
+ends), and `disconnect` drops the session until it is opened again.
+`attach` connects a `controller.Controller` to simulated instruments, so that `Controller.open`,
+`set_frequency` and the control loop run the same driver code as with the hardware. Unlike
+simulation mode (``simulate=True``), which skips the instrument calls, every command is issued.
+"""
+import time
+from oncolysis_ctrl import transport
+
+IDN = 'Rigol Technologies,DG4162,SIM0000000001,00.01.00'
+RESOURCE = 'USB0::0x1AB1::0x0641::SIM0000000001::INSTR'
+# Settings of a channel after reset, keyed by the command header without the channel prefix
+DEFAULTS = {'OUTPUT:STAT': 'OFF', 'OUTPUT:IMP': 'INFINITY', 'OUTPUT:NOISE:SCALE': '10',
+            'OUTPUT:NOISE:STAT': 'OFF', 'OUTPUT:POL': 'NORMAL', 'OUTPUT:SYNC:POL': 'POS',
+            'OUTPUT:SYNC:STAT': 'ON',
+            'SOURCE:BURST:STAT': 'OFF', 'SOURCE:BURST:INTERNAL:PERIOD': '0.01', 'SOURCE:BURST:MODE': 'TRIG',
+            'SOURCE:BURST:NCYCLES': '1', 'SOURCE:BURST:PHASE': '0', 'SOURCE:BURST:TDELAY': '0',
+            'SOURCE:BURST:TRIG:SLOPE': 'POS', 'SOURCE:BURST:TRIG:SOURCE': 'INT', 'SOURCE:BURST:TRIG:TRIGOUT': 'OFF',
+            'SOURCE:BURST:GATE:POL': 'NORM',
+            'SOURCE:FUNCTION': 'SIN', 'SOURCE:FREQUENCY:FIXED': '1000', 'SOURCE:PERIOD': '0.001',
+            'SOURCE:PHASE': '0', 'SOURCE:VOLTAGE:LEVEL:IMMEDIATE:AMPLITUDE': '0.005',
+            'SOURCE:VOLTAGE:LEVEL:IMMEDIATE:HIGH': '0.0025', 'SOURCE:VOLTAGE:LEVEL:IMMEDIATE:LOW': '-0.0025',
+            'SOURCE:VOLTAGE:LEVEL:IMMEDIATE:OFFSET': '0', 'SOURCE:VOLTAGE:UNIT': 'VPP'}
+# Responses differ from the values written for some settings
+RESPONSES = {'OUTPUT:POL': {'NORM': 'NORMAL', 'INV': 'INVERTED'},
+             'OUTPUT:SYNC:POL': {'POSITIVE': 'POS', 'NEGATIVE': 'NEG'},
+             'SOURCE:BURST:TRIG:SLOPE': {'POSITIVE': 'POS', 'NEGATIVE': 'NEG'}}
+APPLY_FIELDS = ('SOURCE:FREQUENCY:FIXED', 'SOURCE:VOLTAGE:LEVEL:IMMEDIATE:AMPLITUDE',
+                'SOURCE:VOLTAGE:LEVEL:IMMEDIATE:OFFSET', 'SOURCE:PHASE')
+
+
+def wait(seconds):
+    """
+    Wait for a short time. Busy-waits below a millisecond, where `time.sleep` is too coarse.
+
+    :param seconds: time to wait (s)
+    """
+    if seconds >= 1e-3:
+        time.sleep(seconds)
+    elif seconds > 0:
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+
+class VisaIOError(IOError):
+    """
+    Stand-in for `pyvisa.errors.VisaIOError`
+    """
+    def __init__(self, error_code, description):
+        super().__init__(f'{description} ({error_code})')
+        self.error_code = error_code
+
+
+class IOException(IOError):
+    """
+    Stand-in for the `System.IO.IOException` raised by the Radiall USB interface
+    """
+
+
+# VISA status code of a lost connection (VI_ERROR_CONN_LOST)
+VI_ERROR_CONN_LOST = -1073807194
+
+
+class Faults:
+    """
+    Transport faults injected into a simulated device
+    """
+    def __init__(self):
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.connected = True
+
+    def stall(self, count=1, duration=10.0):
+        """
+        Make the next commands hang
+
+        :param count: number of commands
+        :param duration: time each command hangs (s)
+        """
+        self.stalls = count
+        self.stall_time = duration
+
+    def disconnect(self):
+        """
+        Drop the session: commands fail until the device is opened again
+        """
+        self.connected = False
+
+    def next_stall(self):
+        """
+        :return: time the next command hangs (s)
+        """
+        if not self.stalls:
+            return 0.0
+        self.stalls -= 1
+        return self.stall_time
+
+
+def parse_header(header):
+    """
+    Split a command header into its channel and a normalized key
+
+    :param header: command header, e.g. 'SOUR1:BURST:STATE'
+    :return: (channel, key), e.g. (1, 'SOURCE:BURST:STAT'). The channel is None for common commands.
+    """
+    root, _, rest = header.partition(':')
+    channel = None
+    for prefix, name in (('SOURCE', 'SOURCE'), ('SOUR', 'SOURCE'), ('OUTPUT', 'OUTPUT'), ('OUTP', 'OUTPUT')):
+        if root.startswith(prefix) and root[len(prefix):].isdigit():
+            channel = int(root[len(prefix):])
+            root = name
+            break
+    key = f'{root}:{rest}' if rest else root
+    if key.endswith(':STATE'):
+        key = key[:-len('STATE')] + 'STAT'
+    return channel, key
+
+
+class SimulatedInstrument:
+    """
+    Simulated Rigol DG4162
+    ======================
+
+    Stand-in for a pyvisa instrument resource.
+    """
+    def __init__(self, latency=0.0, channels=(1, 2)):
+        """
+        SimulatedInstrument constructor
+
+        :param latency: time taken by each command (s)
+        :param channels: channels of the instrument
+        """
+        self.latency = latency
+        self.channels = channels
+        # Session timeout (ms, None to wait indefinitely), set by the client as for pyvisa
+        self.timeout = None
+        self.faults = Faults()
+        self.settings = {}
+        self.n_writes = 0
+        self.n_queries = 0
+        self.reset()
+
+    @property
+    def n_commands(self):
+        return self.n_writes + self.n_queries
+
+    def reset(self):
+        """
+        Restore the settings after reset
+        """
+        self.settings = {(channel, key): value for channel in self.channels for key, value in DEFAULTS.items()}
+
+    def transact(self):
+        """
+        Wait for the round trip of a command, applying the injected faults
+        """
+        if not self.faults.connected:
+            raise VisaIOError(VI_ERROR_CONN_LOST, 'VI_ERROR_CONN_LOST: The connection for the given session has been lost.')
+        stall = self.faults.next_stall()
+        if stall:
+            timeout = self.timeout / 1e3 if self.timeout is not None else None
+            if timeout is not None and stall > timeout:
+                wait(timeout)
+                raise VisaIOError(transport.VI_ERROR_TMO, 'VI_ERROR_TMO: Timeout expired before operation completed.')
+            wait(stall)
+        wait(self.latency)
+
+    def write(self, command):
+        """
+        :param command: SCPI command
+        """
+        self.transact()
+        self.n_writes += 1
+        header, _, value = command.strip().partition(' ')
+        if header == '*RST':
+            self.reset()
+            return
+        channel, key = parse_header(header)
+        if channel is None:
+            return
+        if key.startswith('SOURCE:APPLY:'):
+            self.settings[(channel, 'SOURCE:FUNCTION')] = key[len('SOURCE:APPLY:'):]
+            for field, arg in zip(APPLY_FIELDS, value.split(',')):
+                self.settings[(channel, field)] = arg.strip()
+        elif key == 'SOURCE:BURST:TRIGGER:IMMEDIATE':
+            pass
+        else:
+            self.settings[(channel, key)] = RESPONSES.get(key, {}).get(value, value)
+
+    def query(self, command):
+        """
+        :param command: SCPI query
+        :return: response, terminated by a newline
+        """
+        self.transact()
+        self.n_queries += 1
+        header = command.strip().rstrip('?')
+        if header == '*IDN':
+            return IDN + '\n'
+        if header == '*OPC':
+            return '1\n'
+        if header == 'SYSTEM:ERROR':
+            return '0,"No error"\n'
+        channel, key = parse_header(header)
+        if key == 'SOURCE:APPLY':
+            values = ','.join(self.settings[(channel, field)] for field in APPLY_FIELDS)
+            return f'"{self.settings[(channel, "SOURCE:FUNCTION")]},{values}"\n'
+        return self.settings.get((channel, key), '0') + '\n'
+
+    def close(self):
+        pass
+
+
+class SimulatedResourceManager:
+    """
+    Stand-in for `pyvisa.ResourceManager`, opening a `SimulatedInstrument`
+    """
+    def __init__(self, latency=0.0, resource=RESOURCE):
+        """
+        :param latency: time taken by each command of the instrument (s)
+        :param resource: resource name of the instrument
+        """
+        self.resource = resource
+        self.instrument = SimulatedInstrument(latency=latency)
+
+    def list_resources(self):
+        return (self.resource,)
+
+    def open_resource(self, resource):
+        if resource != self.resource:
+            raise ConnectionError(f'Instrument {resource} not found')
+        self.instrument.faults.connected = True
+        return self.instrument
+
+
+class SimulatedSwitchInterface:
+    """
+    Stand-in for the Radiall USB interface of an `rf_switch.RFSwitch`
+    """
+    def __init__(self, latency=0.0):
+        """
+        :param latency: time taken by each command (s)
+        """
+        self.latency = latency
+        self.position = 1
+        self.n_commands = 0
+        self.faults = Faults()
+
+    def transact(self):
+        """
+        Wait for the round trip of a command, applying the injected faults
+        """
+        if not self.faults.connected:
+            raise IOException('The port is closed.')
+        wait(self.faults.next_stall() + self.latency)
+
+    def Initialize(self, comport):
+        wait(self.latency)
+        self.faults.connected = True
+        return True
+
+    def SetPosition(self, position):
+        self.transact()
+        self.n_commands += 1
+        self.position = position
+
+    def GetPosition(self):
+        self.transact()
+        self.n_commands += 1
+        return self.position
+
+    def Close(self):
+        return True
+
+
+def attach(controller, latency=0.0, switch_latency=0.0, settle_time=0.0):
+    """
+    Connect a controller to simulated instruments. Call before `Controller.open`.
+
+    :param controller: `controller.Controller` (not in simulation mode)
+    :param latency: time taken by each function generator command (s)
+    :param switch_latency: time taken by each RF switch command (s)
+    :param settle_time: time the RF switches wait after moving (s)
+    :return: the `SimulatedInstrument`
+    """
+    resource_manager = SimulatedResourceManager(latency=latency)
+    controller.fgen.resource_manager = resource_manager
+    controller.fgen.resource = resource_manager.resource
+    for i, switch in enumerate(controller.switches):
+        switch.comport = f'SIM{i + 1}'
+        switch.interface = SimulatedSwitchInterface(latency=switch_latency)
+        switch.settle_time = settle_time
+    return resource_manager.instrument
+
+
+def count_commands(controller):
+    """
+    :param controller: controller attached with `attach`
+    :return: total number of commands sent to the simulated instruments
+    """
+    instrument = controller.fgen.resource_manager.instrument
+    return instrument.n_commands + sum(switch.interface.n_commands for switch in controller.switches)
@@ -0,0 +1,251 @@
+"""
+Strip Chart Module
+==================
+
+This module contains a live strip chart for the GUI, `StripChart`, which plots the recent history
+of a few traces (such as the commanded voltage, the output state, the frequency segment and the
+cumulative dose) against time, each in its own horizontal band of a `tkinter.Canvas`.
+
+The chart samples its source at a fixed refresh rate into a bounded buffer, and draws each new
+sample incrementally: while a trace is flat, its last line is extended instead of adding a new
+one, the view is scrolled by moving the scroll region rather than the items, and items that have
+scrolled out of view are deleted. The number of canvas items and the work per refresh therefore
+stay constant over an hours-long session. The whole chart is only redrawn (from the buffer) when
+the canvas is resized.
+"""
+import collections
+import logging
+import tkinter as tk
+logger = logging.getLogger("oc.stripchart")
+
+REFRESH_MS = 250
+WINDOW_S = 300
+PALETTE = ('#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#17becf')
+
+
+class Trace:
+    """
+    A trace of a strip chart, drawn in its own band
+    """
+    def __init__(self, name, label, full_scale=None, step=True, categorical=False, fmt='{:g}', color='#002030'):
+        """
+        Trace constructor
+
+        :param name: key of the trace in the samples
+        :param label: label shown next to the band
+        :param full_scale: value at the top of the band (None to scale to the data, doubling as needed)
+        :param step: True to draw the value as constant until the next sample (False to interpolate)
+        :param categorical: True to draw each distinct value as a coloured segment, labelled where it starts
+        :param fmt: format string or function formatting a value for the labels
+        :param color: line colour
+        """
+        self.name = name
+        self.label = label
+        self.full_scale = full_scale
+        self.step = step
+        self.categorical = categorical
+        self.fmt = fmt
+        self.color = color
+
+    def format(self, value):
+        """
+        :return: value formatted for the labels
+        """
+        return self.fmt(value) if callable(self.fmt) else self.fmt.format(value)
+
+
+class StripChart(tk.Frame):
+    """
+    Strip Chart
+    ===========
+
+    Scrolling chart of traces sampled from a function at a fixed rate.
+    """
+    def __init__(self, master, sample, traces, refresh_ms=REFRESH_MS, window_s=WINDOW_S, height=160, width=560,
+                 font=None, **kwargs):
+        """
+        StripChart constructor. Call `start` to begin sampling.
+
+        :param master: parent widget
+        :param sample: function returning the current sample, as a dict with 't' (time, s) and a value
+                       per trace name (None where there is no value)
+        :param traces: list of `Trace`
+        :param refresh_ms: time between samples (ms)
+        :param window_s: time span shown (s)
+        :param height: canvas height (pixels)
+        :param width: canvas width (pixels)
+        :param font: font of the labels
+        """
+        super().__init__(master, **kwargs)
+        self.sample = sample
+        self.traces = traces
+        self.refresh_ms = refresh_ms
+        self.window_s = window_s
+        self.samples = collections.deque(maxlen=int(window_s * 1000 / refresh_ms) + 2)
+        self.job = None
+        self.labels = {}
+        self.label_vars = {}
+        for i, trace in enumerate(traces):
+            self.label_vars[trace.name] = tk.StringVar(value=trace.label)
+            self.labels[trace.name] = tk.Label(self, textvariable=self.label_vars[trace.name], anchor='w', width=16,
+                                               font=font, foreground=trace.color)
+            self.labels[trace.name].grid(row=i, column=0, sticky='nsw')
+            self.grid_rowconfigure(i, weight=1)
+        self.canvas = tk.Canvas(self, height=height, width=width, background='white', highlightthickness=0)
+        self.canvas.grid(row=0, column=1, rowspan=len(traces), sticky='nsew')
+        self.grid_columnconfigure(1, weight=1)
+        self.width = width
+        self.height = height
+        self.reset_drawing()
+        self.canvas.bind('<Configure>', self.on_resize)
+
+    def reset_drawing(self):
+        """
+        Clear the canvas and the drawing state of each trace
+        """
+        self.canvas.delete('all')
+        self.px_per_s = self.width / self.window_s
+        self.band = self.height / len(self.traces)
+        self.index = {trace.name: i for i, trace in enumerate(self.traces)}
+        self.scales = {trace.name: trace.full_scale or 1.0 for trace in self.traces}
+        # Per trace: canvas items in time order, the last point and value drawn, and whether the
+        # last item is a horizontal line that can be extended
+        self.items = {trace.name: collections.deque() for trace in self.traces}
+        self.last = {trace.name: None for trace in self.traces}
+        self.values = {trace.name: None for trace in self.traces}
+        self.flat = {trace.name: False for trace in self.traces}
+        self.colors = {}
+        self.t0 = None
+        for i in range(1, len(self.traces)):
+            self.canvas.create_line(-1e9, i * self.band, 1e12, i * self.band, fill='#e0e0e0', tags='grid')
+
+    def start(self):
+        """
+        Sample and draw at the refresh rate, until `stop` is called
+        """
+        self.refresh()
+
+    def stop(self):
+        """
+        Stop sampling
+        """
+        if self.job is not None:
+            self.after_cancel(self.job)
+            self.job = None
+
+    def clear(self):
+        """
+        Discard the samples and clear the chart
+        """
+        self.samples.clear()
+        self.reset_drawing()
+
+    def refresh(self):
+        """
+        Take a sample and draw it
+        """
+        try:
+            sample = self.sample()
+        except Exception as err:
+            logger.warning(f'[refresh] Could not sample: {err!r}')
+        else:
+            self.samples.append(sample)
+            self.draw(sample)
+        self.job = self.after(self.refresh_ms, self.refresh)
+
+    def on_resize(self, event):
+        """
+        Redraw the buffered samples at the new size
+        """
+        if (event.width, event.height) == (self.width, self.height):
+            return
+        self.width, self.height = event.width, event.height
+        self.reset_drawing()
+        for sample in self.samples:
+            self.draw(sample, update_labels=False)
+
+    def to_y(self, trace, value):
+        """
+        :return: y coordinate of a value in the band of a trace
+        """
+        i = self.index[trace.name]
+        top = i * self.band + 2
+        bottom = (i + 1) * self.band - 2
+        if trace.categorical:
+            return (top + bottom) / 2
+        return bottom - (bottom - top) * min(max(value / self.scales[trace.name], 0.0), 1.0)
+
+    def rescale(self, trace, value):
+        """
+        Double the full scale of an autoscaled trace until a value fits, rescaling its items in place
+        """
+        factor = 1.0
+        while value > self.scales[trace.name]:
+            self.scales[trace.name] *= 2
+            factor /= 2
+        if factor != 1.0:
+            bottom = (self.index[trace.name] + 1) * self.band - 2
+            self.canvas.scale(f'trace:{trace.name}', 0, bottom, 1, factor)
+            if self.last[trace.name] is not None:
+                x, y = self.last[trace.name]
+                self.last[trace.name] = (x, bottom - (bottom - y) * factor)
+
+    def draw(self, sample, update_labels=True):
+        """
+        Draw a sample: extend or add a line per trace, scroll the view and delete the items that
+        have scrolled out of view
+
+        :param sample: dict with 't' and a value per trace name
+        :param update_labels: update the value shown in the labels
+        """
+        if self.t0 is None:
+            self.t0 = sample['t']
+        x = (sample['t'] - self.t0) * self.px_per_s
+        canvas = self.canvas
+        for trace in self.traces:
+            name = trace.name
+            value = sample.get(name)
+            items = self.items[name]
+            last = self.last[name]
+            if value is None:
+                self.last[name] = None
+                continue
+            if trace.full_scale is None and not trace.categorical:
+                self.rescale(trace, value)
+                last = self.last[name]
+            y = self.to_y(trace, value)
+            tags = ('trace', f'trace:{name}')
+            if trace.categorical and (last is None or value != self.values[name]):
+                # New segment: a coloured line, labelled where it starts
+                color = self.colors.setdefault(value, PALETTE[len(self.colors) % len(PALETTE)])
+                x0 = x if last is None else last[0]
+                items.append(canvas.create_text(x0 + 2, y - self.band / 2 + 2, text=trace.format(value),
+                                                anchor='nw', fill=color, tags=tags))
+                items.append(canvas.create_line(x0, y, x, y, fill=color, width=3, tags=tags))
+                self.flat[name] = True
+            elif last is None:
+                items.append(canvas.create_line(x, y, x, y, fill=trace.color, width=2, tags=tags))
+                self.flat[name] = True
+            elif y == last[1] and self.flat[name]:
+                # Unchanged: extend the last line
+                canvas.coords(items[-1], canvas.coords(items[-1])[:2] + [x, y])
+            elif trace.step:
+                items.append(canvas.create_line(last[0], last[1], x, last[1], x, y, fill=trace.color, width=2,
+                                                tags=tags))
+                items.append(canvas.create_line(x, y, x, y, fill=trace.color, width=2, tags=tags))
+                self.flat[name] = True
+            else:
+                items.append(canvas.create_line(last[0], last[1], x, y, fill=trace.color, width=2, tags=tags))
+                self.flat[name] = y == last[1]
+            self.last[name] = (x, y)
+            self.values[name] = value
+            # Delete the items that ended before the left edge
+            left = x - self.width
+            while len(items) > 2 and canvas.coords(items[0])[-2] < left:
+                canvas.delete(items.popleft())
+            if update_labels:
+                text = f'{trace.label} {trace.format(value)}'
+                if text != self.label_vars[name].get():
+                    self.label_vars[name].set(text)
+        canvas.configure(scrollregion=(x - self.width, 0, x, self.height))
+        canvas.xview_moveto(0)
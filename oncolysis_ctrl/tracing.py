@@ -0,0 +1,219 @@
+"""
+Tracing Module
+==============
+
+This module records spans (named, timed sections of code, which may nest) of the treatment
+phases, so that a slow frequency transition can be broken down into switch settling, function
+generator writes, verification readback, logging and GUI callbacks. Spans are recorded into a
+bounded in-memory buffer (the oldest spans are dropped when it is full) and exported in the
+Chrome trace event format, which can be opened in Perfetto (ui.perfetto.dev) or chrome://tracing.
+
+Tracing is off by default and can be switched on and off at runtime with `enable` and `disable`.
+When it is off, `span` returns a shared do-nothing context manager, so an instrumented section
+costs a method call and a flag check::
+
+    with tracing.span('set_frequency', frequency_khz=frequency_khz):
+        with tracing.span('fgen.write'):
+            ...
+"""
+import collections
+import functools
+import json
+import logging
+import os
+import threading
+import time
+logger = logging.getLogger("oc.tracing")
+
+TRACE_BUFFER_SIZE = 200000
+
+
+class NullSpan:
+    """
+    Span returned while tracing is off. Records nothing.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """
+    Timed section of code, recorded in the tracer's buffer when it exits
+    """
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.record(self.name, self.start, end - self.start, self.args)
+        return False
+
+    def set(self, **args):
+        """
+        Add arguments to the span (e.g. results only known at the end)
+        """
+        self.args.update(args)
+
+
+class Tracer:
+    """
+    Tracer
+    ======
+
+    Records spans into a bounded buffer, and exports them as a Chrome trace.
+    """
+    def __init__(self, buffer_size=TRACE_BUFFER_SIZE):
+        """
+        Tracer constructor. Tracing is off until `enable` is called.
+
+        :param buffer_size: maximum number of events kept
+        """
+        self.enabled = False
+        self.events = collections.deque(maxlen=buffer_size)
+        self.thread_names = {}
+
+    def enable(self):
+        """
+        Start recording spans
+        """
+        self.enabled = True
+        logger.info('[enable] Tracing on')
+
+    def disable(self):
+        """
+        Stop recording spans. Recorded spans are kept until `clear` is called.
+        """
+        self.enabled = False
+        logger.info(f'[disable] Tracing off ({len(self.events)} events recorded)')
+
+    def clear(self):
+        """
+        Discard recorded spans
+        """
+        self.events.clear()
+
+    def span(self, name, **args):
+        """
+        Create a span, to use as a context manager
+
+        :param name: span name
+        :param args: arguments shown with the span
+        :return: `Span`, or `NULL_SPAN` while tracing is off
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def instant(self, name, **args):
+        """
+        Record an instantaneous event
+
+        :param name: event name
+        :param args: arguments shown with the event
+        """
+        if self.enabled:
+            self.record(name, time.perf_counter_ns(), None, args)
+
+    def traced(self, name=None):
+        """
+        Decorator recording a span around each call of a function
+
+        :param name: span name (default: the qualified name of the function)
+        :return: decorator
+        """
+        def decorator(func):
+            span_name = name or func.__qualname__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with Span(self, span_name, {}):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, start, duration, args):
+        """
+        Add an event to the buffer
+
+        :param name: event name
+        :param start: start time (ns, `time.perf_counter_ns`)
+        :param duration: duration (ns), or None for an instantaneous event
+        :param args: dict of arguments
+        """
+        tid = threading.get_ident()
+        if tid not in self.thread_names:
+            self.thread_names[tid] = threading.current_thread().name
+        self.events.append((name, start, duration, tid, args))
+
+    def to_chrome(self):
+        """
+        Convert the recorded events to the Chrome trace event format
+
+        :return: dict with 'traceEvents', serializable as JSON
+        """
+        # Copy the buffers, as other threads may still be recording. A thread is named before its
+        # first event is added, so every copied event has a thread name.
+        events = list(self.events)
+        thread_names = dict(self.thread_names)
+        pid = os.getpid()
+        origin = min((event[1] for event in events), default=0)
+        trace_events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                        for tid, name in thread_names.items()]
+        for name, start, duration, tid, args in events:
+            event = {'name': name, 'cat': name.split('.', 1)[0], 'pid': pid, 'tid': tid,
+                     'ts': (start - origin) / 1e3}
+            if duration is None:
+                event.update(ph='i', s='t')
+            else:
+                event.update(ph='X', dur=duration / 1e3)
+            if args:
+                event['args'] = args
+            trace_events.append(event)
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def export(self, filename):
+        """
+        Write the recorded events to a Chrome trace JSON file
+
+        :param filename: output file
+        :return: number of events written
+        """
+        trace = self.to_chrome()
+        with open(filename, 'w') as f:
+            json.dump(trace, f, default=str)
+        n = sum(1 for event in trace['traceEvents'] if event['ph'] != 'M')
+        logger.info(f'[export] Wrote {n} events to {filename}')
+        return n
+
+
+TRACER = Tracer()
+span = TRACER.span
+instant = TRACER.instant
+traced = TRACER.traced
+enable = TRACER.enable
+disable = TRACER.disable
+export = TRACER.export
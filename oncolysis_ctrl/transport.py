@@ -0,0 +1,273 @@
+"""
+Transport Module
+================
+
+This module bounds the time the controller can spend waiting on the instruments. A stalled USB
+transaction raises an error after a timeout, instead of blocking the control loop:
+
+* VISA sessions time out by themselves (`function_generator.FunctionGenerator.open` sets the
+  session timeout);
+* calls into the Radiall .NET interface, which cannot time out, are run on a worker thread by a
+  `TimedCaller`, which stops waiting when a call overruns its timeout. The call is left behind,
+  and further calls fail (with an `IOTimeout`) until it returns, so that the interface is never
+  called concurrently.
+
+`RetryPolicy.call` retries idempotent reads (queries, switch position readback) that fail with a
+transient transport error, after an exponential backoff with jitter, and raises a
+`TransportError` once the retries are exhausted. Writes are not retried: after a transport error,
+`controller.Controller.recover` reconnects the sessions and reconciles the hardware with the state
+the controller expects. The policy counts the retries, timeouts, failures and recoveries, and the
+time spent in them, for `controller.Controller.get_status`.
+"""
+import concurrent.futures
+import logging
+import queue
+import random
+import threading
+import time
+from oncolysis_ctrl import config
+constants = config.constants
+logger = logging.getLogger("oc.transport")
+
+# Transient errors of pyvisa and of the .NET runtime, matched by name so that classifying an error
+# does not import either
+TRANSIENT_ERROR_NAMES = ('VisaIOError', 'InvalidSession', 'IOException', 'TimeoutException')
+# VISA status code of a timeout (VI_ERROR_TMO)
+VI_ERROR_TMO = -1073807339
+
+
+class TransportError(IOError):
+    """
+    Raised when an I/O operation fails with a transport error after its retries
+    """
+
+
+class IOTimeout(TransportError, TimeoutError):
+    """
+    Raised when an I/O operation does not complete within its timeout
+    """
+
+
+def is_transient(err):
+    """
+    :param err: exception raised by an I/O operation
+    :return: True if the error is a transport error (a timeout, or a lost or broken session), after
+             which the operation may succeed on a retry or on a new session
+    """
+    return isinstance(err, (TransportError, TimeoutError, ConnectionResetError, ConnectionAbortedError,
+                            BrokenPipeError)) or type(err).__name__ in TRANSIENT_ERROR_NAMES
+
+
+def is_timeout(err):
+    """
+    :param err: exception raised by an I/O operation
+    :return: True if the operation timed out
+    """
+    return isinstance(err, TimeoutError) or getattr(err, 'error_code', None) == VI_ERROR_TMO or \
+        type(err).__name__ == 'TimeoutException'
+
+
+class RetryPolicy:
+    """
+    Retry Policy
+    ============
+
+    Timeout and retries of the instrument I/O, shared by the devices of a controller, with the
+    statistics of the errors and recoveries.
+    """
+    def __init__(self, timeout=constants.IO_TIMEOUT_S, retries=constants.IO_RETRIES, backoff=constants.IO_BACKOFF_S,
+                 backoff_max=constants.IO_BACKOFF_MAX_S, reconnect_attempts=constants.RECONNECT_ATTEMPTS, seed=None):
+        """
+        RetryPolicy constructor
+
+        :param timeout: timeout of each I/O operation (s, None to wait indefinitely)
+        :param retries: number of retries of an idempotent read
+        :param backoff: backoff before the first retry (s), doubled for each further retry
+        :param backoff_max: maximum backoff (s)
+        :param reconnect_attempts: number of attempts to reconnect after a transport error
+        :param seed: seed of the backoff jitter (None for a random seed)
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff
+        self.backoff_max = backoff_max
+        self.reconnect_attempts = reconnect_attempts
+        self.random = random.Random(seed)
+        # Devices are opened concurrently, so their errors may be counted from two threads
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Clear statistics
+        :return: None
+        """
+        with self.lock:
+            self.stats = {'errors': 0, 'timeouts': 0, 'retries': 0, 'failures': 0, 'retry_time': 0.0,
+                          'recoveries': 0, 'recovery_failures': 0, 'recovery_time': 0.0, 'max_recovery_time': 0.0}
+            self.last_error = None
+
+    def backoff(self, attempt):
+        """
+        :param attempt: number of the retry (0 for the first)
+        :return: delay before the retry (s): half of the exponential backoff, plus a random part of
+                 up to the other half, so that the retries of devices failing together are spread out
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return delay / 2 + self.random.uniform(0, delay / 2)
+
+    def call(self, name, operation, *args):
+        """
+        Run an idempotent operation, retrying it after transient errors
+
+        :param name: name of the operation, for the log
+        :param operation: function running the operation
+        :param args: arguments of the operation
+        :return: result of the operation
+        :raises TransportError: if the operation still fails after the retries
+        """
+        attempt = 0
+        t0 = None
+        while True:
+            t_attempt = time.perf_counter()
+            try:
+                result = operation(*args)
+            except Exception as err:
+                if not is_transient(err):
+                    raise
+                if t0 is None:
+                    t0 = t_attempt
+                self.count_error(err)
+                if attempt >= self.retries:
+                    elapsed = time.perf_counter() - t0
+                    with self.lock:
+                        self.stats['failures'] += 1
+                        self.stats['retry_time'] += elapsed
+                    logger.error(f'[call] {name} failed after {attempt + 1} attempts ({elapsed * 1e3:0.0f} ms): {err!r}')
+                    raise TransportError(f'{name} failed after {attempt + 1} attempts: {err!r}') from err
+                delay = self.backoff(attempt)
+                logger.warning(f'[call] {name} failed ({err!r}). Retrying in {delay * 1e3:0.0f} ms')
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if t0 is not None:
+                with self.lock:
+                    self.stats['retries'] += attempt
+                    self.stats['retry_time'] += t_attempt - t0
+                logger.info(f'[call] {name} succeeded after {attempt} retries')
+            return result
+
+    def count_error(self, err):
+        """
+        Record a transport error
+        :param err: the error
+        :return: None
+        """
+        with self.lock:
+            self.stats['errors'] += 1
+            if is_timeout(err):
+                self.stats['timeouts'] += 1
+            self.last_error = repr(err)
+
+    def record_recovery(self, elapsed, ok, err=None):
+        """
+        Record a recovery from a transport error
+
+        :param elapsed: time spent reconnecting and reconciling (s)
+        :param ok: True if the hardware was reconnected
+        :param err: the error that caused the recovery
+        :return: None
+        """
+        with self.lock:
+            self.stats['recoveries'] += 1
+            self.stats['recovery_failures'] += not ok
+            self.stats['recovery_time'] += elapsed
+            self.stats['max_recovery_time'] = max(self.stats['max_recovery_time'], elapsed)
+            if err is not None:
+                self.last_error = repr(err)
+
+    def report(self):
+        """
+        Summarize the transport errors and the time spent recovering from them
+
+        :return: dict of statistics
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            last_error = self.last_error
+        return {'timeout_s': self.timeout,
+                'errors': stats['errors'],
+                'timeouts': stats['timeouts'],
+                'retries': stats['retries'],
+                'failures': stats['failures'],
+                'retry_time_s': stats['retry_time'],
+                'recoveries': stats['recoveries'],
+                'recovery_failures': stats['recovery_failures'],
+                'recovery_time_s': stats['recovery_time'],
+                'max_recovery_s': stats['max_recovery_time'],
+                'last_error': last_error}
+
+
+def serve(requests):
+    """
+    Worker of a `TimedCaller`: run the calls put in a queue until it receives None
+
+    :param requests: queue of (future, operation, args)
+    """
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        future, operation, args = request
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(operation(*args))
+            except BaseException as err:
+                future.set_exception(err)
+
+
+class TimedCaller:
+    """
+    Runs calls that cannot time out by themselves on a worker thread, one at a time, waiting for
+    each at most its timeout. While a call that overran is still running, further calls fail
+    immediately instead of calling the device concurrently.
+    """
+    def __init__(self, name):
+        """
+        :param name: name of the worker thread
+        """
+        self.name = name
+        self.requests = None
+        # Future of a call that overran its timeout and has not returned yet
+        self.overrun = None
+
+    def call(self, timeout, operation, *args):
+        """
+        :param timeout: time to wait for the call (s, None to call on the calling thread)
+        :param operation: function to call
+        :param args: arguments of the function
+        :return: result of the call
+        :raises IOTimeout: if the call does not complete within the timeout, or a previous call that
+                           overran its timeout is still running
+        """
+        name = getattr(operation, '__name__', repr(operation))
+        if self.overrun is not None:
+            if not self.overrun.done():
+                raise IOTimeout(f'{self.name}: {name} not called, a previous call has not completed')
+            self.overrun = None
+        if timeout is None:
+            return operation(*args)
+        if self.requests is None:
+            self.requests = queue.SimpleQueue()
+            threading.Thread(target=serve, args=(self.requests,), name=self.name, daemon=True).start()
+        future = concurrent.futures.Future()
+        self.requests.put((future, operation, args))
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            if future.done():
+                # The call completed just after the timeout (or raised a timeout error itself)
+                return future.result()
+            # The worker is stuck in the call: fail until it returns
+            self.overrun = future
+            raise IOTimeout(f'{self.name}: {name} did not complete within {timeout} s') from None
@@ -0,0 +1,224 @@
+"""
+Hardware Watchdog Module
+========================
+
+This module contains the `HealthWatchdog` class, which checks the health of the hardware while a
+treatment segment is running. The control loop hands the watchdog its idle time between polls of
+the command queue, and the watchdog runs at most one cheap probe at a time, only when the probe is
+expected to finish well before the segment deadline and within its time budget. Probes rotate
+through: instrument alive (``*OPC?``), output still enabled, RF switch positions, and the
+instrument error queue (``SYST:ERR?``).
+
+An unexpected probe result or a slow probe is an anomaly, which escalates to a full check of every
+probe plus the source settings. If the full check fails, the output is stopped and a `WatchdogError`
+is raised, which ends the control loop through its usual error path. A transport error that
+persists after the retries of the I/O is raised as is, for the controller to reconnect.
+"""
+import logging
+import time
+from oncolysis_ctrl import config, transport
+constants = config.constants
+logger = logging.getLogger("oc.watchdog")
+
+
+class WatchdogError(IOError):
+    """
+    Raised when the hardware fails a full health check
+    """
+
+
+class HealthWatchdog:
+    """
+    Health Watchdog
+    ===============
+
+    Interleaves hardware health probes into the idle time of the control loop.
+    """
+    def __init__(self, controller, interval=constants.WATCHDOG_INTERVAL_S, budget=constants.WATCHDOG_BUDGET,
+                 max_latency=constants.WATCHDOG_MAX_LATENCY_S):
+        """
+        HealthWatchdog constructor
+
+        :param controller: controller object to monitor
+        :param interval: minimum time between probes (s)
+        :param budget: maximum fraction of the segment time spent probing
+        :param max_latency: probe latency above which the probe is treated as an anomaly (s)
+        """
+        self.controller = controller
+        self.interval = interval
+        self.budget = budget
+        self.max_latency = max_latency
+        self.probes = (('alive', self.probe_alive),
+                       ('output', self.probe_output),
+                       ('switch', self.probe_switch),
+                       ('errors', self.probe_errors))
+        self.reset()
+
+    def reset(self):
+        """
+        Clear statistics and restart the budget window
+        :return: None
+        """
+        self.t_start = time.perf_counter()
+        self.t_last = self.t_start
+        self.probe_index = 0
+        self.busy_time = 0.0
+        self.full_checks = 0
+        self.stats = {name: {'count': 0, 'total': 0.0, 'max': 0.0, 'expected': self.max_latency / 5}
+                      for name, _ in self.probes + (('settings', None),)}
+
+    @property
+    def enabled(self):
+        return self.interval is not None and not self.controller.simulate and self.controller.treat_on
+
+    def poll(self, slack):
+        """
+        Run the next probe if it is due and fits in the available time
+
+        :param slack: time until the next deadline of the control loop (s)
+        :return: None
+        :raises WatchdogError: if the hardware fails a full check
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if now - self.t_last < self.interval:
+            return
+        name, probe = self.probes[self.probe_index]
+        stats = self.stats[name]
+        if stats['expected'] > min(slack, self.max_latency):
+            return
+        if (self.busy_time + stats['expected']) > self.budget * (now - self.t_start):
+            return
+        self.probe_index = (self.probe_index + 1) % len(self.probes)
+        ok, detail = self.run_probe(name, probe)
+        if not ok:
+            logger.warning(f'[poll] Anomaly in {name} probe: {detail}. Running full check')
+            self.full_check()
+
+    def run_probe(self, name, probe):
+        """
+        Run a single probe and record its latency
+
+        :param name: probe name
+        :param probe: probe function, returning (ok, detail)
+        :return: (ok, detail)
+        :raises transport.TransportError: if the probe fails with a transport error
+        """
+        t0 = time.perf_counter()
+        try:
+            ok, detail = probe()
+        except Exception as e:
+            if transport.is_transient(e):
+                raise
+            ok, detail = False, repr(e)
+        t1 = time.perf_counter()
+        latency = t1 - t0
+        stats = self.stats[name]
+        stats['count'] += 1
+        stats['total'] += latency
+        stats['max'] = max(stats['max'], latency)
+        stats['expected'] = 0.8 * stats['expected'] + 0.2 * latency
+        self.busy_time += latency
+        self.t_last = t1
+        if ok and latency > self.max_latency:
+            ok, detail = False, f'slow response ({latency * 1e3:0.1f} ms)'
+        return ok, detail
+
+    def full_check(self):
+        """
+        Run every probe and verify the source settings. Stops the output if any check fails.
+
+        :return: None
+        :raises WatchdogError: if any check fails
+        """
+        self.full_checks += 1
+        failures = []
+        for name, probe in self.probes + (('settings', self.probe_settings),):
+            ok, detail = self.run_probe(name, probe)
+            if not ok and name == 'errors':
+                logger.warning(f'[full_check] Instrument reported {detail}')
+                ok, detail = self.run_probe(name, self.drain_errors)
+            if not ok:
+                failures.append(f'{name}: {detail}')
+        if failures:
+            logger.critical(f'[full_check] Failed: {"; ".join(failures)}')
+            self.safe_stop()
+            raise WatchdogError(f'Hardware health check failed ({"; ".join(failures)})')
+        logger.info('[full_check] Passed')
+
+    def safe_stop(self):
+        """
+        Disable the output, even if the controller state cannot be updated cleanly
+        """
+        try:
+            self.controller.stop_treatment(reset_timer=True)
+        except Exception as e:
+            logger.critical(f'[safe_stop] Could not stop treatment: {e!r}')
+            self.controller.treat_on = False
+            try:
+                self.controller.fgen.close()
+            except Exception as e:
+                logger.critical(f'[safe_stop] Could not close function generator: {e!r}')
+
+    def probe_alive(self):
+        response = self.controller.fgen.ping()
+        return response == '1', f'*OPC? returned {response!r}'
+
+    def probe_output(self):
+        enabled = self.controller.xmit.get_output_enabled()
+        return enabled == self.controller.treat_on, f'output enabled={enabled}'
+
+    def probe_switch(self):
+        positions = self.controller.get_switch_positions(self.controller.frequency)
+        if positions is None:
+            return True, 'unmapped frequency'
+        for switch, position in zip(self.controller.switches, positions):
+            if position is not None:
+                read_position = switch.get_position()
+                if read_position != position:
+                    return False, f'{switch.comport} at {read_position} (expected {position})'
+        return True, ''
+
+    def probe_errors(self):
+        code, message = self.controller.fgen.get_error()
+        return code == 0, f'error {code}: {message}'
+
+    def drain_errors(self, max_errors=20):
+        """
+        Read (and log) every entry in the instrument error queue
+
+        :param max_errors: maximum number of entries to read
+        :return: (ok, detail) where ok is True if the queue could be emptied
+        """
+        for _ in range(max_errors):
+            code, message = self.controller.fgen.get_error()
+            if code == 0:
+                return True, ''
+            logger.warning(f'[drain_errors] error {code}: {message}')
+        return False, f'more than {max_errors} errors queued'
+
+    def probe_settings(self):
+        settings = self.controller.xmit.get_settings()
+        frequency = self.controller.frequency
+        if frequency is not None and abs(settings['frequency'] - frequency * 1e3) > 1e-6 * frequency * 1e3:
+            return False, f'frequency {settings["frequency"]} Hz (expected {frequency * 1e3} Hz)'
+        if abs(settings['amplitude'] - self.controller.voltage) > 1e-3:
+            return False, f'amplitude {settings["amplitude"]} V (expected {self.controller.voltage} V)'
+        return True, ''
+
+    def report(self):
+        """
+        Summarize probe latency and budget usage
+
+        :return: dict of statistics
+        """
+        elapsed = max(time.perf_counter() - self.t_start, 1e-9)
+        probes = {name: {'count': stats['count'],
+                         'mean_ms': 1e3 * stats['total'] / stats['count'] if stats['count'] else None,
+                         'max_ms': 1e3 * stats['max']} for name, stats in self.stats.items()}
+        return {'budget': self.budget,
+                'budget_used': self.busy_time / elapsed,
+                'busy_time_s': self.busy_time,
+                'full_checks': self.full_checks,
+                'probes': probes}
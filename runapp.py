@@ -6,35 +6,39 @@ The configuration prefixed with an asterisk (*) will be the default configuratio
 
 The -simulate flag can be used to run the application in simulation mode, which will not communicate with the hardware.
 
-The -config and -simulate flags can be used in any order. 
+The -loglevel flag sets the log level (e.g. WARNING to skip the per-command logs). The default is INFO.
 
-Usage: python runapp.py [-s] [-config CONFIG_ID[,CONFIG_ID...]]
+The -trace flag switches span tracing on from the start (it can also be toggled with Ctrl+Shift+T in the GUI).
+The trace is saved as Chrome trace JSON alongside the logs.
+
+The -serve flag runs a headless controller server on the given local port instead of the GUI, and the
+-attach flag launches the GUI as a client of a running server.
+
+The flags can be used in any order. 
+
+Usage: python runapp.py [-s] [-loglevel LEVEL] [-trace] [-config CONFIG_ID[,CONFIG_ID...]] [-serve [PORT] | -attach [HOST:]PORT]
 """
+import time
+start_time = time.perf_counter()
 import oncolysis_ctrl.config
+import oncolysis_ctrl.logs
 import sys
-import importlib
 import ctypes
 import os
 import datetime
 import logging
+import socket
 import sys
 
 HERE = os.path.dirname(__file__)
 timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-logpath = os.path.join(HERE, '..', 'logs')
+logpath = oncolysis_ctrl.config.LOG_PATH
 if not os.path.exists(logpath):
     os.makedirs(logpath, exist_ok=True)
-logfile = os.path.join(logpath, f'{timestamp}.log')
-logfmt = '%(asctime)s | %(levelname)s | %(name)s | %(message)s'
-logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=logfmt)
+logfile = oncolysis_ctrl.logs.make_log_filename(logpath, timestamp)
+oncolysis_ctrl.logs.setup_logging(logfile, fields={'session': f'{timestamp}_{os.getpid()}',
+                                                   'host': socket.gethostname()})
 logger = logging.getLogger("oc")
-fh = logging.FileHandler(logfile)
-fh.setLevel(logging.INFO)
-file_formatter = logging.Formatter(
-    '{"time": \"%(asctime)s\", "level": %(levelname)s, "name": \"%(name)s\", "message": \"%(message)s\"}'
-)
-fh.setFormatter(file_formatter)
-logger.addHandler(fh)
 
 # runapp launches the application with the specified configuration. 
 # The configuration can be specified using the -config flag, followed by a comma-separated list of configuration IDs. 
@@ -44,15 +48,24 @@ logger.addHandler(fh)
 
 if __name__ == "__main__":
     """
-    Usage: python runapp.py [-s] [-config CONFIG_ID[,CONFIG_ID...]]
+    Usage: python runapp.py [-s] [-loglevel LEVEL] [-trace] [-config CONFIG_ID[,CONFIG_ID...]] [-serve [PORT] | -attach [HOST:]PORT]
     """
     i = 0
     simulate = False
+    trace = False
+    serve_port = None
+    server_address = None
     config_ids = oncolysis_ctrl.config.CONFIG_IDS
     while i < len(sys.argv):
         if sys.argv[i] in ('-s', '--simulate'):
             simulate = True
             i += 1
+        elif sys.argv[i] in ('-trace',):
+            trace = True
+            i += 1
+        elif sys.argv[i] in ('-loglevel',):
+            logging.getLogger().setLevel(sys.argv[i+1].upper())
+            i += 2
         elif sys.argv[i] in ('-config',):
             config_id_list = sys.argv[i+1]
             config_ids = config_id_list.upper().split(',')
@@ -62,21 +75,36 @@ if __name__ == "__main__":
             else:
                 default_idx = 0
             config_ids = [x[1:] if x[0] == '*' else x for x in config_ids]
-            oncolysis_ctrl.config.set_config_id(config_ids[default_idx])
-            importlib.reload(oncolysis_ctrl.config)
+            oncolysis_ctrl.config.load_config(config_ids[default_idx])
+            i += 2
+        elif sys.argv[i] in ('-serve',):
+            from oncolysis_ctrl import server
+            if i + 1 < len(sys.argv) and sys.argv[i+1].isdigit():
+                serve_port = int(sys.argv[i+1])
+                i += 2
+            else:
+                serve_port = server.DEFAULT_PORT
+                i += 1
+        elif sys.argv[i] in ('-attach',):
+            from oncolysis_ctrl import server
+            host, _, port = sys.argv[i+1].rpartition(':')
+            server_address = (host or server.DEFAULT_HOST, int(port))
             i += 2
         else:
             i += 1
 
     import oncolysis_ctrl.app
-    from oncolysis_ctrl import rf_switch, function_generator, controller
     kernel32 = ctypes.windll.kernel32
     kernel32.SetConsoleMode(kernel32.GetStdHandle(-10), 128)
-    oncolysis_ctrl.app.runapp(simulate=simulate, config_ids=config_ids)
-    while oncolysis_ctrl.config.REBOOT:
-        importlib.reload(oncolysis_ctrl.config)
-        importlib.reload(oncolysis_ctrl.app)
-        for module in (rf_switch, function_generator, controller):
-            importlib.reload(module)
-        oncolysis_ctrl.app.runapp(simulate=simulate, config_ids=config_ids)
+    if serve_port is not None:
+        if trace:
+            oncolysis_ctrl.tracing.enable()
+        try:
+            oncolysis_ctrl.server.serve(simulate=simulate, port=serve_port)
+        finally:
+            if trace:
+                oncolysis_ctrl.tracing.export(os.path.join(logpath, f'{timestamp}_trace.json'))
+        sys.exit()
+    oncolysis_ctrl.app.runapp(simulate=simulate, config_ids=config_ids, server_address=server_address, trace=trace,
+                              start_time=start_time)
 
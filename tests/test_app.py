@@ -0,0 +1,64 @@
+"""
+Tests of the GUI logic that runs without a display
+"""
+import types
+import pytest
+from oncolysis_ctrl import app, benchmark, clock, config, dose
+
+
+@pytest.fixture
+def config_file(tmp_path, monkeypatch):
+    """
+    Keep the configuration switches of a test out of the saved configuration ID
+    """
+    monkeypatch.setattr(config, 'CONFIG_FILENAME', str(tmp_path / 'CONFIG_ID.txt'))
+    monkeypatch.setattr(config, 'config_id', config.config_id)
+    monkeypatch.setattr(config, 'constants', config.constants)
+
+
+def make_app(controller):
+    """
+    :param controller: controller
+    :return: stand-in for the `app.App` attributes used by `App.load_config`, without the widgets
+    """
+    stand_in = types.SimpleNamespace(controller=controller, reloaded=[], reconciled=[], names=[])
+    stand_in.config_name = types.SimpleNamespace(set=stand_in.names.append)
+    stand_in.reload_config = stand_in.reloaded.append
+    stand_in.control_queue = types.SimpleNamespace(reconcile=lambda: stand_in.reconciled.append(True))
+    return stand_in
+
+
+def test_load_config_while_connected(config_file):
+    controller = benchmark.make_controller()
+    stand_in = make_app(controller)
+    config_id = next(cid for cid in config.CONFIG_IDS if cid != config.config_id)
+    app.App.load_config(stand_in, config.CONFIG_NAMES[config.CONFIG_IDS.index(config_id)])
+    assert config.config_id == config_id
+    assert controller.is_connected
+    assert list(controller.rf_switch_settings) == list(config.get_constants(config_id).RF_SWITCH_SETTINGS)
+    assert [constants.ID for constants in stand_in.reloaded] == [config.get_constants(config_id).ID]
+    assert stand_in.reconciled == [True]
+    assert stand_in.names == []
+    controller.close()
+
+
+def test_refused_start_saves_no_dose():
+    saved = []
+    widget = types.SimpleNamespace(configure=lambda **kwargs: None, set=lambda value: None)
+    stand_in = types.SimpleNamespace(controller=types.SimpleNamespace(simulate=True),
+                                     save_dose=lambda: saved.append(True),
+                                     abort_button=widget, startpause_button=widget, pbar_label_var=widget,
+                                     set_controls_enabled=lambda enabled: None, check_ready=lambda: None)
+    app.App.on_end(stand_in, 'Safety Limit Exceeded')
+    assert saved == []
+    app.App.on_end(stand_in, 'Treatment Aborted')
+    assert saved == [True]
+
+
+def test_attached_app_saves_no_dose(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'LOG_PATH', str(tmp_path))
+    controller = types.SimpleNamespace(clock=clock.VirtualClock(), dose=dose.DoseIntegrator())
+    app.App.save_dose(types.SimpleNamespace(attached=True, controller=controller))
+    assert list(tmp_path.iterdir()) == []
+    app.App.save_dose(types.SimpleNamespace(attached=False, controller=controller))
+    assert len(list(tmp_path.iterdir())) == 1
@@ -0,0 +1,60 @@
+"""
+Tests of the interpolation of the voltage calibration
+"""
+import numpy as np
+import pytest
+from oncolysis_ctrl import calibration, config
+
+CALIB = {100: {'p_ref': 600, 'coeff_a': 1e-3, 'coeff_b': 1.5},
+         150: {'p_ref': 750, 'coeff_a': 1.5e-3, 'coeff_b': 1.4},
+         250.5: {'p_ref': 900, 'coeff_a': 2e-3, 'coeff_b': 1.2}}
+
+
+@pytest.mark.parametrize('cid', config.CONFIG_IDS)
+def test_exact_at_calibration_points(cid):
+    calib = config.get_constants(cid).CALIB
+    cal = calibration.Calibration(calib)
+    values = cal.evaluate(list(calib))
+    for k, frequency in enumerate(calib):
+        assert cal.get(frequency) == calib[frequency]
+        for field in calibration.CALIB_FIELDS:
+            assert values[field][k] == calib[frequency][field]
+        assert cal.get_uncertainty(frequency)['voltage'] == 0.0
+
+
+def test_evaluate_matches_get():
+    cal = calibration.Calibration(CALIB)
+    frequencies = np.linspace(100, 250.5, 1001)
+    values = cal.evaluate(frequencies)
+    for k, frequency in enumerate(frequencies):
+        point = cal.get(float(frequency))
+        for field in calibration.CALIB_FIELDS:
+            assert values[field][k] == pytest.approx(point[field], rel=1e-12)
+
+
+def test_no_overshoot():
+    cal = calibration.Calibration(CALIB)
+    frequencies = sorted(CALIB)
+    for f0, f1 in zip(frequencies[:-1], frequencies[1:]):
+        values = cal.evaluate(np.linspace(f0, f1, 101))
+        for field in calibration.CALIB_FIELDS:
+            low, high = sorted((CALIB[f0][field], CALIB[f1][field]))
+            assert np.all((values[field] >= low - 1e-12) & (values[field] <= high + 1e-12))
+
+
+@pytest.mark.parametrize('step', [1, 0.1, 0.7])
+def test_continuous_at_end_of_range(step):
+    cal = calibration.Calibration(CALIB, step=step)
+    below = cal.get(250.49)
+    for field in calibration.CALIB_FIELDS:
+        assert below[field] == pytest.approx(CALIB[250.5][field], rel=1e-4)
+        assert cal.evaluate([250.49])[field][0] == pytest.approx(below[field], rel=1e-12)
+
+
+def test_outside_range():
+    cal = calibration.Calibration(CALIB)
+    assert not cal.covers(99.9)
+    with pytest.raises(calibration.CalibrationError):
+        cal.get(99.9)
+    with pytest.raises(calibration.CalibrationError):
+        cal.evaluate([150, 251])
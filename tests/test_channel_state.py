@@ -0,0 +1,63 @@
+"""
+Tests of the compilation of function generator transitions
+"""
+import pytest
+from oncolysis_ctrl.channel_state import ChannelState, compile_transition
+
+AMPLITUDE = 'SOURCE1:VOLTAGE:LEVEL:IMMEDIATE:AMPLITUDE'
+FREQUENCY = 'SOURCE1:FREQUENCY:FIXED'
+CYCLES = 'SOURCE1:BURST:NCYCLES'
+PERIOD = 'SOURCE1:BURST:INTERNAL:PERIOD'
+CURRENT = ChannelState(output=True, function='SIN', frequency=100e3, amplitude=0.5, offset=0, phase=0,
+                       burst_enabled=True, burst_mode='TRIG', burst_cycles=400, burst_period=0.4, trig_source='INT')
+
+
+def test_raising_transition():
+    target = ChannelState(frequency=200e3, amplitude=0.8, burst_cycles=800)
+    commands, state = compile_transition(CURRENT, target, 1)
+    # The frequency comes before the longer burst, and the amplitude is raised last
+    assert commands == (f'{FREQUENCY} 200000.0', f'{CYCLES} 800', f'{AMPLITUDE} 0.8')
+    assert state == CURRENT.update(target)
+
+
+def test_lowering_transition():
+    current = CURRENT.replace(frequency=200e3, amplitude=0.8, burst_cycles=800, burst_period=0.2)
+    target = ChannelState(frequency=100e3, amplitude=0.5, burst_cycles=400, burst_period=0.4)
+    commands, state = compile_transition(current, target, 1)
+    # The amplitude is lowered and the burst shortened before the frequency changes
+    assert commands == (f'{AMPLITUDE} 0.5', f'{CYCLES} 400', f'{PERIOD} 0.4', f'{FREQUENCY} 100000.0')
+    assert state == CURRENT
+
+
+def test_no_change():
+    assert compile_transition(CURRENT, CURRENT, 1) == ((), CURRENT)
+
+
+@pytest.mark.parametrize('target, command', [(ChannelState(burst_mode='GAT'), 'SOURCE1:BURST:MODE GAT'),
+                                             (ChannelState(function='SQU', frequency=50e3),
+                                              'SOUR1:APPLY:SQU 50000.0, 0.5, 0, 0')])
+def test_mode_change_holds_output_off(target, command):
+    commands, state = compile_transition(CURRENT, target, 1)
+    assert commands == ('OUTPUT1:STAT OFF', command, 'OUTPUT1:STAT ON')
+    assert state.output
+
+
+def test_output_disabled():
+    commands, state = compile_transition(CURRENT, ChannelState(output=False), 1)
+    assert commands == ('OUTPUT1:STAT OFF',)
+    assert state == CURRENT.replace(output=False)
+
+
+def test_unknown_current_state():
+    target = ChannelState(output=True, frequency=100e3, amplitude=0.5, burst_enabled=True, burst_cycles=400)
+    commands, state = compile_transition(ChannelState(), target, 2)
+    assert commands == ('OUTPUT2:STAT OFF', 'SOURCE2:FREQUENCY:FIXED 100000.0', 'SOURCE2:BURST:NCYCLES 400',
+                        'SOURCE2:BURST:STATE ON', 'SOURCE2:VOLTAGE:LEVEL:IMMEDIATE:AMPLITUDE 0.5', 'OUTPUT2:STAT ON')
+    assert state == target
+
+
+def test_max_voltage():
+    with pytest.raises(ValueError):
+        compile_transition(CURRENT, ChannelState(amplitude=1.6), 1, max_voltage=1.5)
+    commands, _ = compile_transition(CURRENT, ChannelState(amplitude=1.5), 1, max_voltage=1.5)
+    assert commands == (f'{AMPLITUDE} 1.5',)
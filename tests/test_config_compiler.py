@@ -0,0 +1,99 @@
+"""
+Tests of the validation and compilation of configurations
+"""
+import copy
+import json
+import logging
+import os
+import shutil
+import pytest
+from oncolysis_ctrl import config, config_compiler
+
+
+def get_constants(cid='INVITRO_8MM'):
+    """
+    :return: dict of the constants of a shipped configuration
+    """
+    return copy.deepcopy(config_compiler.get_module_constants(config.get_constants(cid)))
+
+
+def test_shipped_configurations_are_valid():
+    for cid in config.CONFIG_IDS:
+        assert config_compiler.validate(get_constants(cid)) == [], cid
+
+
+def test_default_power_outside_envelope():
+    constants = get_constants()
+    constants['POWER_SETTINGS']['constant_mi']['default'] = 100
+    errors = config_compiler.validate(constants)
+    assert errors and all('POWER_SETTINGS[constant_mi] default 100 exceeds the safety envelope' in e for e in errors)
+
+
+def write_configuration(folder, name, data):
+    """
+    Write a JSON configuration file
+    :return: path to the file
+    """
+    path = folder / f'constants_{name}.json'
+    path.write_text(json.dumps(data), encoding='utf-8')
+    return str(path)
+
+
+def make_configurations(folder):
+    """
+    Write a base configuration exported from a shipped one, and a configuration extending it
+    :return: path to the extending configuration
+    """
+    shutil.copy(os.path.join(os.path.dirname(config.__file__), 'configurations', 'constants_global.py'), folder)
+    config_compiler.export(config.get_constants('INVITRO_8MM'), folder / 'constants_base.json')
+    return write_configuration(folder, 'child', {'extends': ['global', 'base'], 'ID': 'CHILD', 'NAME': 'Child'})
+
+
+def test_load_is_cached(tmp_path, caplog):
+    path = make_configurations(tmp_path)
+    with caplog.at_level(logging.INFO, logger='oc.config_compiler'):
+        module = config_compiler.load(path)
+        assert config_compiler.load(path) is module
+        # A new process loads the compiled form
+        config_compiler._loaded.clear()
+        reloaded = config_compiler.load(path)
+    assert [r.getMessage() for r in caplog.records].count('[load] Compiling constants_child.json') == 1
+    assert reloaded is not module
+    assert (reloaded.ID, reloaded.NAME, reloaded.CALIB) == ('CHILD', 'Child', module.CALIB)
+
+
+def test_load_recompiles_when_base_changes(tmp_path):
+    path = make_configurations(tmp_path)
+    module = config_compiler.load(path)
+    base_path = tmp_path / 'constants_base.json'
+    base = json.loads(base_path.read_text(encoding='utf-8'))
+    frequency = str(module.FREQUENCIES_KHZ[0])
+    base['CALIB'][frequency]['p_ref'] += 1
+    base_path.write_text(json.dumps(base), encoding='utf-8')
+    recompiled = config_compiler.load(path)
+    assert recompiled is not module
+    assert recompiled.CALIB[module.FREQUENCIES_KHZ[0]]['p_ref'] == module.CALIB[module.FREQUENCIES_KHZ[0]]['p_ref'] + 1
+    # The compiled form of the old sources is not used by a new process either
+    config_compiler._loaded.clear()
+    assert config_compiler.load(path).CALIB == recompiled.CALIB
+
+
+@pytest.mark.parametrize('data, match', [({'FREQUENCIES_KHZ': [100, 777]}, '777'),
+                                         ({'NAME': 5}, 'NAME'),
+                                         ({'extends': ['missing']}, 'missing'),
+                                         ({'extends': ['child']}, 'Circular')])
+def test_load_rejects_invalid_configuration(tmp_path, data, match):
+    make_configurations(tmp_path)
+    path = write_configuration(tmp_path, 'invalid', {'extends': ['global', 'base'], **data})
+    if data.get('extends') == ['child']:
+        write_configuration(tmp_path, 'child', {'extends': ['invalid']})
+    with pytest.raises(config_compiler.ConfigError, match=match):
+        config_compiler.load(path)
+
+
+def test_load_rejects_unparseable_file(tmp_path):
+    make_configurations(tmp_path)
+    path = tmp_path / 'constants_broken.json'
+    path.write_text('{"ID": ', encoding='utf-8')
+    with pytest.raises(config_compiler.ConfigError, match='Could not parse'):
+        config_compiler.load(str(path))
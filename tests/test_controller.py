@@ -0,0 +1,123 @@
+"""
+Tests of the control loop, on simulated hardware and a virtual clock
+"""
+import queue
+import pytest
+from oncolysis_ctrl import clock, config, controller, envelope
+
+FREQUENCIES_KHZ = list(config.constants.FREQUENCIES_KHZ[:2])
+
+
+def make_controller(**kwargs):
+    """
+    :return: controller in simulation mode on a virtual clock, within the safety envelope
+    """
+    c = controller.Controller(frequencies=list(FREQUENCIES_KHZ), simulate=True, ask_simulate=None,
+                              clock=clock.VirtualClock(), **kwargs)
+    max_value, _, _ = c.envelope.get_max_value(c.frequencies, c.power_mode, c.burst_length, c.burst_duty_cycle)
+    c.power_value = min(c.power_value, max_value)
+    c.open()
+    return c
+
+
+def test_abort_reports_final_dose():
+    c = make_controller()
+    commands = queue.Queue()
+    ended = []
+
+    def on_wait(treat_time, duration):
+        if treat_time >= 1.5 and commands.empty() and not ended:
+            commands.put('STOP')
+            commands.put('KILL')
+
+    def on_end(message='Treatment Complete'):
+        # The GUI saves the dose without the time of an active segment
+        ended.append((message, c.treat_on, c.dose.get_session_totals()))
+
+    commands.put('START')
+    controller.control_loop(c, commands, on_wait=on_wait, on_end=on_end)
+    assert len(ended) == 1, 'the control loop did not end the run after STOP'
+    message, treat_on, totals = ended[0]
+    assert message == 'Treatment Aborted'
+    assert not treat_on
+    assert totals['on_time_s'] == pytest.approx(1.5, abs=controller.POLL_INTERVAL_S * 1.01)
+    assert totals['energy_j_cm2'] > 0
+
+
+def test_configure_refused_during_run():
+    c = make_controller()
+    commands = queue.Queue()
+    refused = []
+
+    def on_wait(treat_time, duration):
+        if treat_time >= 0.5 and commands.empty() and not refused:
+            commands.put('PAUSE')
+            with pytest.raises(RuntimeError):
+                c.configure(frequencies=FREQUENCIES_KHZ[:1], duration=0.1)
+            refused.append((list(c.frequencies), c.duration))
+            commands.put('RESUME')
+
+    commands.put('START')
+    controller.control_loop(c, commands, on_wait=on_wait, on_end=lambda message='': commands.put('KILL'))
+    assert refused == [(FREQUENCIES_KHZ, c.duration)]
+    assert not c.run_active
+    c.configure(frequencies=FREQUENCIES_KHZ[:1])
+    assert c.frequencies == FREQUENCIES_KHZ[:1]
+
+
+def test_envelope_uses_constructor_options():
+    c = controller.Controller(frequencies=[], frequency_options=FREQUENCIES_KHZ, burst_lengths=(0.02,),
+                              duty_cycles=(0.01,), simulate=True, ask_simulate=None, clock=clock.VirtualClock())
+    assert {(f, bl, dc) for f, _, bl, dc in c.envelope.table} == \
+        {(f, 0.02, 0.01) for f in FREQUENCIES_KHZ}
+
+
+def test_start_outside_envelope_is_refused():
+    c = make_controller()
+    max_value, _, _ = c.envelope.get_max_value(c.frequencies, c.power_mode, c.burst_length, c.burst_duty_cycle)
+    c.power_value = max_value + 1
+    commands = queue.Queue()
+    ended = []
+
+    def on_end(message='Treatment Complete'):
+        ended.append(message)
+        commands.put('KILL')
+
+    commands.put('START')
+    controller.control_loop(c, commands, on_end=on_end)
+    assert ended == ['Safety Limit Exceeded']
+    assert not c.run_active
+
+
+def test_default_settings_within_envelope():
+    c = controller.Controller(simulate=True, ask_simulate=None, clock=clock.VirtualClock())
+    c.configure(frequencies=config.constants.FREQUENCIES_KHZ, duration=0.5)
+    assert c.check_envelope() == []
+    ended = []
+    controller.run_protocol(c, {}, on_end=ended.append)
+    assert ended == ['Treatment Complete']
+
+
+def test_configure_outside_envelope():
+    c = make_controller()
+    settings = (c.frequencies, c.power_value, c.burst_duty_cycle)
+    max_value, _, _ = c.envelope.get_max_value(c.frequencies, c.power_mode, c.burst_length, c.burst_duty_cycle)
+    with pytest.raises(envelope.EnvelopeError):
+        c.configure(power_value=max_value + 1, duty_cycle=0.5)
+    assert (c.frequencies, c.power_value, c.burst_duty_cycle) == settings
+
+
+def test_treat_outside_envelope_is_reported():
+    c = make_controller()
+    max_value, _, _ = c.envelope.get_max_value(c.frequencies, c.power_mode, c.burst_length, c.burst_duty_cycle)
+    c.power_value = max_value + 1
+    commands = queue.Queue()
+    ended = []
+
+    def on_end(message='Treatment Complete'):
+        ended.append(message)
+        commands.put('KILL')
+
+    commands.put('TREAT')
+    controller.control_loop(c, commands, on_end=on_end)
+    assert ended == ['Safety Limit Exceeded']
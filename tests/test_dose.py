@@ -0,0 +1,46 @@
+"""
+Tests of the acoustic dose integration
+"""
+import json
+import pytest
+from oncolysis_ctrl import dose
+
+
+def test_segments():
+    integrator = dose.DoseIntegrator(mi_threshold=1.0, limits={})
+    integrator.start_segment(100, t=0, mi=1.5, ispta=500)
+    integrator.stop_segment(t=2)
+    integrator.start_segment(200, t=3, mi=0.5, ispta=100)
+    # The active segment is only included at a given time
+    assert integrator.get_session_totals()['on_time_s'] == 2
+    session = integrator.get_session_totals(t=4)
+    assert session == pytest.approx({'on_time_s': 3, 'energy_j_cm2': 1.1, 'time_above_mi_s': 2, 'ispta_s': 1100})
+    integrator.stop_segment(t=4)
+    assert integrator.get_session_totals() == session
+    totals = integrator.get_totals()
+    assert totals[100]['energy_j_cm2'] == pytest.approx(1.0)
+    assert totals[200]['time_above_mi_s'] == 0
+
+
+def test_limits():
+    integrator = dose.DoseIntegrator(mi_threshold=1.0, limits={'on_time_s': 10, 'energy_j_cm2': 2, 'ispta_s': None})
+    assert set(integrator.limits) == {'on_time_s', 'energy_j_cm2'}
+    integrator.start_segment(100, t=0, mi=1.5, ispta=500)
+    assert integrator.time_to_limit(t=1) == pytest.approx(3)
+    assert integrator.check_limits(t=3) == []
+    assert integrator.check_limits(t=4) == ['energy_j_cm2']
+    integrator.stop_segment(t=4)
+    assert integrator.time_to_limit(t=4) is None
+
+
+def test_reset_and_save(tmp_path):
+    integrator = dose.DoseIntegrator(mi_threshold=1.0, limits={})
+    integrator.start_segment(100, t=0, mi=1.5, ispta=500)
+    filename = tmp_path / 'dose.json'
+    integrator.save(filename, t=2)
+    with open(filename) as f:
+        saved = json.load(f)
+    assert saved['session']['on_time_s'] == 2
+    assert saved['frequencies']['100']['ispta_s'] == 1000
+    integrator.reset()
+    assert integrator.get_session_totals(t=5) == dict.fromkeys(dose.DOSE_FIELDS, 0.0)
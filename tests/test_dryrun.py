@@ -0,0 +1,61 @@
+"""
+Tests of the protocol dry run, against runs of the control loop on a virtual clock
+"""
+import numpy as np
+from oncolysis_ctrl import benchmark, config, controller, dryrun
+
+FREQUENCIES_KHZ = list(config.constants.FREQUENCIES_KHZ)
+
+
+def make_controller(limits=None):
+    """
+    :param limits: cumulative dose limits (default: the configuration's)
+    :return: function returning a simulated controller
+    """
+    def make():
+        c = controller.Controller(frequencies=list(FREQUENCIES_KHZ), simulate=True, ask_simulate=None)
+        if limits is not None:
+            c.dose.limits = dict(limits)
+        return c
+    return make
+
+
+def get_statuses(make, protocols):
+    estimate = dryrun.ProtocolEstimator(make()).estimate_protocols(protocols)
+    return [dryrun.STATUSES[status] for status in estimate['status']]
+
+
+def test_random_protocols_match_runs():
+    make = make_controller()
+    protocols = benchmark.random_protocols(make(), 30, seed=2)
+    assert dryrun.validate(make, protocols) == []
+
+
+def test_dose_limit_matches_runs():
+    make = make_controller({'on_time_s': 25.0})
+    protocols = [{'frequencies': FREQUENCIES_KHZ[:2], 'duration': duration} for duration in (10, 20, 30)]
+    assert get_statuses(make, protocols) == ['Treatment Complete', 'Dose Limit Reached', 'Dose Limit Reached']
+    assert dryrun.validate(make, protocols) == []
+
+
+def test_refused_protocols_match_runs():
+    make = make_controller()
+    c = make()
+    max_value, _, _ = c.envelope.get_max_value(FREQUENCIES_KHZ[:1], c.power_mode, c.burst_length, c.burst_duty_cycle)
+    protocols = [{'frequencies': FREQUENCIES_KHZ[:1], 'duration': 5, 'power_value': max_value},
+                 {'frequencies': FREQUENCIES_KHZ[:1], 'duration': 5, 'power_value': max_value * 1.1},
+                 {'frequencies': [FREQUENCIES_KHZ[-1] * 10], 'duration': 5},
+                 {'frequencies': [], 'duration': 5}]
+    assert get_statuses(make, protocols) == ['Treatment Complete', 'Safety Limit Exceeded', 'Error', 'Error']
+    assert dryrun.validate(make, protocols) == []
+
+
+def test_validate_reports_mismatches():
+    # The estimate is made without the dose limit the runs stop at
+    controllers = iter([make_controller()()])
+    limited = make_controller({'on_time_s': 5.0})
+    protocols = [{'frequencies': FREQUENCIES_KHZ[:1], 'duration': 20}]
+    mismatches = dryrun.validate(lambda: next(controllers, None) or limited(), protocols)
+    fields = {field: (expected, actual) for _, field, expected, actual in mismatches}
+    assert fields['status'] == ('Treatment Complete', 'Dose Limit Reached')
+    assert np.isclose(fields['runtime_s'][0], 20, atol=1) and fields['runtime_s'][1] < 20
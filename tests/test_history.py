@@ -0,0 +1,85 @@
+"""
+Tests of the run history store
+"""
+import datetime
+import pytest
+from oncolysis_ctrl import dose, history
+
+PROTOCOL = {'frequencies': [100, 150], 'power_mode': 'constant_mi', 'power_value': 20, 'duration': 60,
+            'burst_length': 10, 'duty_cycle': 0.5}
+T0 = datetime.datetime(2024, 3, 1, 12).timestamp()
+DAY = 86400.0
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = history.RunStore(str(tmp_path / 'history.sqlite3'), flush_interval=0.01)
+    yield store
+    store.close()
+
+
+def test_round_trip(store):
+    dose_totals = {field: float(i + 1) for i, field in enumerate(dose.DOSE_FIELDS)}
+    run_id = store.start_run('INVITRO_8MM', PROTOCOL, simulate=True, notes='first', started=T0)
+    store.add_segment(run_id, 150, T0 + 5, 2.5, 0.4)
+    store.add_segment(run_id, 100, T0 + 1, 3.0, 0.3)
+    store.add_note(run_id, 'second')
+    store.end_run(run_id, 'Treatment Complete', dose_totals=dose_totals, ended=T0 + 60)
+    store.flush()
+    run, = store.query_runs()
+    assert run == {'run_id': run_id, 'started': T0, 'ended': T0 + 60, 'config_id': 'INVITRO_8MM', 'simulate': 1,
+                   'frequencies': [100.0, 150.0], 'power_mode': 'constant_mi', 'power_value': 20.0,
+                   'duration': 60.0, 'burst_length': 10.0, 'duty_cycle': 0.5, 'status': 'Treatment Complete',
+                   'error': None, 'notes': 'first\nsecond', **dose_totals}
+    assert store.get_segments(run_id) == [
+        {'run_id': run_id, 'frequency': 100.0, 'started': T0 + 1, 'on_time_s': 3.0, 'voltage': 0.3},
+        {'run_id': run_id, 'frequency': 150.0, 'started': T0 + 5, 'on_time_s': 2.5, 'voltage': 0.4}]
+
+
+def test_unfinished_run(store):
+    run_id = store.start_run('INVITRO_8MM', {}, started=T0)
+    store.flush()
+    run, = store.query_runs()
+    assert run['run_id'] == run_id
+    assert (run['status'], run['ended'], run['frequencies'], run['notes']) == (None, None, [], None)
+
+
+def test_queries(store):
+    runs = []
+    for day in range(10):
+        config_id = 'INVITRO_8MM' if day % 2 else 'INVIVO_FLANK'
+        protocol = {**PROTOCOL, 'power_value': 10 + day}
+        run_id = store.start_run(config_id, protocol, started=T0 + day * DAY)
+        store.add_segment(run_id, 100 if day < 5 else 150, T0 + day * DAY, 1.0, 0.2)
+        store.end_run(run_id, 'Treatment Complete', ended=T0 + day * DAY + 60)
+        runs.append(run_id)
+    store.flush()
+
+    def run_ids(**kwargs):
+        return [run['run_id'] for run in store.query_runs(**kwargs)]
+    assert run_ids(limit=None) == runs[::-1]
+    assert run_ids(limit=3) == runs[:-4:-1]
+    assert run_ids(limit=3, offset=3) == runs[-4:-7:-1]
+    assert run_ids(since=T0 + 2 * DAY, until=datetime.datetime.fromtimestamp(T0 + 4 * DAY)) == [runs[3], runs[2]]
+    assert run_ids(since=datetime.date.fromtimestamp(T0 + 8 * DAY).isoformat()) == [runs[9], runs[8]]
+    assert run_ids(config_id='INVITRO_8MM') == runs[1::2][::-1]
+    assert run_ids(frequency=150) == runs[5:][::-1]
+    assert run_ids(min_power=12, max_power=13, power_mode='constant_mi') == [runs[3], runs[2]]
+    assert run_ids(power_mode='constant_pressure') == []
+
+
+def test_writes_are_batched(tmp_path):
+    store = history.RunStore(str(tmp_path / 'history.sqlite3'), batch_size=50, flush_interval=1.0)
+    run_id = store.start_run('INVITRO_8MM', PROTOCOL, started=T0)
+    for i in range(199):
+        store.add_segment(run_id, 100, T0 + i, 1.0, 0.2)
+    store.close()
+    assert store.n_written == 200
+    # Four full batches, and the empty one that stops the writer
+    assert store.n_batches == 5
+    # A new store reads the runs written by the previous one
+    store = history.RunStore(store.filename)
+    try:
+        assert len(store.get_segments(run_id)) == 199
+    finally:
+        store.close()
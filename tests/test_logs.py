@@ -0,0 +1,81 @@
+"""
+Tests of the compression of session logs
+"""
+import gzip
+import logging
+import os
+import subprocess
+import sys
+from oncolysis_ctrl import logs
+
+
+def exited_pid():
+    """
+    :return: PID of a process that has exited
+    """
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write_log(logpath, timestamp, pid, text=b'{}\n'):
+    filename = os.path.join(logpath, f'{timestamp}_{pid}{logs.LOG_EXTENSION}')
+    with open(filename, 'wb') as f:
+        f.write(text)
+    return filename
+
+
+def test_compress_old_logs_skips_running_processes(tmp_path):
+    live = write_log(tmp_path, '20240101_000000', os.getpid())
+    unnamed = os.path.join(tmp_path, f'20240101_000000{logs.LOG_EXTENSION}')
+    open(unnamed, 'w').close()
+    logs.compress_old_logs(str(tmp_path))
+    assert os.path.exists(live) and not os.path.exists(live + '.gz')
+    assert os.path.exists(unnamed) and not os.path.exists(unnamed + '.gz')
+
+
+def test_compress_old_logs_of_exited_process(tmp_path):
+    pid = exited_pid()
+    assert not logs.is_process_running(pid)
+    old = write_log(tmp_path, '20240101_000000', pid, b'new\n')
+    # A compressed log of the same name is kept
+    with gzip.open(old + '.gz', 'wb') as f:
+        f.write(b'old\n')
+    logs.compress_old_logs(str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == [f'20240101_000000_{pid}-1{logs.LOG_EXTENSION}.gz',
+                                            f'20240101_000000_{pid}{logs.LOG_EXTENSION}.gz']
+    with gzip.open(os.path.join(tmp_path, f'20240101_000000_{pid}-1{logs.LOG_EXTENSION}.gz')) as f:
+        assert f.read() == b'new\n'
+
+
+def test_compress_log_leaves_no_duplicate(tmp_path, monkeypatch):
+    source = write_log(tmp_path, '20240101_000000', exited_pid())
+
+    def remove(path):
+        if path == source:
+            raise PermissionError(path)
+        os.unlink(path)
+    monkeypatch.setattr(logs.os, 'remove', remove)
+    logs.compress_old_logs(str(tmp_path))
+    assert os.listdir(tmp_path) == [os.path.basename(source)]
+
+
+def test_stop_logging_compresses_session_log(tmp_path):
+    root = logging.getLogger()
+    saved_handlers, saved_level = list(root.handlers), root.level
+    logfile = logs.make_log_filename(str(tmp_path), '20240101_000000')
+    assert logs.get_log_pid(logfile) == os.getpid()
+    with open(os.devnull, 'w') as console:
+        try:
+            logs.setup_logging(logfile, stream=console)
+            logging.getLogger('oc.test').info('[test] Logged')
+        finally:
+            logs.stop_logging()
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            for handler in saved_handlers:
+                root.addHandler(handler)
+            root.setLevel(saved_level)
+    assert not os.path.exists(logfile)
+    with gzip.open(logfile + '.gz') as f:
+        assert b'[test] Logged' in f.read()
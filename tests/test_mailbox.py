@@ -0,0 +1,35 @@
+"""
+Tests of the GUI mailbox, without a Tk main loop
+"""
+from oncolysis_ctrl import mailbox
+
+
+def test_drain_coalesces_by_key():
+    box = mailbox.Mailbox(root=None)
+    events = []
+    progress = box.wrap(lambda value: events.append(('progress', value)), key='progress')
+    for value in range(3):
+        progress(value)
+    box.post(events.append, 'end')
+    progress(3)
+    box.post(events.append, 'closed')
+    box.drain()
+    # Only the last progress update runs, at its place in the order of events
+    assert events == ['end', ('progress', 3), 'closed']
+    assert (box.n_posted, box.n_run) == (6, 3)
+    box.drain()
+    assert len(events) == 3
+
+
+def test_drain_continues_after_error():
+    box = mailbox.Mailbox(root=None)
+    events = []
+    box.post(lambda: 1 / 0)
+    box.post(events.append, 'after')
+    box.drain()
+    assert events == ['after']
+
+
+def test_call_from_main_thread():
+    box = mailbox.Mailbox(root=None)
+    assert box.call(sum, (1, 2)) == 3
@@ -0,0 +1,21 @@
+"""
+Tests of the multi-rig orchestrator, on simulated rigs
+"""
+from oncolysis_ctrl import config, orchestrator
+
+
+def test_jobs_on_rig_configuration():
+    # Constant MI of 53% at 230 kHz is within the envelope of the in vivo configuration only
+    protocol = {'frequencies': [230], 'power_mode': 'constant_mi', 'power_value': 53, 'duration': 0.2}
+    rigs = [orchestrator.Rig('invivo', simulate=True, config_id='INVIVO_FLANK'),
+            orchestrator.Rig('invitro', simulate=True, config_id='INVITRO_8MM')]
+    assert rigs[0].rf_switch_sn == tuple(config.get_constants('INVIVO_FLANK').RADIALL_SN)
+    results = {}
+    for rig in rigs:
+        with orchestrator.Orchestrator([rig], hang_timeout=10) as orch:
+            job_id = orch.submit(protocol)
+            results[rig.rig_id] = orch.run(timeout=30)[job_id]
+    assert results['invivo']['state'] == 'complete'
+    assert results['invivo']['message'] == 'Treatment Complete'
+    assert results['invitro']['state'] == 'failed'
+    assert 'safety envelope' in results['invitro']['message']
@@ -0,0 +1,52 @@
+"""
+Tests of the reconciliation of the hardware state, on simulated instruments
+"""
+from oncolysis_ctrl import benchmark, reconcile
+
+AMPLITUDE = 'SOURCE:VOLTAGE:LEVEL:IMMEDIATE:AMPLITUDE'
+
+
+def reconcile_controller(c):
+    source_params, burst_params, switch_positions = c.get_desired_state()
+    return reconcile.reconcile(c.xmit, source_params, burst_params, switches=c.switches,
+                               switch_positions=switch_positions)
+
+
+def test_open_writes_only_changes():
+    c = benchmark.make_controller()
+    assert c.reconcile_report.commands
+    instrument = c.fgen.resource_manager.instrument
+    n_writes = instrument.n_writes
+    report = reconcile_controller(c)
+    assert report.fields_changed == {}
+    assert report.commands == ()
+    assert instrument.n_writes == n_writes
+    c.close()
+
+
+def test_drift_is_corrected():
+    c = benchmark.make_controller()
+    instrument = c.fgen.resource_manager.instrument
+    amplitude = instrument.settings[(c.xmit.channel, AMPLITUDE)]
+    instrument.settings[(c.xmit.channel, AMPLITUDE)] = '0.2'
+    instrument.settings[(c.xmit.channel, 'OUTPUT:STAT')] = 'ON'
+    report = reconcile_controller(c)
+    assert set(report.fields_changed) == {'output', 'amplitude'}
+    assert report.fields_changed['output'] == (True, False)
+    # The output is disabled before anything else is written
+    assert report.commands[0].startswith('OUTPUT1')
+    assert float(instrument.settings[(c.xmit.channel, AMPLITUDE)]) == float(amplitude)
+    assert instrument.settings[(c.xmit.channel, 'OUTPUT:STAT')] == 'OFF'
+    c.close()
+
+
+def test_switch_position_is_corrected():
+    c = benchmark.make_controller()
+    c.set_frequency(c.frequencies[-1])
+    _, _, switch_positions = c.get_desired_state()
+    i, position = next((i, position) for i, position in enumerate(switch_positions) if position is not None)
+    c.switches[i].interface.position = position % 6 + 1
+    report = reconcile_controller(c)
+    assert report.fields_changed == {f'switch[{i}].position': (position % 6 + 1, position)}
+    assert c.switches[i].interface.position == position
+    c.close()
@@ -0,0 +1,81 @@
+"""
+Tests of the controller server, without clients
+"""
+import json
+import pytest
+from oncolysis_ctrl import clock, config, controller, server
+
+
+@pytest.fixture
+def controller_server():
+    c = controller.Controller(frequencies=[], simulate=True, ask_simulate=None, clock=clock.VirtualClock())
+    s = server.ControllerServer(c, port=0)
+    yield s
+    if s.control_queue.control_loop_thread.is_alive():
+        s.control_queue.kill()
+    s.server_close()
+
+
+def test_connect_after_control_loop_error(controller_server):
+    c = controller_server.controller
+    opened = []
+
+    def open_fails(progress=None):
+        raise RuntimeError('open failed')
+    c.open = open_fails
+    controller_server.dispatch('connect', {})
+    controller_server.control_queue.control_loop_thread.join(5)
+    assert not controller_server.control_queue.control_loop_thread.is_alive()
+
+    c.open = lambda progress=None: opened.append(True)
+    controller_server.dispatch('connect', {})
+    assert controller_server.control_queue.control_loop_thread.is_alive()
+    controller_server.dispatch('disconnect', {})
+    assert opened == [True]
+
+
+def test_serve_uses_loaded_configuration(monkeypatch):
+    constants = config.get_constants(next(cid for cid in config.CONFIG_IDS if cid != config.config_id))
+    monkeypatch.setattr(config, 'constants', constants)
+    served = []
+
+    class Server:
+        def __init__(self, ctrl, host, port):
+            served.append(ctrl)
+            self.control_queue = controller.ControlQueue(ctrl)
+
+        def serve_forever(self):
+            raise KeyboardInterrupt
+
+        def server_close(self):
+            pass
+    monkeypatch.setattr(server, 'ControllerServer', Server)
+    monkeypatch.setattr(server.history, 'RunStore', lambda: type('Store', (), {'close': lambda self: None})())
+    server.serve(simulate=True, port=0)
+    assert served[0].voltage_calibration == constants.CALIB
+
+
+def test_attached_controller_mirrors_telemetry(controller_server):
+    c = controller_server.controller
+    messages = []
+
+    class Client:
+        topics = set(server.TOPICS)
+
+        def send(self, message):
+            messages.append(json.loads(message))
+    controller_server.clients.add(Client())
+    c.frequency, c.voltage, c.treat_on, c.treat_time_start = 100, 0.25, True, 0.0
+    c.dose.start_segment(c.frequency, 0.0, mi=1.0, ispta=500.0)
+    c.clock.sleep(2.0)
+    controller_server.on_wait(2.0, 10.0)
+    controller_server.on_treat(0)
+
+    local = controller.Controller(frequencies=[], simulate=True, ask_simulate=None)
+    waits = []
+    remote = server.RemoteControlQueue(local, on_wait=lambda *args: waits.append(args))
+    for message in messages:
+        remote.on_event(message['event'], message['data'])
+        assert (local.frequency, local.voltage, local.treat_on) == (c.frequency, 0.25, True)
+        assert remote.get_dose_totals()['energy_j_cm2'] == pytest.approx(1.0)
+    assert waits == [(2.0, 10.0)]
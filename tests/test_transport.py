@@ -0,0 +1,129 @@
+"""
+Tests of the instrument I/O timeouts, retries and recovery
+"""
+import concurrent.futures
+import threading
+import pytest
+from oncolysis_ctrl import benchmark, transport
+
+
+def make_policy(**kwargs):
+    return transport.RetryPolicy(**{'timeout': 0.05, 'retries': 2, 'backoff': 0.0, 'seed': 0, **kwargs})
+
+
+def flaky(errors, result='ok'):
+    """
+    :param errors: errors raised by the first calls
+    :return: operation raising the errors, then returning the result, and the list of its calls
+    """
+    calls = []
+
+    def operation():
+        calls.append(True)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+    return operation, calls
+
+
+def test_retry_policy_retries_transient_errors():
+    policy = make_policy()
+    operation, calls = flaky([transport.IOTimeout('stalled'), ConnectionResetError('reset')])
+    assert policy.call('read', operation) == 'ok'
+    assert len(calls) == 3
+    report = policy.report()
+    assert (report['errors'], report['timeouts'], report['retries'], report['failures']) == (2, 1, 2, 0)
+
+
+def test_retry_policy_gives_up():
+    policy = make_policy(retries=1)
+    operation, calls = flaky([TimeoutError()] * 3)
+    with pytest.raises(transport.TransportError):
+        policy.call('read', operation)
+    assert len(calls) == 2
+    assert policy.report()['failures'] == 1
+
+
+def test_retry_policy_raises_other_errors():
+    policy = make_policy()
+    operation, calls = flaky([KeyError('bad')])
+    with pytest.raises(KeyError):
+        policy.call('read', operation)
+    assert len(calls) == 1
+    assert policy.report()['errors'] == 0
+
+
+def test_backoff():
+    policy = make_policy(backoff=0.1, backoff_max=0.3)
+    for attempt, delay in enumerate((0.1, 0.2, 0.3, 0.3)):
+        assert delay / 2 <= policy.backoff(attempt) <= delay
+
+
+def test_timed_caller_fails_until_overrun_call_returns():
+    caller = transport.TimedCaller('test')
+    release = threading.Event()
+    active = []
+    concurrent_calls = []
+
+    def operation(wait):
+        active.append(True)
+        concurrent_calls.append(len(active))
+        if wait:
+            release.wait(5)
+        active.pop()
+        return 'done'
+
+    with pytest.raises(transport.IOTimeout):
+        caller.call(0.01, operation, True)
+    with pytest.raises(transport.IOTimeout):
+        caller.call(0.01, operation, False)
+    release.set()
+    caller.overrun.result(5)
+    assert caller.call(1.0, operation, False) == 'done'
+    assert concurrent_calls == [1, 1]
+
+
+def test_timed_caller_returns_late_result(monkeypatch):
+    class LateFuture(concurrent.futures.Future):
+        """
+        Future completing just after the timeout of the wait
+        """
+        def result(self, timeout=None):
+            value = super().result()
+            if timeout is not None:
+                raise concurrent.futures.TimeoutError()
+            return value
+    monkeypatch.setattr(transport.concurrent.futures, 'Future', LateFuture)
+    assert transport.TimedCaller('test').call(0.01, lambda: 'late') == 'late'
+
+
+def test_recover_reconnects_and_reconciles():
+    c = benchmark.make_controller()
+    c.set_frequency(c.frequencies[0])
+    c.fgen.resource_manager.instrument.faults.disconnect()
+    with pytest.raises(Exception) as err:
+        c.xmit.get_settings()
+    assert transport.is_transient(err.value)
+    c.recover(err.value)
+    assert c.xmit.get_settings()
+    report = c.io_policy.report()
+    assert (report['recoveries'], report['recovery_failures']) == (1, 0)
+    c.close()
+
+
+def test_recover_gives_up(monkeypatch):
+    c = benchmark.make_controller()
+    c.io_policy.reconnect_attempts = 2
+    c.io_policy.backoff_base = 0.0
+    attempts = []
+
+    def reconnect():
+        attempts.append(True)
+        raise ConnectionError('no device')
+    monkeypatch.setattr(c, 'reconnect', reconnect)
+    with pytest.raises(transport.TransportError):
+        c.recover(transport.TransportError('session lost'))
+    assert len(attempts) == 2
+    assert c.io_policy.report()['recovery_failures'] == 1
+    monkeypatch.undo()
+    c.close()
@@ -0,0 +1,110 @@
+"""
+Tests of the hardware health watchdog, on a fake controller and a fake clock
+"""
+import types
+import pytest
+from oncolysis_ctrl import watchdog
+
+
+class Clock:
+    """
+    Clock advanced by the probes
+    """
+    def __init__(self):
+        self.t = 0.0
+
+    def perf_counter(self):
+        return self.t
+
+
+class Fgen:
+    def __init__(self, clock, latency):
+        self.clock = clock
+        self.latency = latency
+        self.calls = 0
+
+    def ping(self):
+        self.calls += 1
+        self.clock.t += self.latency
+        return '1'
+
+    def get_error(self):
+        self.calls += 1
+        self.clock.t += self.latency
+        return 0, 'No error'
+
+    def close(self):
+        pass
+
+
+def make_watchdog(monkeypatch, latency=0.001, output=True, **kwargs):
+    """
+    :return: watchdog of a treating controller whose instruments answer after latency (s), and its clock
+    """
+    clock = Clock()
+    monkeypatch.setattr(watchdog.time, 'perf_counter', clock.perf_counter)
+    fgen = Fgen(clock, latency)
+    stopped = []
+    c = types.SimpleNamespace(simulate=False, treat_on=True, frequency=100, voltage=0.5, switches=[], fgen=fgen,
+                              get_switch_positions=lambda frequency: None,
+                              stop_treatment=lambda reset_timer: stopped.append(reset_timer))
+    c.xmit = types.SimpleNamespace(get_output_enabled=lambda: output,
+                                   get_settings=lambda: {'frequency': 100e3, 'amplitude': 0.5})
+    return watchdog.HealthWatchdog(c, **kwargs), clock, stopped
+
+
+def test_probes_within_budget(monkeypatch):
+    wd, clock, _ = make_watchdog(monkeypatch, latency=0.002, interval=0.0, budget=0.05, max_latency=0.02)
+    for _ in range(1000):
+        clock.t += 0.001
+        wd.poll(slack=1.0)
+    report = wd.report()
+    assert report['full_checks'] == 0
+    probes = sum(stats['count'] for stats in report['probes'].values())
+    assert probes > 10
+    # At most one probe beyond the budget
+    assert wd.busy_time <= wd.budget * clock.t + 0.002
+
+
+def test_probe_interval(monkeypatch):
+    wd, clock, _ = make_watchdog(monkeypatch, interval=0.1, budget=1.0)
+    for _ in range(100):
+        clock.t += 0.01
+        wd.poll(slack=1.0)
+    probes = sum(stats['count'] for stats in wd.report()['probes'].values())
+    assert 5 <= probes <= 10
+
+
+def test_no_probe_without_slack(monkeypatch):
+    wd, clock, _ = make_watchdog(monkeypatch, interval=0.0, budget=1.0, max_latency=0.05)
+    for _ in range(100):
+        clock.t += 0.01
+        wd.poll(slack=0.001)
+    assert wd.controller.fgen.calls == 0
+
+
+def test_idle_when_not_treating(monkeypatch):
+    wd, clock, _ = make_watchdog(monkeypatch, interval=0.0, budget=1.0)
+    wd.controller.treat_on = False
+    clock.t += 1.0
+    wd.poll(slack=1.0)
+    assert wd.controller.fgen.calls == 0
+
+
+def test_anomaly_stops_output(monkeypatch):
+    wd, clock, stopped = make_watchdog(monkeypatch, output=False, interval=0.0, budget=1.0)
+    wd.probe_index = 1
+    clock.t += 1.0
+    with pytest.raises(watchdog.WatchdogError, match='output'):
+        wd.poll(slack=1.0)
+    assert wd.full_checks == 1
+    assert stopped == [True]
+
+
+def test_slow_probe_runs_full_check(monkeypatch):
+    wd, clock, stopped = make_watchdog(monkeypatch, latency=0.01, interval=0.0, budget=1.0, max_latency=0.005)
+    wd.stats['alive']['expected'] = 0.0
+    clock.t += 1.0
+    with pytest.raises(watchdog.WatchdogError, match='slow response'):
+        wd.poll(slack=1.0)
+    assert stopped == [True]